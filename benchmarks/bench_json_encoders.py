@@ -0,0 +1,82 @@
+# encoding: utf-8
+"""
+Compare the JSON encoders of the flask-restful representation on library
+payloads shaped like the Classic and ADS 2.0 library end points
+
+    python benchmarks/bench_json_encoders.py
+"""
+
+import os
+import sys
+import random
+import timeit
+import argparse
+
+PROJECT_HOME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')
+)
+sys.path.append(PROJECT_HOME)
+
+from flask import Flask
+from harbour.representations import ENCODERS, make_json_representation
+
+
+def make_payload(number, documents):
+    """
+    Response of a library end point
+    :param number: number of libraries
+    :param documents: number of documents per library
+    :return: dict
+    """
+    random.seed(0)
+    return {
+        'libraries': [
+            {
+                'name': 'Library {}'.format(i),
+                'description': 'Papers on the cosmic microwave background, '
+                               'for the review in preparation',
+                'documents': [
+                    '{}A&A...{:03d}A.{:03d}E'.format(
+                        random.randint(1990, 2016),
+                        random.randint(1, 999),
+                        random.randint(1, 999)
+                    ) for _ in range(documents)
+                ]
+            } for i in range(number)
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    arguments = parser.parse_args()
+
+    payloads = [
+        ('classic', make_payload(20, 200)),
+        ('twopointoh', make_payload(50, 2000))
+    ]
+    app = Flask(__name__)
+
+    print('{:<12} {:<8} {:>12}'.format('payload', 'encoder', 'encode (ms)'))
+    for payload_name, payload in payloads:
+        for name, encoder in ENCODERS:
+            if encoder is None:
+                print('{:<12} {:<8} {:>12}'.format(
+                    payload_name, name, 'not installed'
+                ))
+                continue
+
+            output_json = make_json_representation(name)
+            with app.test_request_context():
+                seconds = min(timeit.repeat(
+                    lambda: output_json(payload, 200),
+                    number=1, repeat=arguments.repeat
+                ))
+            print('{:<12} {:<8} {:>12.2f}'.format(
+                payload_name, name, seconds * 1000
+            ))
+
+
+if __name__ == '__main__':
+    main()
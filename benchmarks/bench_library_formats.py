@@ -0,0 +1,89 @@
+# encoding: utf-8
+"""
+Compare the parse time and peak memory of the JSON and binary formats of the
+ADS 2.0 library dumps, on synthetic libraries
+
+    python benchmarks/bench_library_formats.py --libraries 50 --documents 2000
+"""
+
+import os
+import sys
+import json
+import random
+import timeit
+import argparse
+import tracemalloc
+
+PROJECT_HOME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')
+)
+sys.path.append(PROJECT_HOME)
+
+from harbour.library_format import encode_libraries, decode_libraries
+
+
+def make_libraries(number, documents, pool_size):
+    """
+    Synthetic libraries whose bibcodes are drawn from a shared pool
+    :param number: number of libraries
+    :param documents: number of documents per library
+    :param pool_size: number of distinct bibcodes
+    :return: list of libraries
+    """
+    random.seed(0)
+    pool = [
+        '{}ApJ...{:03d}..{:03d}X'.format(
+            random.randint(1990, 2016), random.randint(1, 999), i % 1000
+        ) for i in range(pool_size)
+    ]
+    return [
+        {
+            'name': 'Library {}'.format(i),
+            'description': 'Synthetic library',
+            'documents': random.sample(pool, min(documents, pool_size))
+        } for i in range(number)
+    ]
+
+
+def peak_memory(function, data):
+    """
+    Peak memory allocated while parsing, in bytes
+    """
+    tracemalloc.start()
+    result = function(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--libraries', type=int, default=50)
+    parser.add_argument('--documents', type=int, default=2000)
+    parser.add_argument('--pool', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    arguments = parser.parse_args()
+
+    libraries = make_libraries(
+        arguments.libraries, arguments.documents, arguments.pool
+    )
+    formats = [
+        ('json', json.dumps(libraries).encode('utf-8'), json.loads),
+        ('binary', encode_libraries(libraries), decode_libraries)
+    ]
+
+    print('{:<8} {:>12} {:>12} {:>14}'.format(
+        'format', 'size (B)', 'parse (ms)', 'peak mem (B)'
+    ))
+    for name, data, function in formats:
+        seconds = min(timeit.repeat(
+            lambda: function(data), number=1, repeat=arguments.repeat
+        ))
+        print('{:<8} {:>12} {:>12.2f} {:>14}'.format(
+            name, len(data), seconds * 1000, peak_memory(function, data)
+        ))
+
+
+if __name__ == '__main__':
+    main()
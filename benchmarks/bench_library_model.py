@@ -0,0 +1,66 @@
+# encoding: utf-8
+"""
+Compare the memory held by the parsed ADS 2.0 libraries, as dictionaries and
+in the compact form of harbour.library_model, and the time to serialise them
+
+    python benchmarks/bench_library_model.py --libraries 50 --documents 2000
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import tracemalloc
+
+PROJECT_HOME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')
+)
+sys.path.append(PROJECT_HOME)
+
+from bench_library_formats import make_libraries
+from harbour.library_model import compact_libraries, to_json_value
+
+
+def held_memory(function, data):
+    """
+    Memory still allocated by the result of function, in bytes
+    """
+    tracemalloc.start()
+    result = function(data)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--libraries', type=int, default=50)
+    parser.add_argument('--documents', type=int, default=2000)
+    parser.add_argument('--pool', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    arguments = parser.parse_args()
+
+    data = json.dumps(make_libraries(
+        arguments.libraries, arguments.documents, arguments.pool
+    ))
+    forms = [
+        ('dict', json.loads),
+        ('compact', lambda data: compact_libraries(json.loads(data)))
+    ]
+
+    print('{:<8} {:>14} {:>14}'.format('form', 'held mem (B)', 'dumps (ms)'))
+    for name, function in forms:
+        libraries = function(data)
+        seconds = min(timeit.repeat(
+            lambda: json.dumps(libraries, default=to_json_value),
+            number=1, repeat=arguments.repeat
+        ))
+        print('{:<8} {:>14} {:>14.2f}'.format(
+            name, held_memory(function, data), seconds * 1000
+        ))
+
+
+if __name__ == '__main__':
+    main()
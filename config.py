@@ -26,15 +26,135 @@ ADS_CLASSIC_MIRROR_LIST = [
     'saaoads.chpc.ac.za',
     'adsabs.harvard.edu'
 ]
+# Mirrors that serve myADS; the fastest healthy one is used
+ADS_CLASSIC_MYADS_MIRRORS = ['adsabs.harvard.edu']
+# Probes of the mirrors every INTERVAL seconds, 0 to disable; the summaries
+# of /mirrors?status=1 are computed over the last WINDOW probes. The prober
+# is started by the serving entry point, wsgi.py
+HARBOUR_MIRROR_PROBE_INTERVAL = 0
+HARBOUR_MIRROR_PROBE_TIMEOUT = 5
+HARBOUR_MIRROR_PROBE_WINDOW = 60
+# Timeouts and retries of the requests made by harbour.client.Client, by the
+# policy named at the call site; settings not given come from default.
+#   connect_timeout, read_timeout: seconds of each attempt
+#   retries: retries of idempotent (GET) requests only, after a connection
+#     error, a timeout or a 502/503/504
+#   backoff, max_backoff: a retry waits a random time up to
+#     min(max_backoff, backoff * 2 ** attempt) seconds
+#   deadline: seconds after which no attempt is started, None for no limit
+HARBOUR_CLIENT_POLICIES = {
+    'default': {
+        'connect_timeout': 5,
+        'read_timeout': 30,
+        'retries': 0,
+        'backoff': 0.5,
+        'max_backoff': 5,
+        'deadline': None
+    },
+    'auth': {
+        'read_timeout': 30,
+        'deadline': 30
+    },
+    'libraries': {
+        'read_timeout': 20,
+        'retries': 2,
+        'deadline': 30
+    },
+    'myads': {
+        'read_timeout': 10,
+        'retries': 2,
+        'deadline': 30
+    }
+}
+# Circuit breaker of each ADS Classic mirror: it opens after FAILURES errors
+# or timeouts within WINDOW seconds, and lets a probe through after
+# RESET_TIMEOUT seconds. 0 failures disables the breakers.
+HARBOUR_CIRCUIT_BREAKER_FAILURES = 5
+HARBOUR_CIRCUIT_BREAKER_WINDOW = 60
+HARBOUR_CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+# In-process cache of the ADS Classic libraries, by mirror and cookie. Stale
+# libraries are returned while they are fetched again in the background, and
+# kept if ADS Classic fails, until they are MAX_AGE seconds old.
+ADS_CLASSIC_LIBRARY_CACHE_SIZE = 64 * 1024 * 1024
+ADS_CLASSIC_LIBRARY_CACHE_TTL = 5 * 60
+ADS_CLASSIC_LIBRARY_CACHE_MAX_AGE = 24 * 60 * 60
+# Read the ADS Classic libraries in chunks of this many bytes, and parse them
+# one library and one entry at a time, rather than as a whole document
+ADS_CLASSIC_LIBRARIES_STREAM = True
+ADS_CLASSIC_LIBRARIES_CHUNK_SIZE = 64 * 1024
 ADS_TWO_POINT_OH_S3_MONGO_BUCKET = 'adsabs-mongogut'
-ADS_TWO_POINT_OH_LOADED_USERS = False
+# How users.json is loaded by a worker: sync, background or lazy
+ADS_TWO_POINT_OH_USERS_LOAD = 'sync'
 ADS_TWO_POINT_OH_USERS = {}
+# Path of a memory-mapped users index shared by all workers on a host
+ADS_TWO_POINT_OH_USERS_INDEX = None
+ADS_TWO_POINT_OH_USERS_ETAG = None
+# Seconds between polls of users.json for changes, 0 to disable
+ADS_TWO_POINT_OH_USERS_REFRESH_INTERVAL = 0
 ADS_TWO_POINT_OH_MIRROR = 'adsabs.harvard.edu'
+# Pass the S3 library dumps straight through to the client without parsing
+ADS_TWO_POINT_OH_STREAM_LIBRARIES = False
+ADS_TWO_POINT_OH_STREAM_CHUNK_SIZE = 64 * 1024
+# In-process cache of parsed ADS 2.0 libraries, bounded in bytes
+ADS_TWO_POINT_OH_LIBRARY_CACHE_SIZE = 128 * 1024 * 1024
+ADS_TWO_POINT_OH_LIBRARY_CACHE_TTL = 60 * 60
+ADS_TWO_POINT_OH_LIBRARY_CACHE_VALIDATE = True
+# Prefer the copies converted by `manage.py convert` to the JSON dumps, when
+# they were converted from the current dumps
+ADS_TWO_POINT_OH_BINARY_FORMAT = False
+# Batch retrieval of ADS 2.0 libraries
+ADS_TWO_POINT_OH_BATCH_MAX_UIDS = 1000
+ADS_TWO_POINT_OH_BATCH_WORKERS = 8
+# On-disk cache of S3 objects shared by the workers of a host, None to disable
+ADS_TWO_POINT_OH_DISK_CACHE_DIR = None
+ADS_TWO_POINT_OH_DISK_CACHE_SIZE = 1024 * 1024 * 1024
+ADS_TWO_POINT_OH_DISK_CACHE_COMPRESSION = 'zlib'
+
+# Storage of the ADS 2.0 data: s3 (ADS_TWO_POINT_OH_S3_MONGO_BUCKET) or local
+HARBOUR_STORAGE_BACKEND = 's3'
+# Directory of the local storage, and the URL it is served under for exports
+HARBOUR_STORAGE_LOCAL_DIR = None
+HARBOUR_STORAGE_LOCAL_URL = None
+
+# Connection pool of the per-process S3 client
+HARBOUR_S3_MAX_POOL_CONNECTIONS = 10
+HARBOUR_S3_CONNECT_TIMEOUT = 5
+HARBOUR_S3_READ_TIMEOUT = 30
+HARBOUR_S3_RETRY_MODE = 'standard'
+HARBOUR_S3_MAX_ATTEMPTS = 3
+# Needs botocore >= 1.27
+HARBOUR_S3_TCP_KEEPALIVE = False
+
+# Compression of the library and myADS responses, br needs brotli
+HARBOUR_COMPRESSION_ENCODINGS = ['br', 'gzip']
+HARBOUR_COMPRESSION_MIN_SIZE = 1024
+HARBOUR_COMPRESSION_GZIP_LEVEL = 6
+HARBOUR_COMPRESSION_BROTLI_QUALITY = 5
+# Compressed responses kept by ETag, bounded in bytes
+HARBOUR_COMPRESSION_CACHE_SIZE = 64 * 1024 * 1024
+
+# JSON encoder of the responses: auto, orjson, ujson or json
+HARBOUR_JSON_ENCODER = 'auto'
 
 SQLALCHEMY_DATABASE_URI = ""
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 HARBOUR_EXPORT_SERVICE_URL = 'http://fakeapi.adsabs.harvard.edu/v1/export'
 HARBOUR_EXPORT_TYPES = ['zotero', 'mendeley']
+# BibTeX exports: bibcodes per request to the export service, and number
+# of concurrent requests
+HARBOUR_EXPORT_BATCH_SIZE = 500
+HARBOUR_EXPORT_WORKERS = 4
+HARBOUR_EXPORT_SERVICE_TIMEOUT = 60
+# Lifetime of the signed export URLs, which are reused while at least the
+# given fraction of it remains
+HARBOUR_EXPORT_URL_EXPIRES = 1800
+HARBOUR_EXPORT_URL_MIN_REMAINING = 0.5
+HARBOUR_EXPORT_URL_CACHE_SIZE = 16 * 1024 * 1024
+# Generate the exports that do not exist yet, and remember for how long
+# whether an export exists
+HARBOUR_EXPORT_GENERATE = True
+HARBOUR_EXPORT_EXISTS_TTL = 5 * 60
+HARBOUR_EXPORT_EXISTS_CACHE_SIZE = 1024 * 1024
 
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'staging').lower()
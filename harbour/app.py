@@ -3,21 +3,43 @@
 Application factory
 """
 
+import os
 import json
-import boto3
+import time
+import tempfile
+import threading
 import logging.config
 
-from flask import Flask
+from flask import Flask, request
 from flask_watchman import Watchman
 from flask_restful import Api
 from flask_discoverer import Discoverer
 from harbour.views import AuthenticateUserClassic, AuthenticateUserTwoPointOh, \
     AllowedMirrors, ClassicLibraries, ClassicUser, TwoPointOhLibraries, \
-    ExportTwoPointOhLibraries, ClassicMyADS
+    ExportTwoPointOhLibraries, ClassicMyADS, Statistics, \
+    TwoPointOhLibrariesBatch, ExportBibTeX
+from harbour.client import Client, S3Client, SingleFlight
+from harbour.user_index import UserIndex, build_user_index, index_lock
+from harbour.cache import LRUCache, DiskCache, StaleWhileRevalidateCache
+from harbour.compression import compress_response
+from harbour.representations import make_json_representation
+from harbour.storage import create_storage, NotFound, NotModified
+from harbour.mirrors import MirrorHealth
+from harbour.utils import binary_key
 
-from io import BytesIO
 from adsmutils import ADSFlask
 
+# Used to report the time between import and the first response
+IMPORT_TIME = time.time()
+
+# End points that need the ADS 2.0 users to be loaded
+TWO_POINT_OH_ENDPOINTS = [
+    'twopointohlibraries',
+    'twopointohlibrariesbatch',
+    'exporttwopointohlibraries',
+    'exportbibtex'
+]
+
 
 def create_app(**config):
     """
@@ -31,11 +53,80 @@ def create_app(**config):
         app = ADSFlask(__name__, static_folder=None)
     app.url_map.strict_slashes = False
 
-    load_s3(app)
+    app.users_ready = threading.Event()
+    app.users_lock = threading.Lock()
+    app.users_loader = None
+    app.first_response_time = None
+
+    # The requests session of ADSFlask, with circuit breakers for the mirrors
+    app.client = Client(app.config, session=app.client)
+    app.s3 = S3Client(app.config)
+
+    app.object_cache = None
+    if app.config.get('ADS_TWO_POINT_OH_DISK_CACHE_DIR'):
+        app.object_cache = DiskCache(
+            app.config['ADS_TWO_POINT_OH_DISK_CACHE_DIR'],
+            max_size=app.config['ADS_TWO_POINT_OH_DISK_CACHE_SIZE'],
+            compression=app.config.get('ADS_TWO_POINT_OH_DISK_CACHE_COMPRESSION')
+        )
+
+    app.storage = create_storage(
+        app.config, s3=app.s3, disk_cache=app.object_cache
+    )
+
+    app.library_cache = LRUCache(
+        max_size=app.config.get('ADS_TWO_POINT_OH_LIBRARY_CACHE_SIZE', 0),
+        ttl=app.config.get('ADS_TWO_POINT_OH_LIBRARY_CACHE_TTL')
+    )
+
+    app.export_url_cache = LRUCache(
+        max_size=app.config.get('HARBOUR_EXPORT_URL_CACHE_SIZE', 0),
+        ttl=app.config['HARBOUR_EXPORT_URL_EXPIRES'] *
+        (1 - app.config['HARBOUR_EXPORT_URL_MIN_REMAINING'])
+    )
+
+    app.export_exists_cache = LRUCache(
+        max_size=app.config.get('HARBOUR_EXPORT_EXISTS_CACHE_SIZE', 0),
+        ttl=app.config.get('HARBOUR_EXPORT_EXISTS_TTL')
+    )
+
+    app.single_flight = SingleFlight()
+
+    app.classic_library_cache = StaleWhileRevalidateCache(
+        max_size=app.config.get('ADS_CLASSIC_LIBRARY_CACHE_SIZE', 0),
+        ttl=app.config.get('ADS_CLASSIC_LIBRARY_CACHE_TTL', 0),
+        max_age=app.config.get('ADS_CLASSIC_LIBRARY_CACHE_MAX_AGE')
+    )
+
+    app.compression_cache = LRUCache(
+        max_size=app.config.get('HARBOUR_COMPRESSION_CACHE_SIZE', 0)
+    )
+
+    app.mirror_health = MirrorHealth(
+        app.config.get('ADS_CLASSIC_MIRROR_LIST', []),
+        window=app.config.get('HARBOUR_MIRROR_PROBE_WINDOW', 60),
+        routing=app.config.get('ADS_CLASSIC_MYADS_MIRRORS', [])
+    )
+    app.mirror_prober = None
+    app.mirror_prober_lock = threading.Lock()
+
+    load_mode = app.config.get('ADS_TWO_POINT_OH_USERS_LOAD', 'sync')
+    if load_mode == 'sync':
+        load_s3(app)
+    elif load_mode == 'background':
+        start_users_loader(app)
+    start_users_refresher(app)
+
+    app.before_request(lambda: prepare_users(app))
+    app.after_request(lambda response: report_first_response(app, response))
+    app.after_request(lambda response: compress_response(app, response))
 
     # Register extensions
     watchman = Watchman(app, version=dict(scopes=['']))
     api = Api(app)
+    api.representation('application/json')(
+        make_json_representation(app.config.get('HARBOUR_JSON_ENCODER', 'auto'))
+    )
     Discoverer(app)
 
     # Add the end resource end points
@@ -53,12 +144,24 @@ def create_app(**config):
         methods=['GET']
     )
 
+    api.add_resource(
+        TwoPointOhLibrariesBatch,
+        '/libraries/twopointoh/batch',
+        methods=['POST']
+    )
+
     api.add_resource(
         ExportTwoPointOhLibraries,
         '/export/twopointoh/<export>',
         methods=['GET']
     )
 
+    api.add_resource(
+        ExportBibTeX,
+        '/export/bibtex/<source>',
+        methods=['GET']
+    )
+
     api.add_resource(
         ClassicMyADS,
         '/myads/classic/<int:uid>',
@@ -67,6 +170,7 @@ def create_app(**config):
 
     api.add_resource(ClassicUser, '/user', methods=['GET'])
     api.add_resource(AllowedMirrors, '/mirrors', methods=['GET'])
+    api.add_resource(Statistics, '/stats', methods=['GET'])
 
     return app
 
@@ -75,25 +179,267 @@ def load_s3(app):
     """
     Loads relevant data from S3 that is needed
 
+    If ADS_TWO_POINT_OH_USERS_INDEX is set, the users are kept in a
+    memory-mapped index at that path rather than a dictionary per worker. The
+    index is only rebuilt when users.json has changed since it was written.
+    With ADS_TWO_POINT_OH_BINARY_FORMAT, an index converted ahead of time is
+    downloaded instead, when there is one and it was converted from the
+    current users.json.
+
+    Once loaded, the ETag of users.json is kept, and later calls make a
+    conditional GET, or a HEAD request when there is an index, so that the
+    users are only reloaded when they changed.
+    The new users are swapped in with a single assignment, so requests that
+    are already using the old ones are unaffected.
+
     :param app: flask.Flask application instance
+
+    :return: True if the users were (re)loaded
     """
     try:
-        s3_resource = boto3.resource('s3')
-        bucket = s3_resource.Object(
-            app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
-            'users.json'
-        )
-        body = bucket.get()['Body']
+        index_path = app.config.get('ADS_TWO_POINT_OH_USERS_INDEX')
+        etag = app.config.get('ADS_TWO_POINT_OH_USERS_ETAG')
 
-        user_data = BytesIO()
-        for chunk in iter(lambda: body.read(1024), b''):
-            user_data.write(chunk)
+        if index_path:
+            users = load_users_into_index(app, index_path, etag)
+            if users is None:
+                app.logger.debug('Users database has not changed')
+                return False
+            etag = users.etag
+        else:
+            try:
+                user_data, etag = app.storage.get(
+                    'users.json',
+                    if_none_match=etag
+                )
+            except NotModified:
+                app.logger.debug('Users database has not changed')
+                return False
+
+            users = json.loads(user_data)
 
-        users = json.loads(user_data.getvalue())
         app.config['ADS_TWO_POINT_OH_USERS'] = users
-        app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = True
+        app.config['ADS_TWO_POINT_OH_USERS_ETAG'] = etag
+        app.users_ready.set()
+        return True
     except Exception as error:
         app.logger.warning('Could not load users database: {}'.format(error))
+        return False
+
+
+def load_users_into_index(app, index_path, etag=None):
+    """
+    Map the index of the current users.json, building it first unless
+    another worker of the host already did. Workers build it one at a time,
+    under a file lock, and check again once they hold it, so that users.json
+    is downloaded and parsed once per host. With
+    ADS_TWO_POINT_OH_BINARY_FORMAT, the index converted ahead of time is
+    downloaded instead, if it was converted from the current users.json.
+
+    :param app: flask.Flask application instance
+    :param index_path: path where the index is kept
+    :param etag: ETag of the users.json already loaded, if any
+
+    :return: UserIndex, or None if users.json has not changed since etag
+    """
+    current_etag = app.storage.head('users.json')
+    if current_etag == etag:
+        return None
+
+    users = UserIndex.open_if_current(index_path, current_etag)
+    if users is not None:
+        return users
+
+    with index_lock(index_path):
+        users = UserIndex.open_if_current(index_path, current_etag)
+        if users is not None:
+            return users
+
+        if app.config.get('ADS_TWO_POINT_OH_BINARY_FORMAT'):
+            users = load_users_index(app, index_path, current_etag)
+            if users is not None:
+                return users
+
+        user_data, etag = app.storage.get('users.json')
+        build_user_index(json.loads(user_data), index_path, etag=etag)
+        return UserIndex(index_path)
+
+
+def load_users_index(app, index_path, etag):
+    """
+    Download the users index converted from users.json by the convert
+    command of manage.py, and map it. This skips parsing users.json.
+
+    :param app: flask.Flask application instance
+    :param index_path: path where the index is kept
+    :param etag: ETag of the current users.json
+
+    :return: UserIndex, or None if there is no index converted from the
+        current users.json
+    """
+    try:
+        index_data, _ = app.storage.get(binary_key('users.json'))
+    except NotFound:
+        return None
+
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(index_path)), suffix='.tmp'
+    )
+    try:
+        with os.fdopen(descriptor, 'wb') as index_file:
+            index_file.write(index_data)
+
+        users = UserIndex.open_if_current(temporary_path, etag)
+        if users is None:
+            app.logger.warning(
+                'Converted users index is out of date, reading users.json'
+            )
+            os.remove(temporary_path)
+            return None
+        users.close()
+
+        os.rename(temporary_path, index_path)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    return UserIndex(index_path)
+
+
+class UsersRefresher(threading.Thread):
+    """
+    Background thread that polls users.json on S3 every interval seconds, and
+    reloads the users when it changed. This also recovers from a failed load
+    when the application was created.
+    """
+    def __init__(self, app, interval):
+        """
+        Constructor
+        :param app: flask.Flask application instance
+        :param interval: seconds between two polls
+        """
+        super(UsersRefresher, self).__init__(name='users-refresher')
+        self.daemon = True
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if load_s3(self.app):
+                self.app.logger.info('Reloaded users database from S3')
+
+    def stop(self):
+        """
+        Stop polling
+        """
+        self.stopped.set()
+
+
+def start_users_loader(app):
+    """
+    Load the users in a background thread, so that the worker can serve
+    requests straight away. This is done at most once per process; a failed
+    load is retried by the users refresher, or by the next request that needs
+    the users, see prepare_users.
+
+    :param app: flask.Flask application instance
+    """
+    if app.users_ready.is_set():
+        return
+
+    with app.users_lock:
+        loader = app.users_loader
+        if loader is not None and loader.pid == os.getpid():
+            return
+
+        loader = threading.Thread(
+            target=load_s3, args=(app,), name='users-loader'
+        )
+        loader.daemon = True
+        loader.pid = os.getpid()
+        app.users_loader = loader
+        loader.start()
+
+
+def ensure_users_loaded(app):
+    """
+    Load the users in the current request, unless they are already loaded.
+    Concurrent requests wait for the first one to finish loading.
+
+    :param app: flask.Flask application instance
+    """
+    if app.users_ready.is_set():
+        return
+
+    with app.users_lock:
+        if not app.users_ready.is_set():
+            load_s3(app)
+
+
+def prepare_users(app):
+    """
+    Called before every request, to make sure the users are (being) loaded in
+    this process according to ADS_TWO_POINT_OH_USERS_LOAD:
+      - sync: loaded when the application is created
+      - background: loaded in a background thread, or by the next request
+        that needs them if that failed
+      - lazy: loaded by the first request that needs them
+
+    :param app: flask.Flask application instance
+    """
+    start_users_refresher(app)
+
+    load_mode = app.config.get('ADS_TWO_POINT_OH_USERS_LOAD', 'sync')
+    if load_mode == 'background':
+        start_users_loader(app)
+        # If the background load failed, load them lazily instead
+        if not app.users_ready.is_set() and \
+                not app.users_loader.is_alive() and \
+                request.endpoint in TWO_POINT_OH_ENDPOINTS:
+            ensure_users_loaded(app)
+    elif load_mode == 'lazy' and request.endpoint in TWO_POINT_OH_ENDPOINTS:
+        ensure_users_loaded(app)
+
+
+def report_first_response(app, response):
+    """
+    Log the time between the import of the application and its first
+    response, to keep track of the start up time of the workers
+
+    :param app: flask.Flask application instance
+    :param response: flask.Response
+
+    :return: response
+    """
+    if app.first_response_time is None:
+        app.first_response_time = time.time() - IMPORT_TIME
+        app.logger.info(
+            'First response served {:.3f}s after import'
+            .format(app.first_response_time)
+        )
+    return response
+
+
+def start_users_refresher(app):
+    """
+    Start the users refresher of this process, if it is enabled and not
+    already running. Threads do not survive a fork, so this is also called
+    before requests to start one in every (pre-forked) worker.
+
+    :param app: flask.Flask application instance
+    """
+    interval = app.config.get('ADS_TWO_POINT_OH_USERS_REFRESH_INTERVAL')
+    if not interval:
+        return
+
+    refresher = getattr(app, 'users_refresher', None)
+    if refresher is not None and refresher.is_alive():
+        return
+
+    app.users_refresher = UsersRefresher(app, interval)
+    app.users_refresher.start()
 
 
 if __name__ == '__main__':
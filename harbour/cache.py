@@ -0,0 +1,397 @@
+# encoding: utf-8
+"""
+In-process and on-disk caches
+"""
+
+import os
+import time
+import zlib
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache, bounded by the total size of the
+    values it holds rather than by the number of entries. Entries older than
+    the time to live (if given) are treated as missing.
+    """
+    def __init__(self, max_size, ttl=None, timer=time.time):
+        """
+        Constructor
+        :param max_size: maximum total size of the values, in bytes
+        :param ttl: time to live of an entry in seconds, None for no expiry
+        :param timer: function returning the current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get the value stored for key, and mark it as recently used
+        :param key: key of the entry
+        :param default: value returned if there is no (fresh) entry
+
+        :return: value of the entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and self.timer() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size):
+        """
+        Store value for key, evicting the least recently used entries until
+        the cache fits within its maximum size. Values larger than the cache
+        are not stored.
+
+        :param key: key of the entry
+        :param value: value to store
+        :param size: size of the value in bytes
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            if size > self.max_size:
+                return
+
+            while self.size + size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+            self._entries[key] = (value, size, self.timer())
+            self.size += size
+
+    def delete(self, key):
+        """
+        Remove the entry for key, if there is one
+        :param key: key of the entry
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove all the entries
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        value, size, created = self._entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        """
+        Usage counters of the cache
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and \
+                (self.ttl is None or self.timer() - entry[2] <= self.ttl)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(object):
+    """
+    Cache of S3 objects in a local directory, shared by all the workers of a
+    host and kept across restarts. Objects are content-addressed by bucket,
+    key and ETag, written with an atomic rename, and the least recently used
+    files are removed once the directory grows beyond its maximum size.
+    """
+    suffixes = {None: '', 'zlib': '.zlib', 'zstd': '.zst'}
+
+    def __init__(self, directory, max_size, compression=None):
+        """
+        Constructor
+        :param directory: directory that holds the cached objects
+        :param max_size: maximum total size of the files, in bytes
+        :param compression: None, 'zlib' or 'zstd' (needs zstandard)
+        """
+        if compression not in self.suffixes:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+
+        self.directory = directory
+        self.max_size = max_size
+        self.compression = compression
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, bucket, key, etag):
+        digest = hashlib.sha256(
+            '{}/{}/{}'.format(bucket, key, etag).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(
+            self.directory, digest + self.suffixes[self.compression]
+        )
+
+    def _compress(self, data):
+        if self.compression == 'zlib':
+            return zlib.compress(data)
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    def _decompress(self, data):
+        if self.compression == 'zlib':
+            return zlib.decompress(data)
+        if self.compression == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    def get(self, bucket, key, etag):
+        """
+        Get the content of an object, and mark it as recently used
+        :param bucket: S3 bucket of the object
+        :param key: S3 key of the object
+        :param etag: ETag of the object
+
+        :return: bytes or None
+        """
+        path = self._path(bucket, key, etag)
+        try:
+            with open(path, 'rb') as cached_file:
+                data = self._decompress(cached_file.read())
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        except Exception:
+            # Corrupt file, fetch the object again
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def set(self, bucket, key, etag, data):
+        """
+        Store the content of an object
+        :param bucket: S3 bucket of the object
+        :param key: S3 key of the object
+        :param etag: ETag of the object
+        :param data: content of the object
+        :type data: bytes
+        """
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=self.directory, suffix='.tmp'
+        )
+        try:
+            with os.fdopen(descriptor, 'wb') as temporary_file:
+                temporary_file.write(self._compress(data))
+            os.rename(temporary_path, self._path(bucket, key, etag))
+        except Exception:
+            self._remove(temporary_path)
+            raise
+
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        Remove the least recently used files until the directory fits within
+        its maximum size
+        """
+        files = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        for mtime, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            self._remove(path)
+            self.evictions += 1
+            total_size -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        """
+        Usage counters of the cache in this process
+        :return: dict
+        """
+        return {
+            'directory': self.directory,
+            'max_size': self.max_size,
+            'compression': self.compression,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class StaleWhileRevalidateCache(object):
+    """
+    Cache of values fetched from a slow or unreliable upstream. A value is
+    fresh for ttl seconds. After that, it is still returned straight away
+    while one background thread fetches it again; if that fetch fails, the
+    last good value is kept. Values are dropped after max_age seconds, or
+    when the underlying LRUCache is full.
+    """
+    def __init__(self, max_size, ttl, max_age=None, timer=time.time):
+        """
+        Constructor
+        :param max_size: maximum total size of the values, in bytes
+        :param ttl: seconds during which a value is fresh
+        :param max_age: seconds after which a stale value is no longer
+            returned, None to keep it until it is evicted
+        :param timer: function returning the current time in seconds
+        """
+        self.ttl = ttl
+        self.timer = timer
+        self.cache = LRUCache(max_size=max_size, ttl=max_age, timer=timer)
+
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+        # Threads of the refreshes in progress, by key
+        self.refreshing = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch, size=len):
+        """
+        Get the value of key, fetching it if there is no fresh value
+        :param key: key of the entry
+        :param fetch: function without arguments that returns the value, or
+            None if the upstream did not return one; it is called in another
+            thread to refresh stale values, so it must not rely on the
+            context of the caller
+        :param size: function returning the size in bytes of a value
+
+        :return: value, or None if there is no value and fetch returned None
+        :raises: the exceptions of fetch, if there is no value
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return self._fetch(key, fetch, size)
+
+        fetched, value = entry
+        if self.timer() - fetched > self.ttl:
+            with self._lock:
+                self.stale_hits += 1
+                if key not in self.refreshing:
+                    thread = threading.Thread(
+                        target=self._refresh,
+                        args=(key, fetch, size),
+                        name='stale-refresh'
+                    )
+                    thread.daemon = True
+                    self.refreshing[key] = thread
+                    thread.start()
+
+        return value
+
+    def _fetch(self, key, fetch, size):
+        value = fetch()
+        if value is not None:
+            self.cache.set(key, (self.timer(), value), size=size(value))
+        return value
+
+    def _refresh(self, key, fetch, size):
+        """
+        Fetch a stale value again, keeping the last good one on failure
+        """
+        try:
+            if self._fetch(key, fetch, size) is None:
+                raise ValueError('No value returned')
+            with self._lock:
+                self.refreshes += 1
+        except Exception:
+            with self._lock:
+                self.refresh_failures += 1
+        finally:
+            with self._lock:
+                self.refreshing.pop(key, None)
+
+    def delete(self, key):
+        """
+        Remove the value of key, if there is one
+        :param key: key of the entry
+        """
+        self.cache.delete(key)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def stats(self):
+        """
+        Usage counters of the cache
+        :return: dict
+        """
+        stats = self.cache.stats()
+        with self._lock:
+            stats.update({
+                'fresh_ttl': self.ttl,
+                'stale_hits': self.stale_hits,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+                'refreshing': len(self.refreshing)
+            })
+        return stats
@@ -1,37 +1,577 @@
+import os
+import time
+import random
+import boto3
 import requests
-from flask import current_app, request
+import threading
+
+from collections import deque
+
+from botocore.config import Config as BotoConfig
+from flask import current_app, request, has_request_context
+from urllib.parse import urlparse
 
 requests.packages.urllib3.disable_warnings()
 
 client = lambda: Client(current_app.config)
 
 
+# Settings of a policy that HARBOUR_CLIENT_POLICIES does not give
+DEFAULT_POLICY = dict(
+    connect_timeout=5,
+    read_timeout=30,
+    retries=0,
+    backoff=0.5,
+    max_backoff=5,
+    deadline=None
+)
+
+# Only requests with these methods are retried
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Responses with these statuses are retried
+RETRY_STATUSES = (502, 503, 504)
+
+
+class Attempts(object):
+    """
+    Attempts of a request under a policy: the timeouts of each attempt, and
+    whether a failed attempt is retried, and after how long. The timeouts of
+    an attempt are cut down so that it cannot start after the deadline, but
+    a read timeout applies to each read rather than the whole response.
+    """
+    def __init__(self, policy, method, timeout=None, backoff=None):
+        """
+        Constructor
+        :param policy: settings of the policy, see Client.policy
+        :param method: HTTP method; only idempotent requests are retried
+        :param timeout: timeout given by the caller, which replaces those of
+            the policy
+        :param backoff: function of the policy and the number of the failed
+            attempt, returning the delay before the next one
+        """
+        self.policy = policy
+        self.retries = policy['retries'] if method in IDEMPOTENT_METHODS else 0
+        self.deadline = time.time() + policy['deadline'] \
+            if policy['deadline'] else None
+        self.given_timeout = timeout
+        self.backoff = backoff
+        self.attempt = 0
+
+    def timeout(self):
+        """
+        Timeouts of the next attempt
+        :return: timeout given by the caller, or tuple of the connect and read
+            timeouts
+        """
+        if self.given_timeout is not None:
+            return self.given_timeout
+
+        connect, read = self.policy['connect_timeout'], self.policy['read_timeout']
+        if self.deadline is None:
+            return connect, read
+
+        remaining = max(self.deadline - time.time(), 0.001)
+        return min(connect, remaining), min(read, remaining)
+
+    def retry_delay(self):
+        """
+        Called when an attempt failed
+        :return: seconds to wait before the next attempt, or None if there
+            is no retry left before the deadline
+        """
+        if self.attempt >= self.retries:
+            return None
+
+        delay = self.backoff(self.policy, self.attempt)
+        if self.deadline is not None and time.time() + delay >= self.deadline:
+            return None
+
+        self.attempt += 1
+        return delay
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    The request was not made, because the circuit breaker of its host is open
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of a host. It opens after a number of failures within a
+    window of time, and requests then fail fast. After reset_timeout
+    seconds, it is half-open: a single request is let through as a probe,
+    and closes the breaker if it succeeds or opens it again if it fails. A
+    probe that ends without an outcome gives its place to the next request.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures, window, reset_timeout, timer=time.time):
+        """
+        Constructor
+        :param failures: number of failures that open the breaker
+        :param window: seconds during which failures are counted
+        :param reset_timeout: seconds before an open breaker lets a probe
+            through
+        :param timer: function returning the current time in seconds
+        """
+        self.failures = failures
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+
+        self.state = self.CLOSED
+        self.opened = None
+        self.rejected = 0
+
+        # Whether the half-open probe is in flight
+        self._probing = False
+
+        # Times of the recent failures
+        self._failures = deque()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a request can be made; if it is, success or failure must be
+        called with its outcome, or release if it has none
+        :return: bool
+        """
+        with self._lock:
+            if self.state == self.OPEN \
+                    and self.timer() - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            if self.state == self.CLOSED:
+                return True
+
+            self.rejected += 1
+            return False
+
+    def success(self):
+        """
+        Record a successful request
+        """
+        with self._lock:
+            self.state = self.CLOSED
+            self._probing = False
+            self._failures.clear()
+
+    def failure(self):
+        """
+        Record a failed request
+        """
+        with self._lock:
+            now = self.timer()
+            self._failures.append(now)
+            while self._failures and now - self._failures[0] > self.window:
+                self._failures.popleft()
+
+            if self.state == self.HALF_OPEN \
+                    or len(self._failures) >= self.failures:
+                self.state = self.OPEN
+                self.opened = now
+            self._probing = False
+
+    def release(self):
+        """
+        Record a request that ended without an outcome, e.g., interrupted by
+        GeneratorExit or a gevent timeout, so that a half-open breaker lets
+        another probe through
+        """
+        with self._lock:
+            self._probing = False
+
+    def stats(self):
+        """
+        State of the breaker
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'state': self.state,
+                'recent_failures': len(self._failures),
+                'opened': self.opened,
+                'rejected': self.rejected
+            }
+
+
 class Client(object):
     """
     The Client class is a thin wrapper around requests; Use it as a centralized
     place to set application specific parameters, such as the oauth2
-    authorization header
+    authorization header.
+
+    Requests to the ADS Classic mirrors (ADS_CLASSIC_MIRROR_LIST and
+    ADS_CLASSIC_MYADS_MIRRORS) go through a circuit breaker per mirror, see
+    CircuitBreaker, and are not given the authorization header of the API.
+
+    Each call can name a policy, e.g., client.get(url, policy='libraries'),
+    with its timeouts, retries and deadline, see HARBOUR_CLIENT_POLICIES.
     """
-    def __init__(self, config):
+    def __init__(self, config, session=None):
         """
         Constructor
         :param client_config: configuration dictionary of the client
+        :param session: requests.Session to use, a new one by default
         """
 
-        self.session = requests.Session()
+        self.config = config
+        self.session = session if session is not None else requests.Session()
+
+        self.mirrors = set(config.get('ADS_CLASSIC_MIRROR_LIST', [])) | \
+            set(config.get('ADS_CLASSIC_MYADS_MIRRORS', []))
+        self.breaker_options = dict(
+            failures=config.get('HARBOUR_CIRCUIT_BREAKER_FAILURES', 0),
+            window=config.get('HARBOUR_CIRCUIT_BREAKER_WINDOW', 60),
+            reset_timeout=config.get('HARBOUR_CIRCUIT_BREAKER_RESET_TIMEOUT', 30)
+        )
+        self.breakers = {}
+        self._lock = threading.Lock()
+
+        self.policies = config.get('HARBOUR_CLIENT_POLICIES', {})
+        self.sleep = time.sleep
 
     def _sanitize(self, args, kwargs):
         headers = kwargs.get('headers', {})
         if 'Authorization' not in headers:
-            headers['Authorization'] = current_app.config.get('SERVICE_TOKEN', None) or request.headers.get('X-Forwarded-Authorization', request.headers.get('Authorization', None))
+            headers.update(self.context_headers())
         kwargs['headers'] = headers
         return (args, kwargs)
 
-    def get(self, *args, **kwargs):
-        args, kwargs = self._sanitize(args, kwargs)
-        return self.session.get(*args, **kwargs)
-    
-    def post(self, *args, **kwargs):
-        args, kwargs = self._sanitize(args, kwargs)
-        return self.session.post(*args, **kwargs)
+    def context_headers(self):
+        """
+        Headers that are added to the requests: the service token, or else
+        the authorization of the current request. Requests made outside of a
+        request context, e.g., in a background thread, only get the service
+        token, if there is one.
+
+        :return: dict
+        """
+        token = self.config.get('SERVICE_TOKEN', None)
+        if token or not has_request_context():
+            return {'Authorization': token}
+        return {
+            'Authorization': request.headers.get('X-Forwarded-Authorization', request.headers.get('Authorization', None))
+        }
+
+    def breaker(self, host):
+        """
+        Circuit breaker of a host
+        :param host: host name
+        :return: CircuitBreaker, or None if the host is not an ADS Classic
+            mirror or the breakers are disabled
+        """
+        if host not in self.mirrors or not self.breaker_options['failures']:
+            return None
+
+        with self._lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(**self.breaker_options)
+            return self.breakers[host]
+
+    def policy(self, name):
+        """
+        Timeouts and retries of a named policy, see HARBOUR_CLIENT_POLICIES.
+        Unknown policies, and the settings a policy does not give, fall back
+        to the default policy.
+
+        :param name: name of the policy, e.g., libraries
+        :return: dict
+        """
+        policy = dict(DEFAULT_POLICY)
+        policy.update(self.policies.get('default', {}))
+        policy.update(self.policies.get(name, {}))
+        return policy
+
+    def backoff(self, policy, attempt):
+        """
+        Delay before a retry: exponential backoff with full jitter
+        :param policy: policy of the request
+        :param attempt: number of the attempt that failed, from 0
+        :return: seconds
+        """
+        return random.uniform(
+            0, min(policy['max_backoff'], policy['backoff'] * 2 ** attempt)
+        )
+
+    def _send(self, host, method, url, **kwargs):
+        """
+        Make a single request, through the circuit breaker of the host
+        """
+        breaker = self.breaker(host)
+        if breaker is None:
+            return self.session.request(method, url, **kwargs)
+
+        if not breaker.allow():
+            raise CircuitOpenError(
+                'Circuit breaker of {} is open'.format(host)
+            )
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            breaker.failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
+
+    def _request(self, method, url, policy=None, **kwargs):
+        """
+        Make a request with the timeouts of a policy. Idempotent requests
+        that fail with a connection error, a timeout or a retryable status
+        are retried after a backoff, within the retries and the deadline of
+        the policy, see Attempts.
+
+        :param method: HTTP method
+        :param url: URL of the request
+        :param policy: name of the policy, see HARBOUR_CLIENT_POLICIES
+        :param kwargs: arguments of requests.Session.request; a timeout
+            given here replaces the timeouts of the policy
+
+        :return: requests.Response
+        """
+        host, kwargs = self._headers(url, kwargs)
+        attempts = Attempts(
+            self.policy(policy), method,
+            timeout=kwargs.pop('timeout', None),
+            backoff=self.backoff
+        )
+        while True:
+            kwargs['timeout'] = attempts.timeout()
+            try:
+                response = self._send(host, method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                delay = attempts.retry_delay()
+                if delay is None:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                delay = attempts.retry_delay()
+                if delay is None:
+                    return response
+                # Release the connection of a streamed response
+                response.close()
+
+            self.sleep(delay)
+
+    def _headers(self, url, kwargs):
+        """
+        Headers of a request: the ADS Classic mirrors are not given the
+        authorization header of the API, the other hosts are
+
+        :return: tuple of the host and the arguments of the request
+        """
+        host = urlparse(url).hostname
+        if host in self.mirrors:
+            # None removes the default header of the session, if any
+            kwargs['headers'] = dict(kwargs.get('headers') or {})
+            kwargs['headers'].setdefault('Authorization', None)
+        else:
+            args, kwargs = self._sanitize((), kwargs)
+        return host, kwargs
+
+    def get(self, url, **kwargs):
+        return self._request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._request('POST', url, **kwargs)
+
+    def stats(self):
+        """
+        State of the circuit breaker of each mirror
+        :return: dict
+        """
+        with self._lock:
+            breakers = dict(self.breakers)
+        return {host: breaker.stats() for host, breaker in breakers.items()}
+
+
+class S3Client(object):
+    """
+    The S3Client class is a per-process boto3 S3 client, with a connection pool,
+    timeouts and retries set from the application configuration. boto3
+    clients cannot be shared across a fork, so a new one is created the first
+    time it is used in a new (e.g., gunicorn worker) process. Any client
+    method can be called on it, e.g., get_object.
+    """
+    def __init__(self, config):
+        """
+        Constructor
+        :param config: configuration dictionary of the application
+        """
+        self.config = config
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _create(self):
+        options = dict(
+            max_pool_connections=self.config.get('HARBOUR_S3_MAX_POOL_CONNECTIONS', 10),
+            connect_timeout=self.config.get('HARBOUR_S3_CONNECT_TIMEOUT', 60),
+            read_timeout=self.config.get('HARBOUR_S3_READ_TIMEOUT', 60),
+            retries={
+                'mode': self.config.get('HARBOUR_S3_RETRY_MODE', 'legacy'),
+                'max_attempts': self.config.get('HARBOUR_S3_MAX_ATTEMPTS', 5)
+            }
+        )
+        # Only known to botocore >= 1.27
+        if self.config.get('HARBOUR_S3_TCP_KEEPALIVE'):
+            options['tcp_keepalive'] = True
 
+        session = boto3.session.Session()
+        return session.client('s3', config=BotoConfig(**options))
+
+    @property
+    def client(self):
+        """
+        boto3 S3 client of the current process
+        """
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._client = self._create()
+                    self._pid = os.getpid()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls: while a call for a key is in
+    flight, other threads calling with the same key wait for it and share
+    its result, or its exception, instead of making their own call.
+
+    Calls that outlive a function call, e.g., a streamed response, are led
+    with join and land instead of do.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+
+        # Calls in flight, by key, see join
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """
+        Join the call for key in flight, or start one if there is none. The
+        thread that starts a call leads it, and must land it, the others
+        wait for it.
+
+        :param key: hashable key of the call, e.g., the URL requested
+
+        :return: tuple of whether the caller leads the call, and the flight
+            to pass to wait or land
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                # Event set when the call landed, result, exception, and
+                # whether the call had an outcome
+                flight = self._flights[key] = [
+                    threading.Event(), None, None, False
+                ]
+                self.calls += 1
+                return True, flight
+
+            self.shared += 1
+            return False, flight
+
+    @staticmethod
+    def wait(flight):
+        """
+        Wait for a call led by another thread to land
+
+        :param flight: flight returned by join
+
+        :return: tuple of whether the call had an outcome, and its result
+        :raises: the exception raised by the call
+        """
+        flight[0].wait()
+        if flight[2] is not None:
+            raise flight[2]
+        return flight[3], flight[1]
+
+    def land(self, key, flight, result=None, error=None, outcome=True):
+        """
+        End a call led by the caller, and wake the threads that wait for it.
+        Landing a call that already landed has no effect.
+
+        :param key: key of the call
+        :param flight: flight returned by join
+        :param result: result of the call
+        :param error: exception raised by the call, if any
+        :param outcome: False if the call was interrupted without a result or
+            an exception, e.g., by GeneratorExit; the threads that waited for
+            it then make the call again
+        """
+        with self._lock:
+            if self._flights.get(key) is not flight:
+                return
+            del self._flights[key]
+
+        flight[1], flight[2], flight[3] = result, error, outcome
+        flight[0].set()
+
+    def do(self, key, function):
+        """
+        Call function, unless a call for key is already in flight. If the
+        call in flight is interrupted without an outcome, e.g., by
+        GeneratorExit, the threads that waited for it make the call again.
+
+        :param key: hashable key of the call, e.g., the URL requested
+        :param function: function without arguments
+
+        :return: result of function
+        :raises: the exception raised by function
+        """
+        while True:
+            leader, flight = self.join(key)
+            if leader:
+                break
+
+            landed, result = self.wait(flight)
+            if landed:
+                return result
+
+        try:
+            result = function()
+        except Exception as error:
+            self.land(key, flight, error=error)
+            raise
+        except BaseException:
+            self.land(key, flight, outcome=False)
+            raise
+
+        self.land(key, flight, result=result)
+        return result
+
+    def stats(self):
+        """
+        Usage counters
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'shared': self.shared,
+                'in_flight': len(self._flights)
+            }
@@ -0,0 +1,124 @@
+# encoding: utf-8
+"""
+Compression of the library responses, negotiated with Accept-Encoding
+"""
+
+import gzip
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# End points whose responses are compressed
+COMPRESSED_ENDPOINTS = [
+    'classiclibraries',
+    'twopointohlibraries',
+    'classicmyads'
+]
+
+
+def available_encodings(encodings):
+    """
+    Encodings that can be used, in order of preference
+    :param encodings: encodings in order of preference, from gzip and br
+    :return: list of str
+    """
+    return [
+        encoding for encoding in encodings
+        if encoding == 'gzip' or (encoding == 'br' and brotli is not None)
+    ]
+
+
+def compress(data, encoding, config):
+    """
+    Compress data with the given encoding
+    :param data: content of the response
+    :type data: bytes
+    :param encoding: gzip or br
+    :param config: application config with the compression levels
+
+    :return: bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(
+            data, quality=config.get('HARBOUR_COMPRESSION_BROTLI_QUALITY', 5)
+        )
+    return gzip.compress(
+        data, compresslevel=config.get('HARBOUR_COMPRESSION_GZIP_LEVEL', 6)
+    )
+
+
+def compress_response(app, response):
+    """
+    Compress the response of the library and myADS end points, if the client
+    accepts it and it is larger than HARBOUR_COMPRESSION_MIN_SIZE. Responses
+    with an ETag are the same for every request with that ETag, so their
+    compressed content is kept in app.compression_cache and not compressed
+    again.
+
+    :param app: flask.Flask application instance
+    :param response: flask.Response
+
+    :return: flask.Response
+    """
+    if request.endpoint not in COMPRESSED_ENDPOINTS:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.status_code == 304:
+        return weaken_not_modified(response)
+
+    if response.status_code != 200 \
+            or response.direct_passthrough \
+            or response.is_streamed \
+            or 'Content-Encoding' in response.headers:
+        return response
+
+    encodings = available_encodings(
+        app.config.get('HARBOUR_COMPRESSION_ENCODINGS', ['gzip'])
+    )
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < app.config.get('HARBOUR_COMPRESSION_MIN_SIZE', 0):
+        return response
+
+    # Only a strong ETag identifies the exact content that is compressed
+    etag, weak = response.get_etag()
+    key = (request.endpoint, etag, encoding) if etag and not weak else None
+
+    compressed = app.compression_cache.get(key) if key else None
+    if compressed is None:
+        compressed = compress(data, encoding, app.config)
+        if key:
+            app.compression_cache.set(key, compressed, len(compressed))
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # The compressed content is another representation of the same libraries
+    if etag:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+def weaken_not_modified(response):
+    """
+    Compressed responses carry the weak form of the ETag of the content, so
+    a client whose copy is compressed sends the weak form back. The 304 then
+    answers with the weak form too, as the client has it.
+
+    :param response: flask.Response with status 304
+    :return: flask.Response
+    """
+    etag, weak = response.get_etag()
+    if etag and not weak and not request.if_none_match.contains(etag) \
+            and request.if_none_match.is_weak(etag):
+        response.set_etag(etag, weak=True)
+    return response
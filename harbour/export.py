@@ -0,0 +1,188 @@
+# encoding: utf-8
+"""
+Generation of the exports of the libraries:
+  - the archives of the ADS 2.0 libraries, a .zip with one .bib file per
+    library, that Zotero, Mendeley or Papers can import
+  - BibTeX from the export service, requested in batches
+Both are generated as a stream, so that they never have to be held in memory.
+"""
+
+import re
+import zipfile
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ADS_ABSTRACT_URL = 'http://adsabs.harvard.edu/abs/{}'
+
+# Ends a BibTeX export that failed after its first batch had been sent
+BIBTEX_INCOMPLETE = (
+    b'\n@COMMENT{ERROR: the export is incomplete, the export service failed. '
+    b'Please try again.}\n'
+)
+
+
+class ZipStream(object):
+    """
+    Unseekable file that keeps what is written to it until it is drained.
+    zipfile.ZipFile writes to it, and the generator draining it sends each
+    part of the archive as soon as it is ready.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+        Everything written since the last call
+        :return: bytes
+        """
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files):
+    """
+    Generate a .zip archive, one part at a time
+    :param files: iterable of the name of each file and an iterable of its
+        content (bytes)
+
+    :return: generator of bytes
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, chunks in files:
+            with archive.open(name, 'w') as archive_file:
+                for chunk in chunks:
+                    archive_file.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+            yield stream.drain()
+    yield stream.drain()
+
+
+def library_documents(library):
+    """
+    Bibcodes of a library, with their tags and notes. The MongoDB dumps list
+    the documents as bibcodes, or as a dictionary of bibcode to tags and
+    notes.
+
+    :param library: library of the MongoDB dump
+    :return: list of tuples of bibcode, tags and notes
+    """
+    documents = library.get('documents') or []
+    if isinstance(documents, dict):
+        return [
+            (bibcode, (document or {}).get('tags', []),
+             (document or {}).get('notes', []))
+            for bibcode, document in documents.items()
+        ]
+    return [(bibcode, [], []) for bibcode in documents]
+
+
+def document_bibtex(bibcode, tags, notes):
+    """
+    BibTeX entry of a document, with its tags as keywords
+    :param bibcode: bibcode of the document
+    :param tags: list of tags of the document
+    :param notes: list of notes of the document
+
+    :return: str
+    """
+    fields = [('adsurl', ADS_ABSTRACT_URL.format(bibcode))]
+    if tags:
+        fields.append(('keywords', ', '.join(tags)))
+    if notes:
+        fields.append(('notes', ', '.join(notes)))
+
+    return '@MISC{{{},\n{}\n}}\n\n'.format(
+        bibcode,
+        ',\n'.join('{:>10} = {{{}}}'.format(key, value) for key, value in fields)
+    )
+
+
+def library_file_names(libraries, extension='.bib'):
+    """
+    Unique file name of each library in the archive
+    :param libraries: list of libraries
+    :param extension: extension of the files
+
+    :return: list of str
+    """
+    names, seen = [], set()
+    for library in libraries:
+        name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', library.get('name') or '')
+        name = name.strip() or 'library'
+        unique_name, number = name, 1
+        while unique_name in seen:
+            number += 1
+            unique_name = '{} ({})'.format(name, number)
+        seen.add(unique_name)
+        names.append(unique_name + extension)
+    return names
+
+
+def stream_library_archive(libraries):
+    """
+    Generate the export archive of a user's libraries
+    :param libraries: list of libraries of the MongoDB dump
+
+    :return: generator of bytes
+    """
+    def files():
+        for name, library in zip(library_file_names(libraries), libraries):
+            yield name, (
+                document_bibtex(*document).encode('utf-8')
+                for document in library_documents(library)
+            )
+
+    return stream_zip(files())
+
+
+def stream_batches(function, items, batch_size, workers):
+    """
+    Apply function to consecutive batches of items in a pool of threads, and
+    generate the results in the order of the batches as soon as each one is
+    ready. At most twice as many batches as workers are in flight, so that
+    the memory used does not grow with the number of items.
+
+    :param function: function called with a list of items
+    :param items: list of items
+    :param batch_size: maximum number of items of a batch
+    :param workers: number of threads
+
+    :return: generator of the results of function
+    """
+    batches = (
+        items[start:start + batch_size]
+        for start in range(0, len(items), batch_size)
+    )
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for batch in batches:
+            pending.append(executor.submit(function, batch))
+            if len(pending) < 2 * workers:
+                continue
+            yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
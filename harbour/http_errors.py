@@ -34,6 +34,11 @@ CLASSIC_TIMEOUT = dict(
     code=504
 )
 
+CLASSIC_UNAVAILABLE = dict(
+    message='ADS Classic mirror is unavailable, try again later',
+    code=503
+)
+
 NO_CLASSIC_ACCOUNT = dict(
     message='This user has not setup an ADS Classic account',
     code=400
@@ -64,7 +69,17 @@ TWOPOINTOH_WRONG_EXPORT_TYPE = dict(
     code=400
 )
 
+WRONG_EXPORT_SOURCE = dict(
+    message='Libraries can only be exported from classic or twopointoh. See the API documentation: {0}'.format(API_HELP),
+    code=400
+)
+
 HARBOUR_SERVICE_FAIL = dict(
     message='Unknown failure from harbour-service',
     code=500
 )
+
+LIBRARY_BAD_PARAMETERS = dict(
+    message='offset, limit, fields or summary has a wrong value. See the API documentation: {0}'.format(API_HELP),
+    code=400
+)
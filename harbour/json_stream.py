@@ -0,0 +1,191 @@
+# encoding: utf-8
+"""
+Incremental reader of a JSON document given in chunks, e.g., the
+iter_content of a response requested with stream=True
+
+Objects and arrays are walked one member at a time, so that only the
+values the caller asks for are decoded, one at a time, and the document is
+never held in memory as a whole.
+"""
+
+import json
+import codecs
+
+WHITESPACE = ' \t\n\r'
+# Characters that can follow a valid number only if it was cut
+NUMBER_PARTS = '.eE+-'
+
+
+class JSONStream(object):
+    """
+    Pull reader of a JSON document. Every key yielded by iter_object and
+    every index yielded by iter_array must have its value consumed, with
+    value, skip, iter_object or iter_array, before the iteration is resumed:
+
+        for key in stream.iter_object():
+            if key == 'libraries':
+                for _ in stream.iter_array():
+                    library = stream.value()
+            else:
+                stream.skip()
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks, encoding='utf-8'):
+        """
+        Constructor
+        :param chunks: iterable of the chunks of the document
+        :type chunks: iterable of bytes or str
+        :param encoding: encoding of the chunks that are bytes
+        """
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder(encoding)(
+            errors='replace'
+        )
+        self.buffer = ''
+        self.position = 0
+        self.finished = False
+
+    def _read(self, size=1):
+        """
+        Append the next chunks to the buffer, at least size characters of
+        them unless the document ends, and drop what was consumed. The chunks
+        are joined once, so that a long read does not copy the buffer for
+        every chunk.
+
+        :param size: number of characters to read
+        :return: bool, False at the end of the document
+        """
+        if self.finished:
+            return False
+
+        chunks = []
+        length = 0
+        while length < size and not self.finished:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.finished = True
+                chunk = self.text_decoder.decode(b'', final=True)
+            else:
+                if isinstance(chunk, bytes):
+                    chunk = self.text_decoder.decode(chunk)
+            chunks.append(chunk)
+            length += len(chunk)
+
+        self.buffer = self.buffer[self.position:] + ''.join(chunks)
+        self.position = 0
+        return True
+
+    def _read_more(self):
+        """
+        Read as many characters as are left to consume in the buffer, so that
+        a value that is decoded again after each read is decoded a
+        logarithmic number of times, in linear time overall
+        :return: bool, False at the end of the document
+        """
+        return self._read(max(len(self.buffer) - self.position, 1))
+
+    def _peek(self):
+        """
+        Next character that is not whitespace, without consuming it
+        :return: str, empty at the end of the document
+        """
+        while True:
+            while self.position < len(self.buffer) and \
+                    self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read():
+                return ''
+
+    def _expect(self, characters):
+        """
+        Consume the next character that is not whitespace
+        :param characters: characters that are allowed
+        :return: str, the character
+        :raises ValueError: if it is not one of them
+        """
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError(
+                'Expecting one of {!r} at character {}, found {!r}'
+                .format(characters, self.position, character)
+            )
+        self.position += 1
+        return character
+
+    def value(self):
+        """
+        Decode the next value in full
+        :return: the value
+        :raises ValueError: if the document is not valid JSON
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                # The value may continue in the next chunks
+                if self._read_more():
+                    continue
+                raise
+            # A number at the end of the buffer, or cut before its fraction
+            # or exponent, may continue too
+            if (end == len(self.buffer) or self.buffer[end] in NUMBER_PARTS) \
+                    and self._read_more():
+                continue
+            self.position = end
+            return value
+
+    def skip(self):
+        """
+        Consume the next value, walking objects and arrays rather than
+        decoding them
+        """
+        character = self._peek()
+        if character == '{':
+            for _ in self.iter_object():
+                self.skip()
+        elif character == '[':
+            for _ in self.iter_array():
+                self.skip()
+        else:
+            self.value()
+
+    def iter_object(self):
+        """
+        Walk the next value, which must be an object
+        :return: generator of its keys
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.position += 1
+            return
+
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError('Expecting a key, found {!r}'.format(key))
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        """
+        Walk the next value, which must be an array
+        :return: generator of the index of each of its elements
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self.position += 1
+            return
+
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self._expect(',]') == ']':
+                return
@@ -0,0 +1,145 @@
+# encoding: utf-8
+"""
+Compact binary format of the ADS 2.0 library dumps
+
+The MongoDB dumps are lists of libraries, each with a list of bibcodes. In
+the binary format every distinct bibcode is stored once, in a table, and the
+libraries refer to it by position. Decoding only parses a small JSON header
+and splits the table, and the decoded libraries share the same bibcode
+strings. A converted file also records the ETag of the JSON dump it was
+converted from, so that a copy that is out of date can be told apart.
+
+Layout (little-endian):
+    magic:   4 bytes, HLB2
+    etag:    length (I) + ETag of the JSON dump, UTF-8
+    header:  length (I) + JSON of the libraries, with their documents
+             replaced by a placeholder, and the number of documents of each
+    table:   length (I) + distinct bibcodes, newline separated, UTF-8
+    indices: number (I) + position in the table of every document (I)
+"""
+
+import sys
+import json
+import struct
+
+from array import array
+
+MAGIC = b'HLB2'
+LENGTH = struct.Struct('<I')
+
+# Libraries whose documents are not a list of bibcodes are kept as they are
+RAW_DOCUMENTS = -1
+
+
+def is_binary_library(data):
+    """
+    Checks if data is in the binary library format
+    :param data: content of a library file
+    :type data: bytes
+    :return: boolean
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def source_etag(data):
+    """
+    ETag of the JSON dump a binary library file was converted from
+    :param data: content of a library file
+    :type data: bytes
+    :return: str, or None if it is not in the binary format
+    """
+    if not is_binary_library(data):
+        return None
+
+    length = LENGTH.unpack_from(data, len(MAGIC))[0]
+    start = len(MAGIC) + LENGTH.size
+    return data[start:start + length].decode('utf-8')
+
+
+def encode_libraries(libraries, etag=''):
+    """
+    Convert a parsed MongoDB dump of ADS 2.0 libraries to the binary format
+    :param libraries: list of libraries
+    :type libraries: list
+    :param etag: ETag of the JSON dump the libraries were parsed from
+    :type etag: str
+
+    :return: bytes
+    """
+    table = {}
+    indices = array('I')
+    header = {'libraries': [], 'counts': []}
+
+    for library in libraries:
+        documents = library.get('documents')
+        library = dict(library)
+
+        if isinstance(documents, list) and all(
+            isinstance(bibcode, str) and '\n' not in bibcode
+            for bibcode in documents
+        ):
+            library['documents'] = None
+            header['counts'].append(len(documents))
+            for bibcode in documents:
+                indices.append(table.setdefault(bibcode, len(table)))
+        else:
+            header['counts'].append(RAW_DOCUMENTS)
+
+        header['libraries'].append(library)
+
+    if sys.byteorder == 'big':
+        indices.byteswap()
+
+    etag = etag.encode('utf-8')
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    bibcodes = '\n'.join(table).encode('utf-8')
+
+    return b''.join([
+        MAGIC,
+        LENGTH.pack(len(etag)), etag,
+        LENGTH.pack(len(header)), header,
+        LENGTH.pack(len(bibcodes)), bibcodes,
+        LENGTH.pack(len(indices)), indices.tobytes()
+    ])
+
+
+def decode_libraries(data):
+    """
+    Convert the binary format back to the parsed MongoDB dump
+    :param data: content of a binary library file
+    :type data: bytes
+
+    :return: list of libraries
+    """
+    if not is_binary_library(data):
+        raise ValueError('Not a binary library file')
+
+    offset = len(MAGIC)
+    sections = []
+    for _ in range(3):
+        length = LENGTH.unpack_from(data, offset)[0]
+        offset += LENGTH.size
+        sections.append(data[offset:offset + length])
+        offset += length
+
+    header = json.loads(sections[1])
+    table = sections[2].decode('utf-8').split('\n')
+
+    count = LENGTH.unpack_from(data, offset)[0]
+    offset += LENGTH.size
+    indices = array('I')
+    indices.frombytes(data[offset:offset + count * indices.itemsize])
+    if sys.byteorder == 'big':
+        indices.byteswap()
+
+    libraries = []
+    position = 0
+    for library, count in zip(header['libraries'], header['counts']):
+        if count != RAW_DOCUMENTS:
+            library['documents'] = [
+                table[index] for index in indices[position:position + count]
+            ]
+            position += count
+        libraries.append(library)
+
+    return libraries
@@ -0,0 +1,239 @@
+# encoding: utf-8
+"""
+Compact in-memory representation of the libraries
+
+A list of bibcodes is held as fixed-width 19-byte records in a single bytes
+object, rather than one str object per bibcode, which is what dominates the
+memory of cached libraries. Lists with bibcodes that do not fit the records
+keep interned strings. Libraries are objects with __slots__ that behave like
+read-only dictionaries, so that they can be used wherever the parsed JSON
+was.
+"""
+
+import re
+import sys
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+BIBCODE_LENGTH = 19
+BIBCODE_RECORD = re.compile('.{{{}}}'.format(BIBCODE_LENGTH), re.DOTALL)
+
+# Marks the fields that a library does not have
+MISSING = object()
+
+
+class BibcodeList(Sequence):
+    """
+    Read-only list of bibcodes
+    """
+    __slots__ = ('_packed', '_strings')
+
+    def __init__(self, bibcodes=()):
+        """
+        Constructor
+        :param bibcodes: iterable of bibcodes, which is packed as it is
+            read, so that a generator is never held as a list of str
+        """
+        packed = bytearray()
+        strings = None
+        for bibcode in bibcodes:
+            if strings is None:
+                if isinstance(bibcode, str) and \
+                        len(bibcode) == BIBCODE_LENGTH and bibcode.isascii():
+                    packed += bibcode.encode('ascii')
+                    continue
+                strings = [
+                    sys.intern(record) for record in
+                    BIBCODE_RECORD.findall(packed.decode('ascii'))
+                ]
+            strings.append(
+                sys.intern(bibcode) if isinstance(bibcode, str) else bibcode
+            )
+
+        if strings is None:
+            self._packed = bytes(packed)
+            self._strings = None
+        else:
+            self._packed = None
+            self._strings = tuple(strings)
+
+    def to_list(self):
+        """
+        Bibcodes as a list of str, e.g., to serialise them
+        :return: list
+        """
+        if self._packed is None:
+            return list(self._strings)
+
+        return BIBCODE_RECORD.findall(self._packed.decode('ascii'))
+
+    def size(self):
+        """
+        Approximate memory used, in bytes
+        :return: int
+        """
+        if self._packed is not None:
+            return sys.getsizeof(self._packed)
+        return sys.getsizeof(self._strings) + sum(
+            sys.getsizeof(bibcode) for bibcode in self._strings
+        )
+
+    def __len__(self):
+        if self._packed is not None:
+            return len(self._packed) // BIBCODE_LENGTH
+        return len(self._strings)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        if self._packed is None:
+            return self._strings[index]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('bibcode index out of range')
+        start = index * BIBCODE_LENGTH
+        return self._packed[start:start + BIBCODE_LENGTH].decode('ascii')
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other):
+        if isinstance(other, (BibcodeList, list, tuple)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BibcodeList({!r})'.format(self.to_list())
+
+
+class Library(Mapping):
+    """
+    Read-only library, with the keys of the MongoDB dump or of the ADS
+    Classic libraries: name, description, documents, and any other key kept
+    as it is
+    """
+    __slots__ = ('name', 'description', 'documents', 'extra')
+
+    fields = ('name', 'description', 'documents')
+
+    def __init__(self, name=MISSING, description=MISSING, documents=MISSING,
+                 extra=None):
+        """
+        Constructor
+        :param name: name of the library
+        :param description: description of the library
+        :param documents: list of bibcodes, which is made compact, or the
+            documents in any other form, which are kept as they are
+        :param extra: dict of the other keys of the library
+        """
+        if isinstance(documents, list):
+            documents = BibcodeList(documents)
+
+        self.name = name
+        self.description = description
+        self.documents = documents
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, library):
+        """
+        Library from the parsed JSON of a library
+        :param library: dict
+        :return: Library
+        """
+        if isinstance(library, Library):
+            return library
+
+        extra = {
+            key: value for key, value in library.items()
+            if key not in cls.fields
+        }
+        return cls(
+            name=library.get('name', MISSING),
+            description=library.get('description', MISSING),
+            documents=library.get('documents', MISSING),
+            extra=extra
+        )
+
+    def size(self):
+        """
+        Approximate memory used, in bytes
+        :return: int
+        """
+        size = sys.getsizeof(self)
+        for key, value in self.items():
+            if isinstance(value, BibcodeList):
+                size += value.size()
+            else:
+                size += sys.getsizeof(value)
+        return size
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is MISSING:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __iter__(self):
+        for key in self.fields:
+            if getattr(self, key) is not MISSING:
+                yield key
+        if self.extra is not None:
+            for key in self.extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'Library({!r})'.format(dict(self))
+
+
+def compact_libraries(libraries):
+    """
+    Compact form of a list of libraries
+    :param libraries: list of dict
+    :return: list of Library
+    """
+    return [Library.from_dict(library) for library in libraries]
+
+
+def libraries_size(libraries):
+    """
+    Approximate memory used by a list of libraries, in bytes
+    :param libraries: list of Library
+    :return: int
+    """
+    return sys.getsizeof(libraries) + sum(
+        library.size() for library in libraries
+    )
+
+
+def to_json_value(value):
+    """
+    Default function of the JSON encoders, that serialises the compact form
+    :param value: value the JSON encoder does not know
+    :return: list or dict
+    """
+    if isinstance(value, BibcodeList):
+        return value.to_list()
+    if isinstance(value, Library):
+        return dict(value)
+    raise TypeError(
+        'Object of type {} is not JSON serializable'.format(type(value).__name__)
+    )
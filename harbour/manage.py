@@ -3,14 +3,22 @@ General manage commands for the harbour-service
 """
 import os
 import sys
+import json
+import shutil
+import tempfile
 PROJECT_HOME = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(PROJECT_HOME)
 
-from flask_script import Manager, Command
+from multiprocessing import Pool
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 from harbour.models import Base
 from harbour.app import create_app
+from harbour.storage import create_storage
+from harbour.library_format import encode_libraries
+from harbour.user_index import build_user_index
+from harbour.utils import binary_key
 
 # Load the app with the factory
 app = create_app()
@@ -30,6 +38,85 @@ class CreateDatabase(Command):
             Base.metadata.create_all(bind=app.db.engine)
 
 
+def convert_s3_object(arguments):
+    """
+    Convert one JSON object of the ADS 2.0 bucket to the binary format, and
+    upload it next to the JSON object. users.json becomes the users index,
+    the library dumps become binary library files.
+
+    :param arguments: tuple of the storage config and key
+    :return: tuple of the key, its size, and the size of the converted object
+    """
+    storage_config, key = arguments
+    storage = create_storage(storage_config)
+
+    data, etag = storage.get(key)
+
+    if key == 'users.json':
+        directory = tempfile.mkdtemp()
+        try:
+            index_path = os.path.join(directory, 'users.idx')
+            build_user_index(json.loads(data), index_path, etag=etag)
+            with open(index_path, 'rb') as index_file:
+                converted = index_file.read()
+        finally:
+            shutil.rmtree(directory)
+    else:
+        converted = encode_libraries(json.loads(data), etag=etag)
+
+    storage.put(binary_key(key), converted)
+
+    return key, len(data), len(converted)
+
+
+class ConvertLibraries(Command):
+    """
+    Converts the ADS 2.0 library dumps and users.json in the storage to the
+    binary format that is read when ADS_TWO_POINT_OH_BINARY_FORMAT is enabled
+    """
+    option_list = (
+        Option(
+            '--processes', '-p', dest='processes', type=int, default=None,
+            help='Number of processes, 1 to convert in this process'
+        ),
+    )
+
+    @staticmethod
+    def run(app=app, processes=None):
+        """
+        Converts every JSON object of the storage, over a pool of processes
+        :param processes: number of processes, defaults to the number of CPUs
+        :return: no return
+        """
+        storage_config = {
+            key: value for key, value in app.config.items()
+            if key.startswith(('HARBOUR_S3_', 'HARBOUR_STORAGE_'))
+            or key == 'ADS_TWO_POINT_OH_S3_MONGO_BUCKET'
+        }
+
+        arguments = [
+            (storage_config, key) for key in app.storage.keys()
+            if key.endswith('.json')
+        ]
+
+        if processes == 1:
+            results = map(convert_s3_object, arguments)
+        else:
+            pool = Pool(processes)
+            results = pool.imap_unordered(convert_s3_object, arguments)
+
+        try:
+            for key, size, converted_size in results:
+                app.logger.info(
+                    'Converted {}: {} bytes -> {} bytes'
+                    .format(key, size, converted_size)
+                )
+        finally:
+            if processes != 1:
+                pool.close()
+                pool.join()
+
+
 # Set up the alembic migration
 migrate = Migrate(app, app.db, compare_type=True)
 
@@ -37,6 +124,7 @@ migrate = Migrate(app, app.db, compare_type=True)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 manager.add_command('createdb', CreateDatabase())
+manager.add_command('convert', ConvertLibraries())
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,219 @@
+# encoding: utf-8
+"""
+Health and latency of the ADS Classic mirrors, measured by a background
+prober, so that requests can be routed to the fastest healthy mirror
+"""
+
+import time
+import threading
+import requests
+
+from collections import deque
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile
+    :param values: list of numbers
+    :param fraction: percentile as a fraction, e.g., 0.9
+    :return: number, or None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+class MirrorHealth(object):
+    """
+    Rolling window of the most recent probes of each mirror: whether each
+    probe succeeded, and the latency of the successful ones
+    """
+    def __init__(self, mirrors, window, routing=(), timer=time.time):
+        """
+        Constructor
+        :param mirrors: list of the mirror hosts, which are reported by status
+        :param window: number of probes kept for each mirror
+        :param routing: other mirror hosts that are probed only to route
+            requests to them, e.g., the myADS mirrors
+        :param timer: function returning the current time in seconds
+        """
+        self.mirrors = list(mirrors)
+        self.probed = self.mirrors + [
+            mirror for mirror in routing if mirror not in self.mirrors
+        ]
+        self.timer = timer
+
+        self._probes = {mirror: deque(maxlen=window) for mirror in self.probed}
+        self._last = {mirror: None for mirror in self.probed}
+        self._lock = threading.Lock()
+
+    def record(self, mirror, latency, error=None):
+        """
+        Record the outcome of a probe
+        :param mirror: mirror host
+        :param latency: seconds the probe took
+        :param error: description of the error, None if it succeeded
+        """
+        with self._lock:
+            self._probes[mirror].append((error is None, latency))
+            self._last[mirror] = (self.timer(), error)
+
+    def summary(self, mirror):
+        """
+        Summary of the recent probes of a mirror
+        :param mirror: mirror host
+        :return: dict
+        """
+        with self._lock:
+            probes = list(self._probes[mirror])
+            last = self._last[mirror]
+
+        latencies = [latency * 1000 for success, latency in probes if success]
+        return {
+            'mirror': mirror,
+            'healthy': last is not None and last[1] is None,
+            'probes': len(probes),
+            'success_rate': len(latencies) / len(probes) if probes else None,
+            'latency_ms': {
+                'p50': percentile(latencies, 0.5),
+                'p90': percentile(latencies, 0.9),
+                'p99': percentile(latencies, 0.99)
+            },
+            'last_probe': last[0] if last else None,
+            'last_error': last[1] if last else None
+        }
+
+    def status(self):
+        """
+        Summary of every reported mirror, in the order of the configuration
+        :return: list of dict
+        """
+        return [self.summary(mirror) for mirror in self.mirrors]
+
+    def fastest(self, mirrors):
+        """
+        Healthy mirror with the lowest median latency
+        :param mirrors: candidate mirror hosts
+        :return: str, or None if none of them is known to be healthy
+        """
+        healthy = [
+            self.summary(mirror) for mirror in mirrors
+            if mirror in self._probes
+        ]
+        healthy = [
+            summary for summary in healthy
+            if summary['healthy'] and summary['latency_ms']['p50'] is not None
+        ]
+        if not healthy:
+            return None
+
+        fastest = min(healthy, key=lambda summary: summary['latency_ms']['p50'])
+        return fastest['mirror']
+
+
+def probe_mirror(app, session, mirror):
+    """
+    Request the home page of a mirror. The probes use their own session
+    rather than app.client, so that they only measure the mirror and do not
+    count towards its circuit breaker.
+
+    :param app: flask.Flask application instance
+    :param session: requests.Session of the prober
+    :param mirror: mirror host
+
+    :return: tuple of the latency in seconds and the error, or None
+    """
+    url = app.config['ADS_CLASSIC_URL'].format(mirror=mirror)
+    start = time.time()
+    try:
+        response = session.get(
+            url,
+            timeout=app.config.get('HARBOUR_MIRROR_PROBE_TIMEOUT', 5)
+        )
+        response.close()
+    except Exception as error:
+        return time.time() - start, '{}: {}'.format(type(error).__name__, error)
+
+    latency = time.time() - start
+    if response.status_code >= 500:
+        return latency, 'HTTP {}'.format(response.status_code)
+    return latency, None
+
+
+class MirrorProber(threading.Thread):
+    """
+    Background thread that probes every mirror every interval seconds, and
+    records the outcomes in app.mirror_health
+    """
+    def __init__(self, app, interval):
+        """
+        Constructor
+        :param app: flask.Flask application instance
+        :param interval: seconds between two rounds of probes
+        """
+        super(MirrorProber, self).__init__(name='mirror-prober')
+        self.daemon = True
+        self.app = app
+        self.interval = interval
+        self.session = requests.Session()
+        self.stopped = threading.Event()
+
+    def probe(self):
+        """
+        Probe every mirror once
+        """
+        for mirror in self.app.mirror_health.probed:
+            latency, error = probe_mirror(self.app, self.session, mirror)
+            if error is not None:
+                self.app.logger.info(
+                    'Mirror "{}" failed its probe: {}'.format(mirror, error)
+                )
+            self.app.mirror_health.record(mirror, latency, error)
+
+    def run(self):
+        self.probe()
+        while not self.stopped.wait(self.interval):
+            self.probe()
+
+    def stop(self):
+        """
+        Stop probing
+        """
+        self.stopped.set()
+
+
+def start_mirror_prober(app):
+    """
+    Start the mirror prober of this process, if it is enabled and not
+    already running. This is called by the serving entry point, wsgi.py,
+    rather than by create_app, so that scripts and tests do not probe the
+    mirrors.
+
+    :param app: flask.Flask application instance
+    """
+    interval = app.config.get('HARBOUR_MIRROR_PROBE_INTERVAL')
+    if not interval:
+        return
+
+    with app.mirror_prober_lock:
+        prober = app.mirror_prober
+        if prober is not None and prober.is_alive():
+            return
+
+        app.mirror_prober = MirrorProber(app, interval)
+        app.mirror_prober.start()
+
+
+def myads_mirror(app):
+    """
+    Mirror from which the myADS settings are requested: the fastest healthy
+    one of ADS_CLASSIC_MYADS_MIRRORS, or the first one if none is known to be
+    healthy
+
+    :param app: flask.Flask application instance
+    :return: str
+    """
+    mirrors = app.config.get('ADS_CLASSIC_MYADS_MIRRORS', ['adsabs.harvard.edu'])
+    return app.mirror_health.fastest(mirrors) or mirrors[0]
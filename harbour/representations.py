@@ -0,0 +1,90 @@
+# encoding: utf-8
+"""
+Output representations of the flask-restful resources
+
+The JSON representation uses a fast encoder (orjson or ujson) when one is
+installed, chosen with HARBOUR_JSON_ENCODER, and falls back to the stdlib
+json module otherwise.
+"""
+
+import json
+
+from flask import make_response
+from harbour.library_model import to_json_value
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def stdlib_dumps(data):
+    return json.dumps(data, default=to_json_value).encode('utf-8')
+
+
+def orjson_dumps(data):
+    return orjson.dumps(
+        data, default=to_json_value, option=orjson.OPT_NON_STR_KEYS
+    )
+
+
+def ujson_dumps(data):
+    # default needs ujson >= 5.1, older versions fall back to the stdlib
+    return ujson.dumps(data, default=to_json_value).encode('utf-8')
+
+
+# Encoders in order of preference, None when not installed
+ENCODERS = [
+    ('orjson', orjson_dumps if orjson is not None else None),
+    ('ujson', ujson_dumps if ujson is not None else None),
+    ('json', stdlib_dumps)
+]
+
+
+def get_encoder(name='auto'):
+    """
+    JSON encoder function, returning bytes
+    :param name: orjson, ujson, json, or auto for the fastest installed
+    :return: tuple of the name and function of the encoder
+    """
+    encoders = dict(ENCODERS)
+    if name not in encoders and name != 'auto':
+        raise ValueError('Unknown JSON encoder: {}'.format(name))
+
+    if name != 'auto' and encoders[name] is not None:
+        return name, encoders[name]
+
+    for encoder_name, encoder in ENCODERS:
+        if encoder is not None:
+            return encoder_name, encoder
+
+
+def make_json_representation(name='auto'):
+    """
+    flask-restful representation of application/json, see
+    flask_restful.Api.representation
+
+    :param name: name of the encoder, see get_encoder
+    :return: function
+    """
+    encoder_name, encoder = get_encoder(name)
+
+    def output_json(data, code, headers=None):
+        try:
+            body = encoder(data)
+        except (TypeError, OverflowError):
+            # Data the fast encoder does not support, e.g., very large ints
+            body = stdlib_dumps(data)
+
+        response = make_response(body + b'\n', code)
+        response.mimetype = 'application/json'
+        response.headers.extend(headers or {})
+        return response
+
+    output_json.encoder_name = encoder_name
+    return output_json
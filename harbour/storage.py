@@ -0,0 +1,339 @@
+# encoding: utf-8
+"""
+Storage backends of the ADS 2.0 data (users.json, the library dumps and the
+export archives), selected with HARBOUR_STORAGE_BACKEND:
+  - s3: the ADS_TWO_POINT_OH_S3_MONGO_BUCKET bucket on S3
+  - local: a local directory, HARBOUR_STORAGE_LOCAL_DIR, e.g., a mounted
+    volume in air-gapped deployments or a copy of the bucket for benchmarks
+
+Both backends have the same interface. Objects are identified by their key,
+and versioned by an ETag, so that callers can make conditional reads.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from io import BytesIO
+from botocore.exceptions import ClientError
+from werkzeug.http import quote_etag
+
+from harbour.client import S3Client
+from harbour.utils import is_not_modified, is_missing
+
+
+class StorageError(Exception):
+    """
+    Base class of the errors of the storage backends
+    """
+
+
+class NotFound(StorageError):
+    """
+    The object does not exist
+    """
+
+
+class NotModified(StorageError):
+    """
+    The object has not changed since the ETag given in if_none_match
+    """
+
+
+def create_storage(config, s3=None, disk_cache=None):
+    """
+    Create the storage backend selected by HARBOUR_STORAGE_BACKEND
+    :param config: configuration dictionary of the application
+    :param s3: harbour.client.S3Client to use, a new one by default
+    :param disk_cache: harbour.cache.DiskCache for the S3 backend, if any
+
+    :return: S3Storage or LocalStorage
+    """
+    backend = config.get('HARBOUR_STORAGE_BACKEND', 's3')
+
+    if backend == 's3':
+        return S3Storage(
+            s3 if s3 is not None else S3Client(config),
+            config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
+            disk_cache=disk_cache
+        )
+    if backend == 'local':
+        return LocalStorage(
+            config['HARBOUR_STORAGE_LOCAL_DIR'],
+            base_url=config.get('HARBOUR_STORAGE_LOCAL_URL')
+        )
+
+    raise ValueError('Unknown storage backend: {}'.format(backend))
+
+
+class S3Storage(object):
+    """
+    Objects of an S3 bucket. Reads go through the shared disk cache if one is
+    given; only a HEAD request is then made to S3 for cached objects.
+    """
+    def __init__(self, s3, bucket, disk_cache=None):
+        """
+        Constructor
+        :param s3: harbour.client.S3Client
+        :param bucket: S3 bucket of the objects
+        :param disk_cache: harbour.cache.DiskCache or None
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.disk_cache = disk_cache
+
+    def _call(self, method, **kwargs):
+        """
+        Call a method of the S3 client on the bucket, turning the errors of
+        conditional requests and missing objects into storage errors
+        """
+        try:
+            return getattr(self.s3, method)(Bucket=self.bucket, **kwargs)
+        except ClientError as error:
+            if is_not_modified(error):
+                raise NotModified(kwargs.get('Key'))
+            if is_missing(error):
+                raise NotFound(kwargs.get('Key'))
+            raise
+
+    def head(self, key):
+        """
+        ETag of an object
+        :param key: key of the object
+        :return: str
+        """
+        return self._call('head_object', Key=key)['ETag']
+
+    def get(self, key, if_none_match=None):
+        """
+        Content of an object
+        :param key: key of the object
+        :param if_none_match: ETag of a copy the caller already has; if the
+            object has not changed, NotModified is raised
+
+        :return: tuple of the content (bytes) and the ETag of the object
+        """
+        if self.disk_cache is not None and not if_none_match:
+            etag = self.head(key)
+            data = self.disk_cache.get(self.bucket, key, etag)
+            if data is not None:
+                return data, etag
+
+        if if_none_match:
+            response = self._call('get_object', Key=key, IfNoneMatch=if_none_match)
+        else:
+            response = self._call('get_object', Key=key)
+
+        body = response['Body']
+        data = BytesIO()
+        for chunk in iter(lambda: body.read(1024), b''):
+            data.write(chunk)
+        data = data.getvalue()
+
+        if self.disk_cache is not None:
+            self.disk_cache.set(self.bucket, key, response['ETag'], data)
+
+        return data, response['ETag']
+
+    def stream(self, key, chunk_size, if_none_match=None):
+        """
+        Content of an object, read one chunk at a time
+        :param key: key of the object
+        :param chunk_size: size of the chunks in bytes
+        :param if_none_match: see get
+
+        :return: tuple of the ETag and a generator of bytes
+        """
+        if if_none_match:
+            response = self._call('get_object', Key=key, IfNoneMatch=if_none_match)
+        else:
+            response = self._call('get_object', Key=key)
+
+        body = response['Body']
+
+        def generate():
+            try:
+                for chunk in iter(lambda: body.read(chunk_size), b''):
+                    yield chunk
+            finally:
+                body.close()
+
+        return response['ETag'], generate()
+
+    def presign(self, key, expires_in):
+        """
+        Temporary URL from which the object can be downloaded
+        :param key: key of the object
+        :param expires_in: lifetime of the URL in seconds
+        :return: str
+        """
+        return self.s3.generate_presigned_url(
+            ClientMethod='get_object',
+            Params={
+                'Bucket': self.bucket,
+                'Key': key
+            },
+            ExpiresIn=expires_in
+        )
+
+    def put(self, key, data):
+        """
+        Store an object
+        :param key: key of the object
+        :param data: content of the object
+        :type data: bytes or file object
+        """
+        self._call('put_object', Key=key, Body=data)
+
+    def keys(self):
+        """
+        Keys of all the objects
+        :return: generator of str
+        """
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket):
+            for s3_object in page.get('Contents', []):
+                yield s3_object['Key']
+
+
+class LocalStorage(object):
+    """
+    Objects stored as files in a local directory, the key being the path of
+    the file relative to the directory. The ETag of an object is derived from
+    the modification time and size of its file.
+    """
+    def __init__(self, directory, base_url=None):
+        """
+        Constructor
+        :param directory: directory of the objects
+        :param base_url: URL under which the directory is served, used by
+            presign; by default, file:// URLs are returned
+        """
+        self.directory = os.path.abspath(directory)
+        self.base_url = base_url
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.directory, key))
+        if not path.startswith(self.directory + os.sep):
+            raise NotFound(key)
+        return path
+
+    @staticmethod
+    def _etag(stat):
+        return quote_etag(hashlib.md5(
+            '{}-{}'.format(stat.st_mtime_ns, stat.st_size).encode('utf-8')
+        ).hexdigest())
+
+    def _open(self, key, if_none_match=None):
+        """
+        Open the file of an object
+        :return: tuple of the ETag and the open file
+        """
+        try:
+            object_file = open(self._path(key), 'rb')
+        except (IOError, OSError):
+            raise NotFound(key)
+
+        etag = self._etag(os.fstat(object_file.fileno()))
+        if if_none_match and if_none_match == etag:
+            object_file.close()
+            raise NotModified(key)
+
+        return etag, object_file
+
+    def head(self, key):
+        """
+        ETag of an object
+        :param key: key of the object
+        :return: str
+        """
+        try:
+            return self._etag(os.stat(self._path(key)))
+        except OSError:
+            raise NotFound(key)
+
+    def get(self, key, if_none_match=None):
+        """
+        Content of an object
+        :param key: key of the object
+        :param if_none_match: ETag of a copy the caller already has; if the
+            object has not changed, NotModified is raised
+
+        :return: tuple of the content (bytes) and the ETag of the object
+        """
+        etag, object_file = self._open(key, if_none_match)
+        with object_file:
+            return object_file.read(), etag
+
+    def stream(self, key, chunk_size, if_none_match=None):
+        """
+        Content of an object, read one chunk at a time
+        :param key: key of the object
+        :param chunk_size: size of the chunks in bytes
+        :param if_none_match: see get
+
+        :return: tuple of the ETag and a generator of bytes
+        """
+        etag, object_file = self._open(key, if_none_match)
+
+        def generate():
+            with object_file:
+                for chunk in iter(lambda: object_file.read(chunk_size), b''):
+                    yield chunk
+
+        return etag, generate()
+
+    def presign(self, key, expires_in):
+        """
+        URL from which the object can be downloaded. Local files are served
+        as they are, so the URL does not expire.
+
+        :param key: key of the object
+        :param expires_in: unused
+        :return: str
+        """
+        path = self._path(key)
+        if self.base_url:
+            return '{}/{}'.format(self.base_url.rstrip('/'), key)
+        return 'file://{}'.format(path)
+
+    def put(self, key, data):
+        """
+        Store an object, with an atomic rename so that readers never see a
+        partial file
+
+        :param key: key of the object
+        :param data: content of the object
+        :type data: bytes or file object
+        """
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=directory, suffix='.tmp'
+        )
+        try:
+            with os.fdopen(descriptor, 'wb') as temporary_file:
+                if hasattr(data, 'read'):
+                    shutil.copyfileobj(data, temporary_file)
+                else:
+                    temporary_file.write(data)
+            os.rename(temporary_path, path)
+        except Exception:
+            os.remove(temporary_path)
+            raise
+
+    def keys(self):
+        """
+        Keys of all the objects
+        :return: generator of str
+        """
+        for root, directories, files in os.walk(self.directory):
+            for name in sorted(files):
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.relpath(os.path.join(root, name), self.directory)
+                yield path.replace(os.sep, '/')
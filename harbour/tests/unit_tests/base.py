@@ -21,6 +21,7 @@ class TestBase(TestCase):
                'CLASSIC_LOGGING': {},
                'ADS_CLASSIC_MIRROR_LIST': ['mirror.com', 'other.mirror.com'],
                'ADS_TWO_POINT_OH_MIRROR': 'mirror.com',
+               'HARBOUR_MIRROR_PROBE_INTERVAL': 0,
                'SQLALCHEMY_DATABASE_URI': TestBaseDatabase.postgresql_url,
                'SQLALCHEMY_ECHO': True,
                'TESTING': True,
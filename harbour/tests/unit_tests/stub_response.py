@@ -3,6 +3,8 @@
 Mock responses to be used with HTTMock
 """
 
+import json
+
 from httmock import urlmatch
 from harbour.tests.unit_tests.stub_data import stub_classic_success, stub_classic_unknown_user, \
     stub_classic_wrong_password, stub_classic_no_cookie, \
@@ -102,3 +104,25 @@ def export_fail(url, request):
         'status_code': 500,
         'content': 'Fail'
     }
+
+
+@urlmatch(path=r'.*/export/bibtex$')
+def export_bibtex_success(url, request):
+    bibcodes = json.loads(request.body)['bibcode']
+    return {
+        'status_code': 200,
+        'content': {
+            'msg': 'Retrieved {} abstracts'.format(len(bibcodes)),
+            'export': ''.join(
+                '@ARTICLE{{{},\n}}\n\n'.format(bibcode) for bibcode in bibcodes
+            )
+        }
+    }
+
+
+@urlmatch(path=r'.*/export/bibtex$')
+def export_bibtex_fail(url, request):
+    return {
+        'status_code': 500,
+        'content': 'Fail'
+    }
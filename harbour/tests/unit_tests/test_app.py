@@ -2,13 +2,17 @@
 Test webservices
 """
 
+import os
 import mock
 import json
 import boto3
+import shutil
+import tempfile
 
 from unittest import TestCase
 from moto import mock_s3
-from harbour.app import create_app
+from harbour.app import create_app, load_s3, prepare_users, UsersRefresher
+from harbour.user_index import UserIndex, build_user_index
 
 
 class TestApp(TestCase):
@@ -38,21 +42,354 @@ class TestApp(TestCase):
 
         app = create_app()
 
-        self.assertTrue(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
+        self.assertTrue(app.users_ready.is_set())
         self.assertEqual(
             app.config['ADS_TWO_POINT_OH_USERS'],
             stub_mongogut_users
         )
 
-    @mock.patch('harbour.app.boto3.resource')
-    def test_load_s3_create_app_mongo_load_success(self, mock_resource):
+    @mock.patch('harbour.client.S3Client.client', new_callable=mock.PropertyMock)
+    def test_load_s3_create_app_mongo_load_success(self, mock_client):
         """
         Test that when the application is created, that the mongo user data
         is loaded from s3, if available.
         """
-        mock_resource.side_effect = Exception
+        mock_client.side_effect = Exception
 
         app = create_app()
 
-        self.assertFalse(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
+        self.assertFalse(app.users_ready.is_set())
         self.assertEqual(app.config['ADS_TWO_POINT_OH_USERS'], {})
+
+    @mock_s3
+    def test_load_s3_create_app_mongo_load_into_index(self):
+        """
+        Test that the mongo user data is loaded into a memory-mapped index when
+        one is configured, and that the index is reused while users.json does
+        not change.
+        """
+        stub_mongogut_users = {
+            'user@ads.com': 'cb16a523-cdba-406b-bfff-edfd428248be.json'
+        }
+
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps(stub_mongogut_users)
+        )
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        index_path = os.path.join(directory, 'users.idx')
+
+        app = create_app(ADS_TWO_POINT_OH_USERS_INDEX=index_path)
+
+        users = app.config['ADS_TWO_POINT_OH_USERS']
+        self.assertTrue(app.users_ready.is_set())
+        self.assertIsInstance(users, UserIndex)
+        self.assertEqual(
+            users.get('user@ads.com'),
+            stub_mongogut_users['user@ads.com']
+        )
+
+        # A second worker maps the same index without rebuilding it
+        with mock.patch('harbour.app.build_user_index') as mocked_build:
+            app = create_app(ADS_TWO_POINT_OH_USERS_INDEX=index_path)
+            self.assertFalse(mocked_build.called)
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'].etag,
+            users.etag
+        )
+
+    @mock_s3
+    def test_load_s3_reuses_an_index_rebuilt_by_another_worker(self):
+        """
+        Test that when users.json changes, the index is rebuilt by the first
+        worker only, and mapped by the others
+        """
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'first.json'})
+        )
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        index_path = os.path.join(directory, 'users.idx')
+
+        first = create_app(ADS_TWO_POINT_OH_USERS_INDEX=index_path)
+        second = create_app(ADS_TWO_POINT_OH_USERS_INDEX=index_path)
+
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'second.json'})
+        )
+        self.assertTrue(load_s3(first))
+
+        with mock.patch('harbour.app.build_user_index') as mocked_build:
+            self.assertTrue(load_s3(second))
+            self.assertFalse(load_s3(second))
+            self.assertFalse(mocked_build.called)
+
+        self.assertEqual(
+            second.config['ADS_TWO_POINT_OH_USERS'].get('user@ads.com'),
+            'second.json'
+        )
+
+    @mock_s3
+    def test_load_s3_uses_the_converted_index_only_when_current(self):
+        """
+        Test that with the binary format, the converted users index is used
+        while it was converted from the current users.json, and users.json
+        is read again once it changes
+        """
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'first.json'})
+        )
+        etag = s3_resource.Object('adsabs-mongogut', 'users.json').e_tag
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        converted_path = os.path.join(directory, 'converted.idx')
+        build_user_index(
+            {'user@ads.com': 'converted.json'}, converted_path, etag=etag
+        )
+        with open(converted_path, 'rb') as converted_file:
+            bucket.put_object(Key='users.idx', Body=converted_file.read())
+
+        index_path = os.path.join(directory, 'users.idx')
+        with mock.patch('harbour.app.build_user_index') as mocked_build:
+            app = create_app(
+                ADS_TWO_POINT_OH_USERS_INDEX=index_path,
+                ADS_TWO_POINT_OH_BINARY_FORMAT=True
+            )
+            self.assertFalse(mocked_build.called)
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'].get('user@ads.com'),
+            'converted.json'
+        )
+        self.assertFalse(load_s3(app))
+
+        # users.idx is now out of date
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'second.json'})
+        )
+        self.assertTrue(load_s3(app))
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'].get('user@ads.com'),
+            'second.json'
+        )
+        self.assertEqual(
+            sorted(os.listdir(directory)),
+            ['converted.idx', 'users.idx', 'users.idx.lock']
+        )
+
+    @mock_s3
+    def test_load_s3_only_reloads_when_users_change(self):
+        """
+        Test that once the users are loaded, they are only loaded again when
+        the ETag of users.json changes
+        """
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'first.json'})
+        )
+
+        app = create_app()
+        users = app.config['ADS_TWO_POINT_OH_USERS']
+        self.assertIsNotNone(app.config['ADS_TWO_POINT_OH_USERS_ETAG'])
+
+        self.assertFalse(load_s3(app))
+        self.assertIs(app.config['ADS_TWO_POINT_OH_USERS'], users)
+
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'second.json'})
+        )
+
+        self.assertTrue(load_s3(app))
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'],
+            {'user@ads.com': 'second.json'}
+        )
+
+    @mock_s3
+    def test_users_refresher_recovers_from_a_failed_load(self):
+        """
+        Test that the refresher loads the users when they could not be loaded
+        when the application was created
+        """
+        app = create_app()
+        self.assertFalse(app.users_ready.is_set())
+
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'library.json'})
+        )
+
+        refresher = UsersRefresher(app, interval=0.01)
+        refresher.start()
+        app.users_ready.wait(5)
+        refresher.stop()
+        refresher.join()
+
+        self.assertTrue(app.users_ready.is_set())
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'],
+            {'user@ads.com': 'library.json'}
+        )
+
+    @mock_s3
+    def test_users_are_loaded_in_the_background(self):
+        """
+        Test that the application is created without waiting for the users
+        when they are loaded in the background
+        """
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'library.json'})
+        )
+
+        with mock.patch('harbour.app.threading.Thread.start') as mocked_start:
+            app = create_app(ADS_TWO_POINT_OH_USERS_LOAD='background')
+            self.assertTrue(mocked_start.called)
+        self.assertFalse(app.users_ready.is_set())
+
+        app.users_loader.run()
+        self.assertTrue(app.users_ready.is_set())
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'],
+            {'user@ads.com': 'library.json'}
+        )
+
+    @mock_s3
+    def test_failed_background_load_is_retried_by_a_request(self):
+        """
+        Test that when the background load fails, and there is no users
+        refresher, the next request that needs the users loads them
+        """
+        with mock.patch('harbour.app.threading.Thread.start'):
+            app = create_app(ADS_TWO_POINT_OH_USERS_LOAD='background')
+        app.users_loader.run()
+        self.assertFalse(app.users_ready.is_set())
+
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'library.json'})
+        )
+
+        with app.test_request_context('/mirrors'):
+            prepare_users(app)
+        self.assertFalse(app.users_ready.is_set())
+
+        with app.test_request_context('/libraries/twopointoh/10'):
+            prepare_users(app)
+        self.assertTrue(app.users_ready.is_set())
+
+    @mock_s3
+    def test_users_are_loaded_lazily_by_the_first_request(self):
+        """
+        Test that lazily loaded users are only loaded by the first request to
+        an ADS 2.0 end point
+        """
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'library.json'})
+        )
+
+        app = create_app(ADS_TWO_POINT_OH_USERS_LOAD='lazy')
+        self.assertFalse(app.users_ready.is_set())
+
+        with app.test_request_context('/mirrors'):
+            prepare_users(app)
+        self.assertFalse(app.users_ready.is_set())
+
+        with app.test_request_context('/libraries/twopointoh/10'):
+            prepare_users(app)
+        self.assertTrue(app.users_ready.is_set())
+
+        with mock.patch('harbour.app.load_s3') as mocked_load:
+            with app.test_request_context('/libraries/twopointoh/10'):
+                prepare_users(app)
+            self.assertFalse(mocked_load.called)
+
+    def test_first_response_time_is_reported(self):
+        """
+        Test that the time from import to the first response is recorded
+        """
+        app = create_app(ADS_TWO_POINT_OH_USERS_LOAD='lazy')
+        self.assertIsNone(app.first_response_time)
+
+        app.test_client().get('/mirrors')
+        first_response_time = app.first_response_time
+        self.assertGreater(first_response_time, 0)
+
+        app.test_client().get('/mirrors')
+        self.assertEqual(app.first_response_time, first_response_time)
+
+    @mock_s3
+    def test_load_s3_through_the_disk_cache(self):
+        """
+        Test that users.json is kept in the disk cache, so that a new worker
+        does not download it again
+        """
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'library.json'})
+        )
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        app = create_app(ADS_TWO_POINT_OH_DISK_CACHE_DIR=directory)
+        self.assertTrue(app.users_ready.is_set())
+        self.assertEqual(app.object_cache.stats()['misses'], 1)
+
+        app = create_app(ADS_TWO_POINT_OH_DISK_CACHE_DIR=directory)
+        self.assertTrue(app.users_ready.is_set())
+        self.assertEqual(app.object_cache.stats()['hits'], 1)
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'],
+            {'user@ads.com': 'library.json'}
+        )
+
+    def test_s3_client_is_created_once_per_process(self):
+        """
+        Test that the S3 client is shared within a process, and recreated in
+        a forked process
+        """
+        app = create_app(HARBOUR_S3_MAX_POOL_CONNECTIONS=25)
+
+        client = app.s3.client
+        self.assertIs(app.s3.client, client)
+        self.assertEqual(client.meta.config.max_pool_connections, 25)
+
+        with mock.patch('harbour.client.os.getpid', return_value=-1):
+            self.assertIsNot(app.s3.client, client)
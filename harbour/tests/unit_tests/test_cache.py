@@ -0,0 +1,281 @@
+"""
+Test the in-process caches
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+from unittest import TestCase
+from harbour.cache import LRUCache, DiskCache, StaleWhileRevalidateCache
+
+
+class TestLRUCache(TestCase):
+    """
+    Test the size-bounded LRU cache
+    """
+
+    def setUp(self):
+        """
+        Use a timer that can be moved forward by the tests
+        """
+        self.now = 0
+        self.cache = LRUCache(max_size=10, ttl=60, timer=lambda: self.now)
+
+    def test_get_and_set(self):
+        """
+        Test that stored values are returned, and that lookups are counted
+        """
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.set('key', 'value', size=5)
+
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertEqual(self.cache.get('other', 'default'), 'default')
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['size'], 5)
+
+    def test_least_recently_used_entries_are_evicted_by_size(self):
+        """
+        Test that the least recently used entries are evicted once the values
+        no longer fit in the cache
+        """
+        self.cache.set('first', 1, size=4)
+        self.cache.set('second', 2, size=4)
+        self.cache.get('first')
+        self.cache.set('third', 3, size=4)
+
+        self.assertEqual(self.cache.get('first'), 1)
+        self.assertIsNone(self.cache.get('second'))
+        self.assertEqual(self.cache.get('third'), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertEqual(self.cache.size, 8)
+
+    def test_values_larger_than_the_cache_are_not_stored(self):
+        """
+        Test that a value that can never fit does not empty the cache
+        """
+        self.cache.set('small', 1, size=4)
+        self.cache.set('large', 2, size=11)
+
+        self.assertEqual(self.cache.get('small'), 1)
+        self.assertIsNone(self.cache.get('large'))
+
+    def test_replacing_an_entry_updates_the_size(self):
+        """
+        Test that storing a key twice only counts the latest value
+        """
+        self.cache.set('key', 1, size=4)
+        self.cache.set('key', 2, size=6)
+
+        self.assertEqual(self.cache.get('key'), 2)
+        self.assertEqual(self.cache.size, 6)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_entries_expire(self):
+        """
+        Test that entries older than the time to live are not returned
+        """
+        self.cache.set('key', 'value', size=1)
+
+        self.now = 60
+        self.assertEqual(self.cache.get('key'), 'value')
+
+        self.now = 61
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_delete_and_clear(self):
+        """
+        Test that entries can be removed
+        """
+        self.cache.set('first', 1, size=1)
+        self.cache.set('second', 2, size=1)
+
+        self.cache.delete('first')
+        self.cache.delete('unknown')
+        self.assertIsNone(self.cache.get('first'))
+        self.assertEqual(self.cache.size, 1)
+
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
+
+
+class TestStaleWhileRevalidateCache(TestCase):
+    """
+    Test the cache that refreshes stale values in the background
+    """
+
+    def setUp(self):
+        """
+        Use a timer that can be moved forward by the tests
+        """
+        self.now = 0
+        self.cache = StaleWhileRevalidateCache(
+            max_size=100, ttl=60, max_age=600, timer=lambda: self.now
+        )
+
+    def refresh(self, fetch):
+        """
+        Get a stale value, and wait for the refresh it starts
+        """
+        release = threading.Event()
+
+        def blocking_fetch():
+            release.wait(5)
+            return fetch()
+
+        value = self.cache.get('key', blocking_fetch)
+        thread = self.cache.refreshing['key']
+        # Only one refresh runs at a time
+        self.assertEqual(self.cache.get('key', blocking_fetch), value)
+        self.assertIs(self.cache.refreshing['key'], thread)
+
+        release.set()
+        thread.join(5)
+        return value
+
+    def test_fresh_values_are_not_fetched_again(self):
+        """
+        Test that values are fetched once while they are fresh
+        """
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return 'value'
+
+        self.assertEqual(self.cache.get('key', fetch), 'value')
+        self.now = 60
+        self.assertEqual(self.cache.get('key', fetch), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_stale_values_are_refreshed(self):
+        """
+        Test that a stale value is returned while it is fetched again
+        """
+        self.cache.get('key', lambda: 'old')
+        self.now = 61
+
+        self.assertEqual(self.refresh(lambda: 'new'), 'old')
+        self.assertEqual(self.cache.get('key', lambda: 'other'), 'new')
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['stale_hits'], 2)
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['refreshing'], 0)
+
+    def test_failed_refreshes_keep_the_last_value(self):
+        """
+        Test that the last good value is kept when the refresh fails
+        """
+        def fail():
+            raise IOError('timed out')
+
+        self.cache.get('key', lambda: 'old')
+        self.now = 61
+
+        self.assertEqual(self.refresh(fail), 'old')
+        self.assertEqual(self.refresh(lambda: None), 'old')
+        self.assertEqual(self.cache.stats()['refresh_failures'], 2)
+
+        # Until it is too old
+        self.now = 700
+        with self.assertRaises(IOError):
+            self.cache.get('key', fail)
+        self.assertIsNone(self.cache.get('key', lambda: None))
+
+
+class TestDiskCache(TestCase):
+    """
+    Test the on-disk cache of S3 objects
+    """
+
+    def setUp(self):
+        """
+        Create a temporary directory for the cache
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Remove the temporary directory
+        """
+        shutil.rmtree(self.directory)
+
+    def test_objects_are_addressed_by_bucket_key_and_etag(self):
+        """
+        Test that an object is only returned for the ETag it was stored with,
+        and that it is shared between cache instances
+        """
+        cache = DiskCache(self.directory, max_size=1024, compression='zlib')
+        cache.set('bucket', 'users.json', '"etag"', b'{"user": "file"}')
+
+        other_cache = DiskCache(self.directory, max_size=1024, compression='zlib')
+        self.assertEqual(
+            other_cache.get('bucket', 'users.json', '"etag"'),
+            b'{"user": "file"}'
+        )
+        self.assertIsNone(other_cache.get('bucket', 'users.json', '"other"'))
+        self.assertIsNone(other_cache.get('other', 'users.json', '"etag"'))
+
+        stats = other_cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(
+            [name for name in os.listdir(self.directory) if name.endswith('.tmp')],
+            []
+        )
+
+    def test_uncompressed_objects(self):
+        """
+        Test that objects can be stored as they are
+        """
+        cache = DiskCache(self.directory, max_size=1024)
+        cache.set('bucket', 'library.json', '"etag"', b'[]')
+        self.assertEqual(cache.get('bucket', 'library.json', '"etag"'), b'[]')
+
+    def test_least_recently_used_objects_are_removed(self):
+        """
+        Test that the least recently used files are removed when the directory
+        grows beyond its maximum size
+        """
+        cache = DiskCache(self.directory, max_size=25)
+        cache.set('bucket', 'first.json', '"1"', b'1' * 10)
+        cache.set('bucket', 'second.json', '"2"', b'2' * 10)
+
+        # Make the first object the most recently used
+        old = os.path.getmtime(cache._path('bucket', 'second.json', '"2"'))
+        os.utime(cache._path('bucket', 'second.json', '"2"'), (old - 10, old - 10))
+        cache.get('bucket', 'first.json', '"1"')
+
+        cache.set('bucket', 'third.json', '"3"', b'3' * 10)
+
+        self.assertIsNotNone(cache.get('bucket', 'first.json', '"1"'))
+        self.assertIsNone(cache.get('bucket', 'second.json', '"2"'))
+        self.assertIsNotNone(cache.get('bucket', 'third.json', '"3"'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_corrupt_objects_are_removed(self):
+        """
+        Test that a file that cannot be decompressed is treated as a miss
+        """
+        cache = DiskCache(self.directory, max_size=1024, compression='zlib')
+        path = cache._path('bucket', 'library.json', '"etag"')
+        with open(path, 'wb') as cached_file:
+            cached_file.write(b'not zlib')
+
+        self.assertIsNone(cache.get('bucket', 'library.json', '"etag"'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_unknown_compression(self):
+        """
+        Test that an unknown compression is rejected
+        """
+        with self.assertRaises(ValueError):
+            DiskCache(self.directory, max_size=1024, compression='lzma')
@@ -0,0 +1,367 @@
+"""
+Test the HTTP client, its circuit breakers, and the coalescing of identical
+calls
+"""
+
+import threading
+
+from flask import Flask
+from unittest import TestCase
+from httmock import HTTMock, urlmatch
+from requests.exceptions import ConnectTimeout, Timeout
+from harbour.client import Client, CircuitBreaker, CircuitOpenError, \
+    SingleFlight
+
+
+@urlmatch(netloc=r'mirror\.com')
+def mirror_down(url, request):
+    raise ConnectTimeout('timed out')
+
+
+@urlmatch(netloc=r'mirror\.com')
+def mirror_up(url, request):
+    return {
+        'status_code': 200,
+        'content': {'authorization': request.headers.get('Authorization')}
+    }
+
+
+class TestCircuitBreaker(TestCase):
+    """
+    Test the transitions of the circuit breaker
+    """
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker(
+            failures=2, window=10, reset_timeout=30, timer=lambda: self.now
+        )
+
+    def test_opens_after_failures_within_the_window(self):
+        """
+        Test that only failures within the window open the breaker
+        """
+        self.breaker.failure()
+        self.now = 11
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_half_open_probe(self):
+        """
+        Test that a single probe is let through once the breaker resets
+        """
+        self.breaker.failure()
+        self.breaker.failure()
+
+        self.now = 30
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+        # A failed probe opens it again
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        # A successful probe closes it
+        self.now = 60
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.stats()['recent_failures'], 0)
+
+    def test_interrupted_probe_is_released(self):
+        """
+        Test that a probe interrupted by a BaseException, e.g., GeneratorExit,
+        lets the next request probe rather than leaving the breaker half-open
+        """
+        client = Client({
+            'ADS_CLASSIC_MIRROR_LIST': ['mirror.com'],
+            'HARBOUR_CIRCUIT_BREAKER_FAILURES': 1
+        })
+        breaker = client.breaker('mirror.com')
+        breaker.failure()
+        breaker.opened -= breaker.reset_timeout
+
+        @urlmatch(netloc=r'mirror\.com')
+        def interrupted(url, request):
+            raise GeneratorExit()
+
+        with HTTMock(interrupted):
+            with self.assertRaises(GeneratorExit):
+                client.get('http://mirror.com/cookie=1')
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        with HTTMock(mirror_up):
+            response = client.get('http://mirror.com/cookie=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+def flaky_mirror(responses):
+    """
+    Mirror that gives the responses in order, an exception being raised
+    """
+    calls = []
+
+    @urlmatch(netloc=r'mirror\.com')
+    def mirror(url, request):
+        calls.append(request.method)
+        response = responses[min(len(calls), len(responses)) - 1]
+        if isinstance(response, Exception):
+            raise response
+        return {'status_code': response, 'content': 'body'}
+
+    return mirror, calls
+
+
+class TestClient(TestCase):
+    """
+    Test the requests to the ADS Classic mirrors
+    """
+
+    def setUp(self):
+        self.client = Client({
+            'ADS_CLASSIC_MIRROR_LIST': ['mirror.com'],
+            'HARBOUR_CIRCUIT_BREAKER_FAILURES': 2,
+            'HARBOUR_CIRCUIT_BREAKER_WINDOW': 60,
+            'HARBOUR_CIRCUIT_BREAKER_RESET_TIMEOUT': 30
+        })
+        self.client.session.headers['Authorization'] = 'Bearer token'
+
+    def test_mirrors_fail_fast(self):
+        """
+        Test that requests to a mirror fail fast once it timed out
+        """
+        with HTTMock(mirror_down):
+            for _ in range(2):
+                with self.assertRaises(ConnectTimeout):
+                    self.client.get('http://mirror.com/cookie=1')
+            with self.assertRaises(CircuitOpenError):
+                self.client.get('http://mirror.com/cookie=1')
+
+        self.assertEqual(
+            self.client.stats()['mirror.com']['state'],
+            CircuitBreaker.OPEN
+        )
+
+    def test_idempotent_requests_are_retried(self):
+        """
+        Test that GET requests are retried within the retries of the policy
+        """
+        self.client.policies = {'libraries': {'retries': 2, 'backoff': 1}}
+        self.client.breaker_options['failures'] = 0
+        delays = []
+        self.client.sleep = delays.append
+
+        mirror, calls = flaky_mirror([ConnectTimeout('timed out'), 503, 200])
+        with HTTMock(mirror):
+            response = self.client.get(
+                'http://mirror.com/cookie=1', policy='libraries'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0 <= delays[0] <= 1 and 0 <= delays[1] <= 2)
+
+        # Until the retries run out
+        mirror, calls = flaky_mirror([503])
+        with HTTMock(mirror):
+            response = self.client.get(
+                'http://mirror.com/cookie=1', policy='libraries'
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(calls), 3)
+
+        # POST requests are not retried
+        mirror, calls = flaky_mirror([ConnectTimeout('timed out'), 200])
+        with HTTMock(mirror):
+            with self.assertRaises(ConnectTimeout):
+                self.client.post(
+                    'http://mirror.com/cookie=1', policy='libraries'
+                )
+        self.assertEqual(calls, ['POST'])
+
+    def test_retries_stop_at_the_deadline(self):
+        """
+        Test that no retry starts after the deadline of the policy
+        """
+        self.client.policies = {
+            'libraries': {'retries': 5, 'backoff': 10, 'deadline': 0.01}
+        }
+        self.client.backoff = lambda policy, attempt: 10
+
+        mirror, calls = flaky_mirror([ConnectTimeout('timed out')])
+        with HTTMock(mirror):
+            with self.assertRaises(Timeout):
+                self.client.get('http://mirror.com/cookie=1', policy='libraries')
+        self.assertEqual(len(calls), 1)
+
+    def test_policy(self):
+        """
+        Test that the settings of a policy fall back to the default policy
+        """
+        self.client.policies = {
+            'default': {'read_timeout': 10},
+            'libraries': {'retries': 2}
+        }
+        policy = self.client.policy('libraries')
+        self.assertEqual(policy['read_timeout'], 10)
+        self.assertEqual(policy['retries'], 2)
+        self.assertEqual(policy['connect_timeout'], 5)
+        self.assertEqual(self.client.policy('unknown')['retries'], 0)
+
+    def test_requests_outside_of_a_request_context(self):
+        """
+        Test that requests can be made without a request context, e.g., from
+        a background thread, with the service token if there is one
+        """
+        @urlmatch(netloc=r'api\.com')
+        def api(url, request):
+            return {
+                'status_code': 200,
+                'content': {'authorization': request.headers.get('Authorization')}
+            }
+
+        with HTTMock(api):
+            response = self.client.get('http://api.com/search')
+            self.assertEqual(response.json(), {'authorization': None})
+
+            self.client.config['SERVICE_TOKEN'] = 'Bearer service'
+            response = self.client.get('http://api.com/search')
+            self.assertEqual(response.json(), {'authorization': 'Bearer service'})
+
+    def test_mirrors_are_not_given_the_authorization(self):
+        """
+        Test that the authorization header of the API is not sent to mirrors,
+        neither the one of the user nor the service token
+        """
+        self.client.config['SERVICE_TOKEN'] = 'Bearer service'
+        headers = {'X-Forwarded-Authorization': 'Bearer user'}
+        with Flask(__name__).test_request_context(headers=headers):
+            with HTTMock(mirror_up):
+                response = self.client.get('http://mirror.com/cookie=1')
+
+        self.assertEqual(response.json(), {'authorization': None})
+        self.assertEqual(
+            self.client.stats()['mirror.com']['state'],
+            CircuitBreaker.CLOSED
+        )
+
+
+class TestSingleFlight(TestCase):
+    """
+    Test that concurrent calls with the same key share one call
+    """
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def call_in_threads(self, function, number=4):
+        """
+        Call function with the same key from several threads, while the
+        first call is blocked
+        """
+        results = []
+
+        def blocked():
+            self.calls.append(1)
+            self.release.wait(5)
+            return function()
+
+        def run():
+            try:
+                results.append(self.flight.do('key', blocked))
+            except BaseException as error:
+                results.append(error)
+
+        threads = [threading.Thread(target=run) for _ in range(number)]
+        for thread in threads:
+            thread.start()
+        while self.flight.stats()['shared'] < number - 1:
+            threading.Event().wait(0.01)
+
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_calls_are_shared(self):
+        """
+        Test that one call is made, and that its result is shared
+        """
+        results = self.call_in_threads(lambda: 'result')
+
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(
+            self.flight.stats(),
+            {'calls': 1, 'shared': 3, 'in_flight': 0}
+        )
+
+        # Later calls are made again
+        self.assertEqual(self.flight.do('key', lambda: 'again'), 'again')
+
+    def test_exceptions_are_shared(self):
+        """
+        Test that the exception of the call is raised in every thread
+        """
+        def fail():
+            raise IOError('timed out')
+
+        results = self.call_in_threads(fail)
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(isinstance(result, IOError) for result in results))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_interrupted_calls_are_made_again(self):
+        """
+        Test that a call interrupted without an outcome, e.g., by
+        GeneratorExit, is made again by one of the threads that waited for
+        it, rather than giving them None
+        """
+        outcomes = [GeneratorExit(), 'result']
+
+        def interrupted():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, BaseException):
+                raise outcome
+            # The two other threads wait for the call made again
+            while self.flight.stats()['shared'] < 5:
+                threading.Event().wait(0.01)
+            return outcome
+
+        results = self.call_in_threads(interrupted)
+
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(
+            [result for result in results if result == 'result'],
+            ['result'] * 3
+        )
+        self.assertTrue(any(
+            isinstance(result, GeneratorExit) for result in results
+        ))
+
+    def test_a_call_lands_once(self):
+        """
+        Test that a call led with join is landed by its first land only, so
+        that it can be landed again in clean up code
+        """
+        leader, flight = self.flight.join('key')
+        self.assertTrue(leader)
+        self.assertEqual(self.flight.join('key'), (False, flight))
+
+        self.flight.land('key', flight, result='result')
+        self.flight.land('key', flight, outcome=False)
+
+        self.assertEqual(self.flight.wait(flight), (True, 'result'))
+        self.assertEqual(self.flight.stats()['in_flight'], 0)
+        self.assertTrue(self.flight.join('key')[0])
@@ -0,0 +1,82 @@
+"""
+Test the generation of the export archives
+"""
+
+from io import BytesIO
+from zipfile import ZipFile
+from unittest import TestCase
+from harbour.export import stream_zip, stream_library_archive, stream_batches
+
+
+class TestExport(TestCase):
+    """
+    Test the streamed .zip archives of the libraries
+    """
+
+    def test_stream_zip(self):
+        """
+        Test that the archive is sent in several parts that form a valid .zip
+        """
+        parts = list(stream_zip([
+            ('first.bib', [b'a' * 10, b'b' * 10]),
+            ('second.bib', [])
+        ]))
+        self.assertGreater(len(parts), 1)
+
+        zip_file = ZipFile(BytesIO(b''.join(parts)))
+        self.assertEqual(zip_file.read('first.bib'), b'a' * 10 + b'b' * 10)
+        self.assertEqual(zip_file.read('second.bib'), b'')
+
+    def test_library_archive(self):
+        """
+        Test that every library gets a uniquely named .bib file, with the
+        tags of its documents as keywords
+        """
+        libraries = [
+            {
+                'name': 'Name',
+                'documents': {
+                    '2015MNRAS.446.4239E': {'tags': ['tag1', 'tag2'], 'notes': []}
+                }
+            },
+            {'name': 'Name', 'documents': ['2015A&C....10...61E']},
+            {'name': 'a/b', 'documents': []}
+        ]
+
+        zip_file = ZipFile(BytesIO(b''.join(stream_library_archive(libraries))))
+        self.assertEqual(
+            zip_file.namelist(),
+            ['Name.bib', 'Name (2).bib', 'a_b.bib']
+        )
+        self.assertIn(b'keywords = {tag1, tag2}', zip_file.read('Name.bib'))
+        self.assertIn(b'@MISC{2015A&C....10...61E', zip_file.read('Name (2).bib'))
+
+    def test_stream_batches(self):
+        """
+        Test that the results of the batches are generated in order, with a
+        bounded number of batches in flight
+        """
+        in_flight = []
+
+        def function(batch):
+            in_flight.append(batch)
+            return sum(batch)
+
+        stream = stream_batches(function, list(range(100)), batch_size=10, workers=2)
+        self.assertEqual(next(stream), sum(range(10)))
+        self.assertLessEqual(len(in_flight), 4)
+
+        self.assertEqual(
+            [sum(range(0, 10))] + list(stream),
+            [sum(range(start, start + 10)) for start in range(0, 100, 10)]
+        )
+
+    def test_stream_batches_errors(self):
+        """
+        Test that an error of a batch is raised to the consumer
+        """
+        def function(batch):
+            raise ValueError('Export service failed')
+
+        with self.assertRaises(ValueError):
+            list(stream_batches(function, [1, 2, 3], batch_size=2, workers=2))
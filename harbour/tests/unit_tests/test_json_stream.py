@@ -0,0 +1,92 @@
+"""
+Test the incremental JSON reader
+"""
+
+import json
+
+from unittest import TestCase
+from harbour.json_stream import JSONStream
+
+
+def chunked(document, size):
+    """
+    Split a document in chunks of bytes
+    """
+    data = json.dumps(document).encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestJSONStream(TestCase):
+    """
+    Test that documents are read the same whatever their chunks
+    """
+    document = {
+        'count': 12345,
+        'libraries': [
+            {'name': 'Café', 'entries': [{'bibcode': 'a', 'n': [1.5, None]}]},
+            {'name': 'Empty', 'entries': [], 'extra': {}}
+        ],
+        'ok': True
+    }
+
+    def read(self, stream):
+        """
+        Rebuild a document by walking it
+        """
+        character = stream._peek()
+        if character == '{':
+            return {key: self.read(stream) for key in stream.iter_object()}
+        if character == '[':
+            return [self.read(stream) for _ in stream.iter_array()]
+        return stream.value()
+
+    def test_read_in_chunks(self):
+        """
+        Test that values split across chunks, including multi-byte
+        characters and numbers, are read in full
+        """
+        for size in [1, 2, 3, 7, 1024]:
+            stream = JSONStream(chunked(self.document, size))
+            self.assertEqual(self.read(stream), self.document)
+
+    def test_long_value(self):
+        """
+        Test that a long value is decoded again a logarithmic number of
+        times, rather than after every chunk
+        """
+        value = {'bibcode': 'a' * 10000}
+        stream = JSONStream(chunked(value, 1))
+        decoder = stream.decoder
+        decoded = []
+
+        class CountingDecoder(object):
+            def raw_decode(self, *args):
+                decoded.append(args)
+                return decoder.raw_decode(*args)
+
+        stream.decoder = CountingDecoder()
+        self.assertEqual(stream.value(), value)
+        self.assertLess(len(decoded), 20)
+
+    def test_skip(self):
+        """
+        Test that skipped values are consumed
+        """
+        stream = JSONStream(chunked(self.document, 5))
+        keys = []
+        for key in stream.iter_object():
+            keys.append(key)
+            if key == 'ok':
+                self.assertIs(stream.value(), True)
+            else:
+                stream.skip()
+        self.assertEqual(keys, ['count', 'libraries', 'ok'])
+
+    def test_malformed(self):
+        """
+        Test that documents that are not valid JSON raise a ValueError
+        """
+        for document in [b'{"libraries": [1, 2', b'{"a" 1}', b'[1 2]', b'']:
+            stream = JSONStream([document])
+            with self.assertRaises(ValueError):
+                self.read(stream)
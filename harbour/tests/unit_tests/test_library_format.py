@@ -0,0 +1,88 @@
+"""
+Test the binary format of the ADS 2.0 library dumps
+"""
+
+import json
+
+from unittest import TestCase
+from harbour.library_format import encode_libraries, decode_libraries, \
+    is_binary_library, source_etag
+
+
+class TestLibraryFormat(TestCase):
+    """
+    Test the conversion of the MongoDB dumps to the binary format and back
+    """
+    stub_libraries = [
+        {
+            'name': 'First',
+            'description': 'Description',
+            'documents': ['2015MNRAS.446.4239E', '2015A&C....10...61E']
+        },
+        {
+            'name': 'Second',
+            'description': 'Description',
+            'documents': ['2015A&C....10...61E']
+        },
+        {
+            'name': 'Empty',
+            'description': '',
+            'documents': []
+        }
+    ]
+
+    def test_round_trip(self):
+        """
+        Test that decoding gives back the original libraries
+        """
+        data = encode_libraries(self.stub_libraries)
+
+        self.assertTrue(is_binary_library(data))
+        self.assertEqual(decode_libraries(data), self.stub_libraries)
+
+    def test_source_etag(self):
+        """
+        Test that the ETag of the JSON dump is kept in the converted file
+        """
+        data = encode_libraries(self.stub_libraries, etag='"etag"')
+
+        self.assertEqual(source_etag(data), '"etag"')
+        self.assertEqual(decode_libraries(data), self.stub_libraries)
+        self.assertEqual(source_etag(encode_libraries([])), '')
+
+    def test_bibcodes_are_shared(self):
+        """
+        Test that a bibcode in several libraries is decoded to one string
+        """
+        libraries = decode_libraries(encode_libraries(self.stub_libraries))
+
+        self.assertIs(
+            libraries[0]['documents'][1],
+            libraries[1]['documents'][0]
+        )
+
+    def test_unexpected_documents_are_kept(self):
+        """
+        Test that libraries whose documents are not a list of bibcodes are
+        kept as they are
+        """
+        libraries = [
+            {'name': 'Missing'},
+            {'name': 'Other', 'documents': [{'bibcode': '2015A&C....10...61E'}]}
+        ]
+
+        self.assertEqual(
+            decode_libraries(encode_libraries(libraries)),
+            libraries
+        )
+
+    def test_json_is_not_a_binary_library(self):
+        """
+        Test that a JSON dump is rejected by the decoder
+        """
+        data = json.dumps(self.stub_libraries).encode('utf-8')
+
+        self.assertFalse(is_binary_library(data))
+        self.assertIsNone(source_etag(data))
+        with self.assertRaises(ValueError):
+            decode_libraries(data)
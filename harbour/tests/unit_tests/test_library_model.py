@@ -0,0 +1,93 @@
+"""
+Test the compact in-memory representation of the libraries
+"""
+
+import json
+
+from unittest import TestCase
+from harbour.library_model import BibcodeList, Library, compact_libraries, \
+    libraries_size, to_json_value
+
+
+class TestLibraryModel(TestCase):
+    """
+    Test that the compact libraries behave like the parsed JSON
+    """
+    stub_libraries = [
+        {
+            'name': 'First',
+            'description': 'Description',
+            'documents': ['2015MNRAS.446.4239E', '2015A&C....10...61E'],
+            'public': True
+        },
+        {
+            'name': 'Short bibcodes',
+            'documents': ['2015MNRAS', '2015A&C....10...61E']
+        },
+        {
+            'name': 'Tags',
+            'description': '',
+            'documents': {'2015MNRAS.446.4239E': {'tags': ['a'], 'notes': []}}
+        }
+    ]
+
+    def test_bibcode_list(self):
+        """
+        Test that a list of bibcodes can be indexed, sliced and compared
+        """
+        bibcodes = ['2015MNRAS.446.4239E', '2015A&C....10...61E']
+        packed = BibcodeList(bibcodes)
+        strings = BibcodeList(['2015MNRAS'] + bibcodes)
+
+        self.assertEqual(packed, bibcodes)
+        self.assertEqual(len(packed), 2)
+        self.assertEqual(packed[-1], '2015A&C....10...61E')
+        self.assertEqual(packed[1:], ['2015A&C....10...61E'])
+        self.assertEqual(list(packed), bibcodes)
+        self.assertEqual(strings[0], '2015MNRAS')
+        self.assertNotEqual(packed, strings)
+        with self.assertRaises(IndexError):
+            packed[2]
+
+    def test_bibcode_list_from_generator(self):
+        """
+        Test that bibcodes read from a generator are packed, unless one of
+        them does not fit the records
+        """
+        bibcodes = ['2015MNRAS.446.4239E', '2015A&C....10...61E', '2015MNRAS']
+
+        self.assertEqual(BibcodeList(b for b in bibcodes[:2]), bibcodes[:2])
+        self.assertIsNotNone(BibcodeList(b for b in bibcodes[:2])._packed)
+
+        strings = BibcodeList(b for b in bibcodes)
+        self.assertIsNone(strings._packed)
+        self.assertEqual(strings, bibcodes)
+
+    def test_library(self):
+        """
+        Test that a library has the keys of the parsed JSON
+        """
+        libraries = compact_libraries(self.stub_libraries)
+
+        for library, expected in zip(libraries, self.stub_libraries):
+            self.assertIsInstance(library, Library)
+            self.assertEqual(dict(library), expected)
+            self.assertEqual(sorted(library), sorted(expected))
+
+        self.assertIsInstance(libraries[0]['documents'], BibcodeList)
+        self.assertNotIn('description', libraries[1])
+        self.assertEqual(libraries[1].get('description', ''), '')
+        self.assertGreater(libraries_size(libraries), 0)
+
+    def test_serialisation(self):
+        """
+        Test that the compact libraries serialise to the same JSON
+        """
+        libraries = compact_libraries(self.stub_libraries)
+
+        self.assertEqual(
+            json.dumps(libraries, default=to_json_value),
+            json.dumps(self.stub_libraries)
+        )
+        with self.assertRaises(TypeError):
+            json.dumps(object(), default=to_json_value)
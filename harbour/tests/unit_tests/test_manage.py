@@ -2,9 +2,14 @@
 Tests the methods within the flask-script file manage.py
 """
 
+import json
+import boto3
+
+from moto import mock_s3
 from harbour.tests.unit_tests.base import TestBaseDatabase
-from harbour.manage import CreateDatabase
+from harbour.manage import CreateDatabase, ConvertLibraries
 from harbour.models import Base, Users
+from harbour.library_format import decode_libraries, source_etag
 from sqlalchemy import create_engine
 
 
@@ -30,3 +35,45 @@ class TestManagePy(TestBaseDatabase):
 
         # Clean up the tables
         Base.metadata.drop_all(bind=engine)
+
+    @mock_s3
+    def test_convert_libraries(self):
+        """
+        Tests the ConvertLibraries action. Every JSON object of the bucket
+        should get a binary copy that can be read instead.
+        """
+        stub_mongogut_library = [
+            {
+                'name': 'Name',
+                'description': 'Description',
+                'documents': ['2015MNRAS.446.4239E', '2015A&C....10...61E']
+            }
+        ]
+
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps({'user@ads.com': 'library.json'})
+        )
+        bucket.put_object(
+            Key='library.json',
+            Body=json.dumps(stub_mongogut_library)
+        )
+
+        ConvertLibraries.run(app=self.app, processes=1)
+
+        keys = sorted(s3_object.key for s3_object in bucket.objects.all())
+        self.assertEqual(
+            keys,
+            ['library.bin', 'library.json', 'users.idx', 'users.json']
+        )
+
+        library = s3_resource.Object('adsabs-mongogut', 'library.bin')\
+            .get()['Body'].read()
+        self.assertEqual(decode_libraries(library), stub_mongogut_library)
+        self.assertEqual(
+            source_etag(library),
+            s3_resource.Object('adsabs-mongogut', 'library.json').e_tag
+        )
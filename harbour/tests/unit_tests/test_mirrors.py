@@ -0,0 +1,98 @@
+"""
+Test the health and latency summaries of the ADS Classic mirrors
+"""
+
+import requests
+
+from unittest import TestCase
+from httmock import HTTMock, urlmatch
+from requests.exceptions import ConnectTimeout
+from harbour.mirrors import MirrorHealth, percentile, probe_mirror
+
+
+@urlmatch(netloc=r'up\.mirror\.com')
+def mirror_up(url, request):
+    return {'status_code': 200, 'content': 'ADS'}
+
+
+@urlmatch(netloc=r'down\.mirror\.com')
+def mirror_down(url, request):
+    raise ConnectTimeout('timed out')
+
+
+class StubApp(object):
+    """
+    The parts of the application used by the probes
+    """
+    config = {'ADS_CLASSIC_URL': 'http://{mirror}'}
+
+
+class TestMirrorHealth(TestCase):
+    """
+    Test the rolling summaries of the probes
+    """
+
+    def setUp(self):
+        self.health = MirrorHealth(
+            ['a.com', 'b.com'], window=3, routing=['b.com', 'c.com'],
+            timer=lambda: 100
+        )
+
+    def test_percentile(self):
+        """
+        Test the nearest-rank percentiles
+        """
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([3, 1, 2], 0.5), 2)
+        self.assertEqual(percentile(list(range(101)), 0.9), 90)
+
+    def test_summary(self):
+        """
+        Test that only the last probes are summarised
+        """
+        for latency in [5, 0.1, 0.2, 0.3]:
+            self.health.record('a.com', latency)
+        self.health.record('a.com', 10, error='HTTP 502')
+
+        summary = self.health.summary('a.com')
+        self.assertFalse(summary['healthy'])
+        self.assertEqual(summary['probes'], 3)
+        self.assertAlmostEqual(summary['success_rate'], 2 / 3.)
+        self.assertAlmostEqual(summary['latency_ms']['p99'], 300)
+        self.assertEqual(summary['last_error'], 'HTTP 502')
+        self.assertEqual(summary['last_probe'], 100)
+
+        self.assertEqual(
+            [summary['mirror'] for summary in self.health.status()],
+            ['a.com', 'b.com']
+        )
+        self.assertEqual(self.health.probed, ['a.com', 'b.com', 'c.com'])
+        self.assertEqual(self.health.summary('c.com')['probes'], 0)
+
+    def test_fastest(self):
+        """
+        Test that the fastest healthy mirror is chosen
+        """
+        self.assertIsNone(self.health.fastest(['a.com', 'b.com']))
+
+        self.health.record('a.com', 0.1)
+        self.health.record('a.com', 0.1, error='timed out')
+        self.health.record('b.com', 0.5)
+        self.health.record('c.com', 0.2)
+
+        self.assertEqual(self.health.fastest(['a.com', 'b.com']), 'b.com')
+        self.assertEqual(self.health.fastest(['b.com', 'c.com']), 'c.com')
+        self.assertEqual(self.health.fastest(['other.com', 'b.com']), 'b.com')
+
+    def test_probe_mirror(self):
+        """
+        Test the outcome of the probes
+        """
+        session = requests.Session()
+        with HTTMock(mirror_up, mirror_down):
+            latency, error = probe_mirror(StubApp, session, 'up.mirror.com')
+            self.assertIsNone(error)
+            self.assertGreaterEqual(latency, 0)
+
+            latency, error = probe_mirror(StubApp, session, 'down.mirror.com')
+            self.assertIn('ConnectTimeout', error)
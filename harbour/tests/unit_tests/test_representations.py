@@ -0,0 +1,64 @@
+"""
+Test the output representations of the resources
+"""
+
+import json
+import mock
+
+from unittest import TestCase
+from flask import Flask
+from flask_restful import Api, Resource
+from harbour import representations
+from harbour.representations import get_encoder, make_json_representation
+
+
+class Libraries(Resource):
+    def get(self):
+        return {'libraries': [{'name': 'Nämé', 'documents': []}]}, 200, \
+            {'ETag': '"etag"'}
+
+
+class TestRepresentations(TestCase):
+    """
+    Test the JSON representation and the choice of encoder
+    """
+
+    def helper_client(self, name):
+        """
+        Test client of an application with the given JSON encoder
+        """
+        app = Flask(__name__)
+        api = Api(app)
+        api.representation('application/json')(make_json_representation(name))
+        api.add_resource(Libraries, '/libraries')
+        return app.test_client()
+
+    def test_every_encoder_gives_the_same_data(self):
+        """
+        Test that the response is the same whichever encoder is used
+        """
+        for name, encoder in representations.ENCODERS:
+            r = self.helper_client(name).get('/libraries')
+
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.mimetype, 'application/json')
+            self.assertEqual(r.headers['ETag'], '"etag"')
+            self.assertEqual(
+                json.loads(r.get_data()),
+                {'libraries': [{'name': 'Nämé', 'documents': []}]}
+            )
+
+    def test_falls_back_to_the_stdlib(self):
+        """
+        Test that the stdlib encoder is used when no fast encoder is installed
+        """
+        with mock.patch.object(
+                representations,
+                'ENCODERS',
+                [('orjson', None), ('ujson', None),
+                 ('json', representations.stdlib_dumps)]):
+            self.assertEqual(get_encoder('auto')[0], 'json')
+            self.assertEqual(get_encoder('orjson')[0], 'json')
+
+        with self.assertRaises(ValueError):
+            get_encoder('pickle')
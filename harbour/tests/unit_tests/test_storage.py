@@ -0,0 +1,139 @@
+"""
+Test the storage backends of the ADS 2.0 data
+"""
+
+import boto3
+import shutil
+import tempfile
+
+from unittest import TestCase
+from moto import mock_s3
+from harbour.storage import create_storage, S3Storage, LocalStorage, \
+    NotFound, NotModified
+
+
+class StorageTests(object):
+    """
+    Tests that every storage backend should pass
+    """
+
+    def test_get_and_head(self):
+        """
+        Test that an object is read with its ETag
+        """
+        self.storage.put('library.json', b'[]')
+
+        data, etag = self.storage.get('library.json')
+        self.assertEqual(data, b'[]')
+        self.assertEqual(self.storage.head('library.json'), etag)
+
+    def test_conditional_get(self):
+        """
+        Test that an object that did not change is not read again
+        """
+        self.storage.put('library.json', b'[]')
+        data, etag = self.storage.get('library.json')
+
+        with self.assertRaises(NotModified):
+            self.storage.get('library.json', if_none_match=etag)
+        with self.assertRaises(NotModified):
+            self.storage.stream('library.json', 1, if_none_match=etag)
+
+        self.assertEqual(
+            self.storage.get('library.json', if_none_match='"other"')[0],
+            b'[]'
+        )
+
+    def test_missing_object(self):
+        """
+        Test that reading an object that does not exist raises NotFound
+        """
+        with self.assertRaises(NotFound):
+            self.storage.get('missing.json')
+        with self.assertRaises(NotFound):
+            self.storage.head('missing.json')
+
+    def test_stream(self):
+        """
+        Test that an object is read in chunks
+        """
+        self.storage.put('library.json', b'["2015A&C....10...61E"]')
+
+        etag, chunks = self.storage.stream('library.json', 4)
+        chunks = list(chunks)
+        self.assertEqual(len(chunks[0]), 4)
+        self.assertEqual(b''.join(chunks), b'["2015A&C....10...61E"]')
+        self.assertEqual(etag, self.storage.head('library.json'))
+
+    def test_keys_and_presign(self):
+        """
+        Test that the objects are listed, and that URLs are given for them
+        """
+        self.storage.put('users.json', b'{}')
+        self.storage.put('library.zotero.zip', b'')
+
+        self.assertEqual(
+            sorted(self.storage.keys()),
+            ['library.zotero.zip', 'users.json']
+        )
+        self.assertIn(
+            'library.zotero.zip',
+            self.storage.presign('library.zotero.zip', 60)
+        )
+
+
+class TestS3Storage(StorageTests, TestCase):
+    """
+    Test the storage in an S3 bucket
+    """
+
+    def setUp(self):
+        """
+        Create the bucket
+        """
+        self.mock = mock_s3()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+
+        boto3.resource('s3').create_bucket(Bucket='adsabs-mongogut')
+        self.storage = create_storage({
+            'HARBOUR_STORAGE_BACKEND': 's3',
+            'ADS_TWO_POINT_OH_S3_MONGO_BUCKET': 'adsabs-mongogut'
+        })
+        self.assertIsInstance(self.storage, S3Storage)
+
+
+class TestLocalStorage(StorageTests, TestCase):
+    """
+    Test the storage in a local directory
+    """
+
+    def setUp(self):
+        """
+        Create the directory
+        """
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.storage = create_storage({
+            'HARBOUR_STORAGE_BACKEND': 'local',
+            'HARBOUR_STORAGE_LOCAL_DIR': self.directory
+        })
+        self.assertIsInstance(self.storage, LocalStorage)
+
+    def test_files_outside_the_directory_are_not_read(self):
+        """
+        Test that a key cannot refer to a file outside the directory
+        """
+        with self.assertRaises(NotFound):
+            self.storage.get('../outside.json')
+
+    def test_presign_with_a_base_url(self):
+        """
+        Test that the URL is under the base URL the directory is served from
+        """
+        storage = LocalStorage(self.directory, base_url='https://exports/')
+        self.assertEqual(
+            storage.presign('library.zotero.zip', 60),
+            'https://exports/library.zotero.zip'
+        )
@@ -0,0 +1,93 @@
+"""
+Test the memory-mapped index of ADS 2.0 users
+"""
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+from harbour.user_index import UserIndex, build_user_index
+
+
+class TestUserIndex(TestCase):
+    """
+    Test building and searching the users index
+    """
+
+    def setUp(self):
+        """
+        Create a temporary directory for the index
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'users.idx')
+        self.users = {
+            'user@ads.com': 'cb16a523-cdba-406b-bfff-edfd428248be.json',
+            'another@ads.com': '2f1dcba4-5b13-4b53-a7d2-8e4be29fa1f3.json',
+            'ünïcode@ads.com': '8a0f2a8e-6c8b-4f8c-9d3a-0b2b1f1e6c7d.json'
+        }
+
+    def tearDown(self):
+        """
+        Remove the temporary directory
+        """
+        shutil.rmtree(self.directory)
+
+    def test_index_behaves_like_the_users_dictionary(self):
+        """
+        Test that every user can be looked up in the index, and that unknown
+        users return the default
+        """
+        build_user_index(self.users, self.path, etag='"etag"')
+        index = UserIndex(self.path)
+
+        self.assertEqual(len(index), len(self.users))
+        for email, library_file_name in self.users.items():
+            self.assertEqual(index.get(email), library_file_name)
+            self.assertEqual(index[email], library_file_name)
+            self.assertIn(email, index)
+
+        self.assertIsNone(index.get('nobody@ads.com'))
+        self.assertIsNone(index.get(None))
+        self.assertEqual(index.get('', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            index['nobody@ads.com']
+
+        index.close()
+
+    def test_empty_index(self):
+        """
+        Test that an index without users can be searched
+        """
+        build_user_index({}, self.path)
+        index = UserIndex(self.path)
+
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.get('user@ads.com'))
+
+        index.close()
+
+    def test_open_if_current_checks_the_etag(self):
+        """
+        Test that an index is only reused when it was built from the same
+        users.json
+        """
+        self.assertIsNone(UserIndex.open_if_current(self.path, '"etag"'))
+
+        build_user_index(self.users, self.path, etag='"etag"')
+        self.assertIsNone(UserIndex.open_if_current(self.path, '"changed"'))
+
+        index = UserIndex.open_if_current(self.path, '"etag"')
+        self.assertEqual(index.etag, '"etag"')
+        index.close()
+
+    def test_not_an_index(self):
+        """
+        Test that a file that is not an index is rejected
+        """
+        with open(self.path, 'wb') as index_file:
+            index_file.write(b'{"user@ads.com": "library.json"}')
+
+        with self.assertRaises(ValueError):
+            UserIndex(self.path)
+        self.assertIsNone(UserIndex.open_if_current(self.path, ''))
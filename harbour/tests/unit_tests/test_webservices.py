@@ -4,25 +4,37 @@ Test webservices
 """
 
 import mock
+import gzip
 import json
+import time
 import boto3
+import shutil
+import tempfile
 import unittest
+import threading
 
 from moto import mock_s3
 from flask import url_for
 
 from harbour.models import Users
+from harbour.client import CircuitOpenError
+from harbour.views import ClassicLibraries
+from harbour.library_format import encode_libraries
+from harbour.export import BIBTEX_INCOMPLETE
+from harbour.utils import binary_key, content_etag
+from harbour.storage import LocalStorage
 from harbour.http_errors import CLASSIC_AUTH_FAILED, CLASSIC_DATA_MALFORMED, \
     CLASSIC_TIMEOUT, CLASSIC_BAD_MIRROR, CLASSIC_NO_COOKIE, \
     CLASSIC_UNKNOWN_ERROR, NO_CLASSIC_ACCOUNT, NO_TWOPOINTOH_LIBRARIES, \
     NO_TWOPOINTOH_ACCOUNT, TWOPOINTOH_AWS_PROBLEM, EXPORT_SERVICE_FAIL, \
-    TWOPOINTOH_WRONG_EXPORT_TYPE
+    TWOPOINTOH_WRONG_EXPORT_TYPE, LIBRARY_BAD_PARAMETERS, WRONG_EXPORT_SOURCE, \
+    CLASSIC_UNAVAILABLE
 from harbour.tests.unit_tests.base import TestBaseDatabase
 from harbour.tests.unit_tests.stub_response import ads_classic_200, ads_classic_unknown_user, \
     ads_classic_wrong_password, ads_classic_no_cookie, ads_classic_fail, \
     ads_classic_libraries_200, export_success, export_success_no_keyword, \
-    ads_classic_myads_200
-from httmock import HTTMock
+    ads_classic_myads_200, export_bibtex_success, export_bibtex_fail
+from httmock import HTTMock, urlmatch
 from zipfile import ZipFile
 from io import BytesIO
 from requests.exceptions import Timeout
@@ -94,6 +106,25 @@ class TestAllowedMirrors(TestBaseDatabase):
         self.assertStatus(r, 200)
         self.assertListEqual(r.json, self.app.config['ADS_CLASSIC_MIRROR_LIST'])
 
+    def test_user_retrieves_the_status_of_the_mirrors(self):
+        """
+        Tests that the health of the mirrors is returned with status=1
+        """
+        self.app.mirror_health.record('mirror.com', 0.25)
+        self.app.mirror_health.record('other.mirror.com', 5, error='timed out')
+
+        r = self.client.get(url_for('allowedmirrors'), query_string={'status': 1})
+
+        self.assertStatus(r, 200)
+        self.assertEqual(
+            [mirror['mirror'] for mirror in r.json],
+            self.app.config['ADS_CLASSIC_MIRROR_LIST']
+        )
+        self.assertTrue(r.json[0]['healthy'])
+        self.assertEqual(r.json[0]['latency_ms']['p50'], 250)
+        self.assertFalse(r.json[1]['healthy'])
+        self.assertEqual(r.json[1]['last_error'], 'timed out')
+
 
 class TestAuthenticateUserClassic(TestBaseDatabase):
     """
@@ -646,6 +677,311 @@ class TestADSTwoPointOhLibraries(TestBaseDatabase):
             self.assertStatus(r, 200)
             self.assertEqual(r.json['libraries'], stub_get_libraries['libraries'])
 
+    @mock_s3
+    def test_get_libraries_end_point_binary_format(self):
+        """
+        Test that the copy converted to the binary format is used while it
+        was converted from the current library file, and the JSON is read
+        once the library file changes
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.app.config['ADS_TWO_POINT_OH_BINARY_FORMAT'] = True
+
+        library_file_name = 'cb16a523-cdba-406b-bfff-edfd428248be.json'
+        s3_resource = boto3.resource('s3')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        etag = s3_resource.Object('adsabs-mongogut', library_file_name).e_tag
+        converted = [{'name': 'Converted', 'documents': ['2015MNRAS.446.4239E']}]
+        bucket.put_object(
+            Key=binary_key(library_file_name),
+            Body=encode_libraries(converted, etag=etag)
+        )
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('twopointohlibraries', uid=10)
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['libraries'], converted)
+            self.assertEqual(r.headers['ETag'], etag)
+
+            # The converted copy is now out of date
+            library = [{'name': 'Changed', 'documents': []}]
+            bucket.put_object(Key=library_file_name, Body=json.dumps(library))
+
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['libraries'], library)
+
+    @mock_s3
+    def test_get_libraries_end_point_streams_when_pass_through(self):
+        """
+        Test that the ADS 2.0 libraries are streamed straight from S3 when the
+        pass-through mode is enabled
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.app.config['ADS_TWO_POINT_OH_STREAM_LIBRARIES'] = True
+        self.app.config['ADS_TWO_POINT_OH_STREAM_CHUNK_SIZE'] = 16
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('twopointohlibraries', uid=10)
+            with mock.patch(
+                'harbour.views.TwoPointOhLibraries.fetch_s3_library'
+            ) as fetch_s3_library:
+                r = self.client.get(url)
+
+            self.assertStatus(r, 200)
+            # The dump was streamed, not read in full and parsed
+            fetch_s3_library.assert_not_called()
+            self.assertEqual(r.json['libraries'][0]['name'], 'Name')
+            self.assertEqual(len(r.json['libraries'][0]['documents']), 4)
+
+    @mock_s3
+    def test_get_libraries_end_point_uses_the_library_cache(self):
+        """
+        Test that repeat requests for the same ADS 2.0 libraries are served
+        from the library cache
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('twopointohlibraries', uid=10)
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+
+            # Revalidated with S3, which reports that nothing changed
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['libraries'][0]['name'], 'Name')
+
+            # Not revalidated, so S3 is not contacted at all
+            self.app.config['ADS_TWO_POINT_OH_LIBRARY_CACHE_VALIDATE'] = False
+            with mock.patch('harbour.client.S3Client.client',
+                            new_callable=mock.PropertyMock) as mocked_client:
+                r = self.client.get(url)
+                self.assertFalse(mocked_client.called)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['libraries'][0]['name'], 'Name')
+
+            stats = self.app.library_cache.stats()
+            self.assertEqual(stats['entries'], 1)
+            self.assertEqual(stats['hits'], 2)
+            self.assertEqual(stats['misses'], 1)
+
+            r = self.client.get(url_for('statistics'))
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['caches']['libraries']['hits'], 2)
+
+    @mock_s3
+    def test_get_libraries_end_point_returns_304_when_not_modified(self):
+        """
+        Test that the ETag of the S3 object is returned, and that a client
+        sending it back gets a 304 without the libraries
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('twopointohlibraries', uid=10)
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            etag = r.headers['ETag']
+
+            r = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertStatus(r, 304)
+            self.assertEqual(r.headers['ETag'], etag)
+            self.assertEqual(r.get_data(), b'')
+
+            # Without the library cache, S3 answers the conditional request
+            self.app.library_cache.clear()
+            r = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertStatus(r, 304)
+
+            self.app.config['ADS_TWO_POINT_OH_STREAM_LIBRARIES'] = True
+            r = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertStatus(r, 304)
+
+            r = self.client.get(url, headers={'If-None-Match': '"other"'})
+            self.assertStatus(r, 200)
+            self.assertEqual(r.headers['ETag'], etag)
+
+    def test_get_libraries_end_point_from_a_local_directory(self):
+        """
+        Test that the ADS 2.0 libraries can be served from the local storage
+        backend, without S3
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.storage = LocalStorage(directory)
+        self.app.storage.put(
+            'cb16a523-cdba-406b-bfff-edfd428248be.json',
+            json.dumps([{'name': 'Name', 'documents': []}]).encode('utf-8')
+        )
+        self.app.config['ADS_TWO_POINT_OH_USERS'] = {
+            'user@ads.com': 'cb16a523-cdba-406b-bfff-edfd428248be.json'
+        }
+        self.app.users_ready.set()
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('twopointohlibraries', uid=10)
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['libraries'][0]['name'], 'Name')
+
+            r = self.client.get(url, headers={'If-None-Match': r.headers['ETag']})
+            self.assertStatus(r, 304)
+
+    @mock_s3
+    def test_get_libraries_end_point_compresses_the_libraries(self):
+        """
+        Test that the libraries are compressed for clients that accept it, and
+        that the compressed content is reused for the same ETag
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.app.config['HARBOUR_COMPRESSION_ENCODINGS'] = ['gzip']
+        self.app.config['HARBOUR_COMPRESSION_MIN_SIZE'] = 10
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('twopointohlibraries', uid=10)
+            headers = {'Accept-Encoding': 'gzip'}
+
+            r = self.client.get(url, headers=headers)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', r.headers['Vary'])
+            self.assertEqual(
+                json.loads(gzip.decompress(r.get_data()))['libraries'][0]['name'],
+                'Name'
+            )
+            etag = r.headers['ETag']
+
+            r = self.client.get(url, headers=headers)
+            self.assertStatus(r, 200)
+            self.assertEqual(self.app.compression_cache.stats()['hits'], 1)
+
+            self.assertTrue(etag.startswith('W/'))
+            # The compressed content is cached by the strong ETag
+            self.assertIn(
+                ('twopointohlibraries', etag[3:-1], 'gzip'),
+                self.app.compression_cache
+            )
+
+            headers['If-None-Match'] = etag
+            r = self.client.get(url, headers=headers)
+            self.assertStatus(r, 304)
+            self.assertEqual(r.headers['ETag'], etag)
+
+            # The uncompressed copy, with the strong ETag, matches too
+            r = self.client.get(url, headers={'If-None-Match': etag[2:]})
+            self.assertStatus(r, 304)
+            self.assertEqual(r.headers['ETag'], etag[2:])
+
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            self.assertNotIn('Content-Encoding', r.headers)
+            self.assertEqual(r.json['libraries'][0]['name'], 'Name')
+
+    @mock_s3
+    def test_get_libraries_end_point_with_parameters(self):
+        """
+        Test that the libraries can be paginated, filtered by field or
+        summarised, also when they would otherwise be streamed
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.app.config['ADS_TWO_POINT_OH_STREAM_LIBRARIES'] = True
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('twopointohlibraries', uid=10)
+
+            with mock.patch(
+                'harbour.views.TwoPointOhLibraries.stream_s3_library'
+            ) as stream_s3_library:
+                r = self.client.get(url, query_string={'summary': 'true'})
+            self.assertStatus(r, 200)
+            # The dump was parsed to be summarised, not streamed as it is
+            stream_s3_library.assert_not_called()
+            self.assertEqual(
+                r.json['libraries'],
+                [{'name': 'Name', 'num_documents': 4}]
+            )
+            etag = r.headers['ETag']
+
+            r = self.client.get(
+                url,
+                query_string={'summary': 'true'},
+                headers={'If-None-Match': etag}
+            )
+            self.assertStatus(r, 304)
+
+            r = self.client.get(url, query_string={'fields': 'name,description'})
+            self.assertStatus(r, 200)
+            self.assertEqual(
+                r.json['libraries'],
+                [{'name': 'Name', 'description': 'Description'}]
+            )
+            self.assertNotEqual(r.headers['ETag'], etag)
+
+            r = self.client.get(url, query_string={'offset': 1, 'limit': 10})
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['libraries'], [])
+
+    def test_get_libraries_end_point_with_wrong_parameters(self):
+        """
+        Test that a wrong offset, limit or fields gives a 400
+        """
+        url = url_for('twopointohlibraries', uid=10)
+        for query_string in [{'offset': 'a'}, {'limit': -1}, {'fields': 'cookie'}]:
+            r = self.client.get(url, query_string=query_string)
+            self.assertStatus(r, LIBRARY_BAD_PARAMETERS['code'])
+            self.assertEqual(r.json['error'], LIBRARY_BAD_PARAMETERS['message'])
+
     def test_get_libraries_end_point_when_no_user(self):
         """
         Test when this user does not have any libraries
@@ -700,12 +1036,12 @@ class TestADSTwoPointOhLibraries(TestBaseDatabase):
         self.assertStatus(r, NO_TWOPOINTOH_ACCOUNT['code'])
         self.assertEqual(r.json['error'], NO_TWOPOINTOH_ACCOUNT['message'])
 
-    @mock.patch('harbour.app.boto3.resource')
-    def test_get_libraries_end_point_when_aws_s3_error(self, mock_resource):
+    @mock.patch('harbour.client.S3Client.client', new_callable=mock.PropertyMock)
+    def test_get_libraries_end_point_when_aws_s3_error(self, mock_client):
         """
         Test when this user has not associated any ADS 2.0 (classic) account
         """
-        mock_resource.side_effect = Exception('Custom Error')
+        mock_client.side_effect = Exception('Custom Error')
 
         user = Users(
             absolute_uid=10,
@@ -725,8 +1061,8 @@ class TestADSTwoPointOhLibraries(TestBaseDatabase):
         """
         Test when this user has not got an associated ADS 2.0 (classic) account
         """
-        self.assertTrue(self.app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
-        self.app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = False
+        self.assertTrue(self.app.users_ready.is_set())
+        self.app.users_ready.clear()
 
         url = url_for('twopointohlibraries', uid=10)
         r = self.client.get(url)
@@ -735,6 +1071,87 @@ class TestADSTwoPointOhLibraries(TestBaseDatabase):
         self.assertEqual(r.json['error'], TWOPOINTOH_AWS_PROBLEM['message'])
 
 
+class TestADSTwoPointOhLibrariesBatch(TestBaseDatabase):
+    """
+    Tests the end point that returns the ADS 2.0 libraries of many users
+    """
+
+    @mock_s3
+    def create_app(self):
+        """
+        Create the wsgi application
+        """
+        # Setup S3 mock data
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+        # Setup the app
+        app_ = super(TestADSTwoPointOhLibrariesBatch, self).create_app()
+
+        return app_
+
+    @mock_s3
+    def test_get_libraries_of_many_users(self):
+        """
+        Test that the libraries of every user are returned, one line per user,
+        with an error for the users that have none
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+        with self.app.session_scope() as session:
+            session.add(Users(absolute_uid=10, twopointoh_email='user@ads.com'))
+            session.add(Users(absolute_uid=11, twopointoh_email='user@ads.com'))
+            session.add(Users(absolute_uid=12, twopointoh_email='nobody@ads.com'))
+            session.add(Users(absolute_uid=13, classic_email='user@ads.com'))
+            session.commit()
+
+            url = url_for('twopointohlibrariesbatch')
+            r = self.client.post(url, data=json.dumps({'uids': [10, 11, 12, 13, 14]}))
+
+            self.assertStatus(r, 200)
+            self.assertEqual(r.mimetype, 'application/x-ndjson')
+            results = {
+                result['uid']: result
+                for result in map(json.loads, r.get_data(as_text=True).splitlines())
+            }
+
+        self.assertEqual(sorted(results), [10, 11, 12, 13, 14])
+        for uid in [10, 11]:
+            self.assertEqual(results[uid]['libraries'][0]['name'], 'Name')
+        self.assertEqual(results[12]['code'], NO_TWOPOINTOH_LIBRARIES['code'])
+        self.assertEqual(results[12]['error'], NO_TWOPOINTOH_LIBRARIES['message'])
+        for uid in [13, 14]:
+            self.assertEqual(results[uid]['code'], NO_TWOPOINTOH_ACCOUNT['code'])
+            self.assertEqual(results[uid]['error'], NO_TWOPOINTOH_ACCOUNT['message'])
+
+    @mock.patch('harbour.client.S3Client.client', new_callable=mock.PropertyMock)
+    def test_get_libraries_of_many_users_when_aws_s3_error(self, mock_client):
+        """
+        Test that an S3 failure is reported for the users it affects
+        """
+        mock_client.side_effect = Exception('Custom Error')
+
+        with self.app.session_scope() as session:
+            session.add(Users(absolute_uid=10, twopointoh_email='user@ads.com'))
+            session.commit()
+
+            url = url_for('twopointohlibrariesbatch')
+            r = self.client.post(url, data=json.dumps({'uids': [10]}))
+
+            self.assertStatus(r, 200)
+            result = json.loads(r.get_data(as_text=True))
+            self.assertEqual(result['uid'], 10)
+            self.assertEqual(result['code'], TWOPOINTOH_AWS_PROBLEM['code'])
+
+    def test_get_libraries_of_many_users_with_malformed_data(self):
+        """
+        Test that the uids must be a list of integers
+        """
+        url = url_for('twopointohlibrariesbatch')
+        for data in [{}, {'uids': 10}, {'uids': ['ten']}]:
+            r = self.client.post(url, data=json.dumps(data))
+            self.assertStatus(r, CLASSIC_DATA_MALFORMED['code'])
+
+
 class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
     """
     Tests the end point that facilitates the export of libraries from ADS 2.0
@@ -802,6 +1219,12 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
         #     Body=zip_io.getvalue()
         # )
 
+        # An export that was already generated
+        bucket.put_object(
+            Key='cb16a523-cdba-406b-bfff-edfd428248be.zotero.zip',
+            Body=b''
+        )
+
     @mock_s3
     def create_app(self):
         """
@@ -912,12 +1335,12 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
             self.assertNotIn('tag1', zip_content['Name2.bib'],)
             self.assertNotIn('notes =', zip_content['Name2.bib'])
 
-    @mock.patch('harbour.views.boto3.client')
-    def test_get_export_end_point_when_aws_s3_error(self, mock_resource):
+    @mock.patch('harbour.client.S3Client.client', new_callable=mock.PropertyMock)
+    def test_get_export_end_point_when_aws_s3_error(self, mock_client):
         """
         Test when there is an issue loading/accessing S3 storage
         """
-        mock_resource.side_effect = Exception('Custom Error')
+        mock_client.side_effect = Exception('Custom Error')
 
         user = Users(
             absolute_uid=10,
@@ -937,8 +1360,8 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
         """
         Test when this user has not got an associated ADS 2.0 (classic) account
         """
-        self.assertTrue(self.app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
-        self.app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = False
+        self.assertTrue(self.app.users_ready.is_set())
+        self.app.users_ready.clear()
 
         url = url_for('exporttwopointohlibraries', export='zotero')
         r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
@@ -984,45 +1407,418 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
                 r.json['url'],
             )
 
-
-class TestClassicLibraries(TestBaseDatabase):
-    """
-    Tests the libraries end point that returns the libraries from ADS classic
-    that belong to a user
-    """
-    def test_get_libraries_end_point(self):
+    @mock_s3
+    def test_missing_export_is_generated(self):
         """
-        Test the workflow of successfully retrieving a set of classic libraries
+        The user should receive the export as a download when it has not been
+        generated yet, and a temporary url once it has been stored
         """
-        stub_get_libraries = {
-            'libraries': [
+        TestExportADSTwoPointOhLibraries.helper_s3_mock_setup()
+        bucket = boto3.resource('s3').Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='cb16a523-cdba-406b-bfff-edfd428248be.json',
+            Body=json.dumps([
                 {
                     'name': 'Name',
                     'description': 'Description',
-                    'documents': [
-                        '2015MNRAS.446.4239E', '2015A&C....10...61E',
-                        '2014A&A...562A.100E', '2013A&A...556A..23E'
-                    ]
+                    'documents': {
+                        '2015MNRAS.446.4239E': {
+                            'tags': ['tag1', 'tag2'],
+                            'notes': ['note1', 'note2']
+                        }
+                    }
+                },
+                {
+                    'name': 'Name2',
+                    'description': 'Description2',
+                    'documents': ['2015A&C....10...61E']
                 }
-            ]
-        }
+            ])
+        )
 
-        # 1. The user is identified via header information
-        # - Generate dummy user in database
-        # - Give the header the correct information
         user = Users(
             absolute_uid=10,
-            classic_cookie='ef9df8ds',
-            classic_mirror='mirror.com',
-            classic_email='user@ads.com'
+            twopointoh_email='user@ads.com'
         )
         with self.app.session_scope() as session:
             session.add(user)
             session.commit()
 
-            # 2. The database is checked to see if the user exists, and the cookie
-            # retrieved
-            #  3. The ADS Classic end point is contacted, returning a 200, and the
+            url = url_for('exporttwopointohlibraries', export='mendeley')
+            r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            self.assertStatus(r, 200)
+            self.assertEqual(
+                r.headers['Content-Disposition'],
+                'attachment; filename=user_mendeley.zip'
+            )
+            archive = r.get_data()
+
+            zip_file = ZipFile(BytesIO(archive))
+            self.assertEqual(zip_file.namelist(), ['Name.bib', 'Name2.bib'])
+            self.assertIn(b'tag1, tag2', zip_file.read('Name.bib'))
+            self.assertIn(b'2015A&C....10...61E', zip_file.read('Name2.bib'))
+
+            # The archive is stored under a key of its own, not as the export
+            stored = bucket.Object(
+                'cb16a523-cdba-406b-bfff-edfd428248be.mendeley.generated.zip'
+            ).get()['Body'].read()
+            self.assertEqual(stored, archive)
+            keys = [s3_object.key for s3_object in bucket.objects.all()]
+            self.assertNotIn(
+                'cb16a523-cdba-406b-bfff-edfd428248be.mendeley.zip', keys
+            )
+
+            r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            self.assertStatus(r, 200)
+            self.assertIn('mendeley.generated.zip', r.json['url'])
+
+            # Once the export exists, it is used instead
+            bucket.put_object(
+                Key='cb16a523-cdba-406b-bfff-edfd428248be.mendeley.zip',
+                Body=b'export'
+            )
+            self.app.export_exists_cache.clear()
+            r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            self.assertStatus(r, 200)
+            self.assertIn('mendeley.zip', r.json['url'])
+            self.assertNotIn('generated', r.json['url'])
+
+    @mock_s3
+    def test_concurrent_generations_of_an_export_are_coalesced(self):
+        """
+        Concurrent requests for an export that has not been generated yet
+        share a single generation
+        """
+        TestExportADSTwoPointOhLibraries.helper_s3_mock_setup()
+        bucket = boto3.resource('s3').Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='cb16a523-cdba-406b-bfff-edfd428248be.json',
+            Body=json.dumps([{'name': 'Name', 'documents': []}])
+        )
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+        url = url_for('exporttwopointohlibraries', export='mendeley')
+        key = 'cb16a523-cdba-406b-bfff-edfd428248be.mendeley.generated.zip'
+
+        # The first request streams the archive as it is generated
+        leader = self.client.get(
+            url, headers={USER_ID_KEYWORD: 10}, buffered=False
+        )
+        self.assertStatus(leader, 200)
+        keys = [s3_object.key for s3_object in bucket.objects.all()]
+        self.assertNotIn(key, keys)
+
+        responses = []
+        follower = threading.Thread(target=lambda: responses.append(
+            self.client.get(url, headers={USER_ID_KEYWORD: 10})
+        ))
+        follower.start()
+        while self.app.single_flight.stats()['shared'] < 1:
+            time.sleep(0.01)
+        self.assertFalse(responses)
+
+        archive = leader.get_data()
+        leader.close()
+        follower.join()
+
+        # The second one waited for it to be stored, and got it from there
+        self.assertStatus(responses[0], 200)
+        self.assertEqual(responses[0].get_data(), archive)
+        self.assertEqual(bucket.Object(key).get()['Body'].read(), archive)
+        self.assertEqual(self.app.single_flight.stats()['in_flight'], 0)
+
+    @mock_s3
+    def test_export_is_generated_again_when_the_download_is_interrupted(self):
+        """
+        An archive is only stored when its download completes, and the next
+        request generates it again otherwise
+        """
+        TestExportADSTwoPointOhLibraries.helper_s3_mock_setup()
+        bucket = boto3.resource('s3').Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='cb16a523-cdba-406b-bfff-edfd428248be.json',
+            Body=json.dumps([{'name': 'Name', 'documents': []}])
+        )
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+        url = url_for('exporttwopointohlibraries', export='mendeley')
+        key = 'cb16a523-cdba-406b-bfff-edfd428248be.mendeley.generated.zip'
+
+        r = self.client.get(url, headers={USER_ID_KEYWORD: 10}, buffered=False)
+        self.assertStatus(r, 200)
+        next(iter(r.response))
+        r.close()
+
+        keys = [s3_object.key for s3_object in bucket.objects.all()]
+        self.assertNotIn(key, keys)
+        self.assertEqual(self.app.single_flight.stats()['in_flight'], 0)
+
+        r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+        self.assertStatus(r, 200)
+        self.assertEqual(
+            ZipFile(BytesIO(r.get_data())).namelist(), ['Name.bib']
+        )
+        self.assertEqual(bucket.Object(key).get()['Body'].read(), r.get_data())
+
+    @mock_s3
+    def test_temporary_url_is_reused_on_export(self):
+        """
+        The user should receive the same temporary url while it remains valid
+        for long enough, and be told how long it can be cached
+        """
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            TestExportADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+            url = url_for('exporttwopointohlibraries', export='zotero')
+            r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            self.assertStatus(r, 200)
+            self.assertIn('private', r.headers['Cache-Control'])
+            max_age = int(r.headers['Cache-Control'].split('max-age=')[1])
+            self.assertTrue(1790 < max_age <= 1800)
+            s3_presigned_url = r.json['url']
+
+            with mock.patch('harbour.views.time.time') as mocked_time, \
+                    mock.patch('harbour.client.S3Client.client',
+                               new_callable=mock.PropertyMock) as mocked_client:
+                mocked_time.return_value = self.app.export_url_cache.timer() + 600
+                r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+                self.assertFalse(mocked_client.called)
+
+            self.assertEqual(r.json['url'], s3_presigned_url)
+            max_age = int(r.headers['Cache-Control'].split('max-age=')[1])
+            self.assertTrue(1190 < max_age <= 1200)
+
+            # A url with less than half of its lifetime left is not reused
+            with mock.patch.object(self.app.export_url_cache, 'timer') as mocked_timer:
+                mocked_timer.return_value = time.time() + 901
+                with mock.patch.object(self.app.s3, 'generate_presigned_url',
+                                       create=True,
+                                       return_value='https://new.url') as mocked_sign:
+                    r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+                    self.assertTrue(mocked_sign.called)
+
+            self.assertEqual(r.json['url'], 'https://new.url')
+
+
+class TestExportBibTeX(TestBaseDatabase):
+    """
+    Tests the end point that exports the documents of all the libraries of a
+    user as BibTeX
+    """
+
+    @mock_s3
+    def create_app(self):
+        """
+        Create the wsgi application
+        """
+        # Setup S3 mock data
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+        # Setup the app
+        app_ = super(TestExportBibTeX, self).create_app()
+
+        return app_
+
+    def test_export_classic_libraries(self):
+        """
+        Test that the bibcodes of the classic libraries are exported in
+        batches, and returned in order
+        """
+        self.app.config['HARBOUR_EXPORT_BATCH_SIZE'] = 1
+        self.app.config['HARBOUR_EXPORT_WORKERS'] = 2
+
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('exportbibtex', source='classic')
+            with HTTMock(export_bibtex_success, ads_classic_libraries_200):
+                r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+                self.assertStatus(r, 200)
+                self.assertEqual(r.mimetype, 'application/x-bibtex')
+                bibtex = r.get_data(as_text=True)
+
+            self.assertEqual(
+                [line for line in bibtex.split('\n') if line.startswith('@')],
+                [
+                    '@ARTICLE{2015MNRAS.446.4239E,',
+                    '@ARTICLE{2015A&C....10...61E,',
+                    '@ARTICLE{2014A&A...562A.100E,',
+                    '@ARTICLE{2013A&A...556A..23E,'
+                ]
+            )
+
+    @mock_s3
+    def test_export_twopointoh_libraries(self):
+        """
+        Test that the bibcodes of the ADS 2.0 libraries are exported, also
+        when the users are loaded lazily by the export
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+        # As in a worker that has not loaded the users yet
+        self.app.config['ADS_TWO_POINT_OH_USERS_LOAD'] = 'lazy'
+        self.app.config['ADS_TWO_POINT_OH_USERS'] = {}
+        self.app.config['ADS_TWO_POINT_OH_USERS_ETAG'] = None
+        self.app.users_ready.clear()
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('exportbibtex', source='twopointoh')
+            with HTTMock(export_bibtex_success):
+                r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+                self.assertStatus(r, 200)
+                bibtex = r.get_data(as_text=True)
+
+            self.assertTrue(self.app.users_ready.is_set())
+            self.assertEqual(
+                [line for line in bibtex.split('\n') if line.startswith('@')],
+                [
+                    '@ARTICLE{2015MNRAS.446.4239E,',
+                    '@ARTICLE{2015A&C....10...61E,',
+                    '@ARTICLE{2014A&A...562A.100E,',
+                    '@ARTICLE{2013A&A...556A..23E,'
+                ]
+            )
+
+    def test_export_when_the_export_service_fails(self):
+        """
+        Test that a failure of the export service gives a 500
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('exportbibtex', source='classic')
+            with HTTMock(export_bibtex_fail, ads_classic_libraries_200):
+                r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+
+            self.assertStatus(r, EXPORT_SERVICE_FAIL['code'])
+            self.assertEqual(r.json['error'], EXPORT_SERVICE_FAIL['message'])
+
+    def test_export_when_the_export_service_fails_after_the_first_batch(self):
+        """
+        Test that a failure of the export service once the BibTeX is being
+        sent ends the file with a marker saying it is incomplete
+        """
+        self.app.config['HARBOUR_EXPORT_BATCH_SIZE'] = 1
+        self.app.config['HARBOUR_EXPORT_WORKERS'] = 1
+
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+        batches = []
+
+        @urlmatch(path=r'.*/export/bibtex$')
+        def export_bibtex_fails_later(url, request):
+            batches.append(request)
+            if len(batches) == 1:
+                return export_bibtex_success(url, request)
+            return export_bibtex_fail(url, request)
+
+        url = url_for('exportbibtex', source='classic')
+        with HTTMock(export_bibtex_fails_later, ads_classic_libraries_200):
+            r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            self.assertStatus(r, 200)
+            bibtex = r.get_data()
+
+        self.assertTrue(bibtex.startswith(b'@ARTICLE{2015MNRAS.446.4239E,'))
+        self.assertTrue(bibtex.endswith(BIBTEX_INCOMPLETE))
+
+    def test_export_from_an_unknown_source(self):
+        """
+        Test that only classic and ADS 2.0 libraries can be exported
+        """
+        url = url_for('exportbibtex', source='fudge')
+        r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+
+        self.assertStatus(r, WRONG_EXPORT_SOURCE['code'])
+        self.assertEqual(r.json['error'], WRONG_EXPORT_SOURCE['message'])
+
+
+class TestClassicLibraries(TestBaseDatabase):
+    """
+    Tests the libraries end point that returns the libraries from ADS classic
+    that belong to a user
+    """
+    def test_get_libraries_end_point(self):
+        """
+        Test the workflow of successfully retrieving a set of classic libraries
+        """
+        stub_get_libraries = {
+            'libraries': [
+                {
+                    'name': 'Name',
+                    'description': 'Description',
+                    'documents': [
+                        '2015MNRAS.446.4239E', '2015A&C....10...61E',
+                        '2014A&A...562A.100E', '2013A&A...556A..23E'
+                    ]
+                }
+            ]
+        }
+
+        # 1. The user is identified via header information
+        # - Generate dummy user in database
+        # - Give the header the correct information
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            # 2. The database is checked to see if the user exists, and the cookie
+            # retrieved
+            #  3. The ADS Classic end point is contacted, returning a 200, and the
             # content returned
             url = url_for('classiclibraries', uid=10)
             with HTTMock(ads_classic_libraries_200):
@@ -1030,6 +1826,152 @@ class TestClassicLibraries(TestBaseDatabase):
             self.assertStatus(r, 200)
             self.assertEqual(r.json['libraries'], stub_get_libraries['libraries'])
 
+    def test_mirrors_are_not_given_the_authorization_of_the_user(self):
+        """
+        Test that the bearer token of the user is not sent to the ADS Classic
+        mirror the libraries are requested from
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        authorizations = []
+
+        @urlmatch(netloc=r'mirror\.com')
+        def mirror(url, request):
+            authorizations.append(request.headers.get('Authorization'))
+            return ads_classic_libraries_200(url, request)
+
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('classiclibraries', uid=10)
+            with HTTMock(mirror):
+                r = self.client.get(url, headers={
+                    'X-Forwarded-Authorization': 'Bearer USER-SECRET'
+                })
+            self.assertStatus(r, 200)
+            self.assertEqual(authorizations, [None])
+
+    def test_get_libraries_end_point_returns_304_when_not_modified(self):
+        """
+        Test that the libraries carry an ETag computed from their content, and
+        that a client sending it back gets a 304 without the libraries
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('classiclibraries', uid=10)
+            with HTTMock(ads_classic_libraries_200):
+                r = self.client.get(url)
+                self.assertStatus(r, 200)
+                etag = r.headers['ETag']
+
+                r = self.client.get(url, headers={'If-None-Match': etag})
+                self.assertStatus(r, 304)
+                self.assertEqual(r.get_data(), b'')
+
+                r = self.client.get(url, headers={'If-None-Match': '"other"'})
+                self.assertStatus(r, 200)
+                self.assertEqual(r.headers['ETag'], etag)
+
+    def test_get_libraries_end_point_computes_the_etag_once(self):
+        """
+        Test that the ETag of the classic libraries is cached with them, and
+        not computed again on every request
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('classiclibraries', uid=10)
+            with mock.patch(
+                'harbour.views.content_etag', wraps=content_etag
+            ) as mocked_etag, HTTMock(ads_classic_libraries_200):
+                r = self.client.get(url)
+                etag = r.headers['ETag']
+                r = self.client.get(url)
+                self.assertEqual(r.headers['ETag'], etag)
+                r = self.client.get(url, headers={'If-None-Match': etag})
+                self.assertStatus(r, 304)
+
+            self.assertEqual(mocked_etag.call_count, 1)
+
+    def test_get_libraries_end_point_with_parameters(self):
+        """
+        Test that the classic libraries can be summarised
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('classiclibraries', uid=10)
+            with HTTMock(ads_classic_libraries_200):
+                r = self.client.get(
+                    url,
+                    query_string={'summary': '1', 'limit': 1}
+                )
+            self.assertStatus(r, 200)
+            self.assertEqual(
+                r.json['libraries'],
+                [{'name': 'Name', 'num_documents': 4}]
+            )
+
+    def test_get_libraries_end_point_falls_back_to_the_cache(self):
+        """
+        Test that stale libraries are returned while ADS Classic is contacted
+        in the background, and kept when it fails
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('classiclibraries', uid=10)
+            with HTTMock(ads_classic_libraries_200):
+                r = self.client.get(url)
+            self.assertStatus(r, 200)
+            libraries = r.json['libraries']
+
+            cache = self.app.classic_library_cache
+            cache.ttl = -1
+            with HTTMock(ads_classic_fail):
+                r = self.client.get(url)
+                for thread in list(cache.refreshing.values()):
+                    thread.join(5)
+
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['libraries'], libraries)
+            self.assertEqual(cache.stats()['stale_hits'], 1)
+            self.assertEqual(cache.stats()['refresh_failures'], 1)
+
     def test_get_libraries_when_the_user_does_not_exist(self):
         """
         Test that when a user does not exist within the database, that the
@@ -1087,6 +2029,30 @@ class TestClassicLibraries(TestBaseDatabase):
             self.assertStatus(r, CLASSIC_TIMEOUT['code'])
             self.assertEqual(r.json['error'], CLASSIC_TIMEOUT['message'])
 
+    @mock.patch('harbour.views.current_app.client.get')
+    def test_get_libraries_when_the_mirror_is_unavailable(self, mocked_get):
+        """
+        Test that the libraries end point fails fast when the circuit breaker
+        of the mirror is open
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            mocked_get.side_effect = CircuitOpenError
+
+            url = url_for('classiclibraries', uid=10)
+            r = self.client.get(url)
+
+            self.assertStatus(r, CLASSIC_UNAVAILABLE['code'])
+            self.assertEqual(r.json['error'], CLASSIC_UNAVAILABLE['message'])
+
     def test_get_libraries_when_ads_classic_returns_non_200(self):
         """
         Tests that the expected response is returned when ADS classic returns a
@@ -1109,6 +2075,70 @@ class TestClassicLibraries(TestBaseDatabase):
             self.assertStatus(r, CLASSIC_UNKNOWN_ERROR['code'])
             self.assertEqual(r.json['error'], CLASSIC_UNKNOWN_ERROR['message'])
 
+    def test_get_libraries_end_point_without_streaming(self):
+        """
+        Test that the libraries are the same when the ADS Classic response is
+        parsed as a whole
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            url = url_for('classiclibraries', uid=10)
+            with HTTMock(ads_classic_libraries_200):
+                r = self.client.get(url)
+                self.app.classic_library_cache.delete(('mirror.com', 'ef9df8ds'))
+                self.app.config['ADS_CLASSIC_LIBRARIES_STREAM'] = False
+                try:
+                    r_whole = self.client.get(url)
+                finally:
+                    self.app.config['ADS_CLASSIC_LIBRARIES_STREAM'] = True
+
+            self.assertStatus(r_whole, 200)
+            self.assertEqual(r_whole.json, r.json)
+
+    def test_parse_classic_libraries_in_chunks(self):
+        """
+        Test that the libraries are parsed one chunk at a time, keeping only
+        their name, description and bibcodes
+        """
+        data = json.dumps({
+            'libraries': [
+                {
+                    'name': 'Name',
+                    'desc': 'Description',
+                    'entries': [
+                        {'bibcode': '2015MNRAS.446.4239E', 'note': 'x' * 50},
+                        {'bibcode': '2015A&C....10...61E', 'tags': ['a']}
+                    ],
+                    'public': True
+                },
+                {'name': 'No description', 'entries': []}
+            ],
+            'user': {'email': 'user@ads.com'}
+        }).encode('utf-8')
+        chunks = (data[i:i + 7] for i in range(0, len(data), 7))
+
+        libraries = ClassicLibraries.parse_classic_libraries(chunks)
+
+        self.assertEqual([dict(library) for library in libraries], [
+            {
+                'name': 'Name',
+                'description': 'Description',
+                'documents': ['2015MNRAS.446.4239E', '2015A&C....10...61E']
+            },
+            {'name': 'No description', 'description': '', 'documents': []}
+        ])
+
+        with self.assertRaises(ValueError):
+            list(ClassicLibraries.parse_classic_libraries([data[:-10]]))
+
 class TestClassicMyADS(TestBaseDatabase):
     """
     Tests the myADS end point that returns the myADS settings from ADS classic
@@ -1144,3 +2174,36 @@ class TestClassicMyADS(TestBaseDatabase):
 
             self.assertStatus(r, 200)
             self.assertEqual(r.json, stub_get_myads)
+
+    @mock.patch('harbour.views.current_app.client.get')
+    def test_get_myads_from_the_fastest_mirror(self, mocked_get):
+        """
+        Test that myADS is requested from the fastest healthy mirror
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        with self.app.session_scope() as session:
+            session.add(user)
+            session.commit()
+
+            self.app.config['ADS_CLASSIC_MYADS_MIRRORS'] = \
+                ['mirror.com', 'other.mirror.com']
+            self.app.mirror_health.record('mirror.com', 1)
+            self.app.mirror_health.record('other.mirror.com', 0.1)
+
+            mocked_get.return_value = mock.Mock(status_code=200)
+            mocked_get.return_value.json.return_value = {'id': 1}
+
+            r = self.client.get(url_for('classicmyads', uid=10))
+
+            self.assertStatus(r, 200)
+            self.assertEqual(
+                mocked_get.call_args[0][0],
+                self.app.config['ADS_CLASSIC_MYADS_URL'].format(
+                    mirror='other.mirror.com', email='user@ads.com'
+                )
+            )
@@ -0,0 +1,211 @@
+# encoding: utf-8
+"""
+Compact on-disk index of the ADS 2.0 users (e-mail -> library file name)
+
+The index is a flat file of sorted keys with a table of offsets, so that it
+can be memory-mapped by every worker on a host and searched with a binary
+search. The memory used by a worker does not grow with the number of users,
+as the pages are shared through the page cache.
+
+Layout (little-endian):
+    header:  magic (4s), version (H), count (Q), etag length (I)
+    etag:    <etag length> bytes
+    offsets: <count> x offset of the record (Q)
+    records: key length (H), value length (H), key, value
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import tempfile
+import contextlib
+
+MAGIC = b'HUIX'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHQI')
+OFFSET = struct.Struct('<Q')
+RECORD = struct.Struct('<HH')
+
+
+def build_user_index(users, path, etag=''):
+    """
+    Write the index for the given users to path. The file is written to a
+    temporary file first and renamed, so that readers never see a partial
+    index and workers that still map the old file are unaffected.
+
+    :param users: mapping of e-mail to library file name
+    :type users: dict
+    :param path: path of the index file
+    :type path: str
+    :param etag: ETag of the users.json the index was built from
+    :type etag: str
+    """
+    items = sorted(
+        (key.encode('utf-8'), value.encode('utf-8'))
+        for key, value in users.items()
+    )
+    etag = etag.encode('utf-8')
+
+    offsets = []
+    offset = HEADER.size + len(etag) + OFFSET.size * len(items)
+    for key, value in items:
+        offsets.append(offset)
+        offset += RECORD.size + len(key) + len(value)
+
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp'
+    )
+    try:
+        with os.fdopen(descriptor, 'wb') as index_file:
+            index_file.write(HEADER.pack(MAGIC, VERSION, len(items), len(etag)))
+            index_file.write(etag)
+            index_file.write(
+                struct.pack('<{}Q'.format(len(offsets)), *offsets)
+            )
+            for key, value in items:
+                index_file.write(RECORD.pack(len(key), len(value)))
+                index_file.write(key)
+                index_file.write(value)
+        os.rename(temporary_path, path)
+    except Exception:
+        os.remove(temporary_path)
+        raise
+
+
+@contextlib.contextmanager
+def index_lock(path):
+    """
+    Exclusive lock on the index at path, held on a <path>.lock file, so that
+    only one worker, or thread, of a host builds the index at a time
+
+    :param path: path of the index file
+    """
+    with open('{}.lock'.format(path), 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class UserIndex(object):
+    """
+    Read-only, memory-mapped view of an index written by build_user_index.
+    It behaves like the read-only part of a dict, so that it can be used in
+    place of the ADS_TWO_POINT_OH_USERS dictionary.
+    """
+    def __init__(self, path):
+        """
+        Constructor
+        :param path: path of the index file
+        """
+        with open(path, 'rb') as index_file:
+            self._mmap = mmap.mmap(
+                index_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+
+        magic, version, count, etag_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError('{} is not a user index'.format(path))
+
+        self.path = path
+        self.etag = self._mmap[HEADER.size:HEADER.size + etag_length]\
+            .decode('utf-8')
+        self._count = count
+        self._offsets = HEADER.size + etag_length
+
+    @classmethod
+    def open_if_current(cls, path, etag):
+        """
+        Open the index at path if it exists and was built from the users.json
+        with the given ETag
+
+        :param path: path of the index file
+        :param etag: ETag of the current users.json
+
+        :return: UserIndex or None
+        """
+        if not os.path.exists(path):
+            return None
+
+        try:
+            index = cls(path)
+        except ValueError:
+            return None
+
+        if index.etag != etag:
+            index.close()
+            return None
+
+        return index
+
+    def _key(self, position):
+        """
+        Key of the record at the given position
+        :param position: position of the record in the sorted index
+        :return: tuple of key (bytes) and offset of the record
+        """
+        offset = OFFSET.unpack_from(
+            self._mmap, self._offsets + position * OFFSET.size
+        )[0]
+        key_length = RECORD.unpack_from(self._mmap, offset)[0]
+        start = offset + RECORD.size
+        return self._mmap[start:start + key_length], offset
+
+    def _find(self, key):
+        """
+        Binary search for the record offset of key
+        :param key: e-mail of the user
+        :return: offset of the record or None
+        """
+        key = key.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, offset = self._key(middle)
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return offset
+        return None
+
+    def get(self, key, default=None):
+        """
+        Library file name of the user with the e-mail key
+        :param key: e-mail of the user
+        :param default: value returned if the user is not in the index
+        :return: str
+        """
+        if not isinstance(key, str):
+            return default
+
+        offset = self._find(key)
+        if offset is None:
+            return default
+
+        key_length, value_length = RECORD.unpack_from(self._mmap, offset)
+        start = offset + RECORD.size + key_length
+        return self._mmap[start:start + value_length].decode('utf-8')
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        """
+        Unmap the index
+        """
+        self._mmap.close()
@@ -4,6 +4,14 @@ for this module. But are also used in differing modules insidide the same
 project, and so do not belong to anything specific.
 """
 
+import re
+import json
+import hashlib
+
+from flask import Response
+from werkzeug.http import quote_etag, unquote_etag
+from harbour.library_model import to_json_value
+
 
 def get_post_data(request, types={}):
     """
@@ -41,3 +49,170 @@ def err(error_dictionary):
     :return: tuple of error message and error number
     """
     return {'error': error_dictionary['message']}, error_dictionary['code']
+
+
+def is_not_modified(error):
+    """
+    Checks if a botocore ClientError was raised because a conditional request
+    found that the object has not been modified
+    :param error: botocore.exceptions.ClientError
+    :return: boolean
+    """
+    return error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+
+def is_missing(error):
+    """
+    Checks if a botocore ClientError was raised because the object does not
+    exist
+    :param error: botocore.exceptions.ClientError
+    :return: boolean
+    """
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
+
+
+def binary_key(key):
+    """
+    Key of the object converted to the binary format (see manage.py convert)
+    :param key: key of the JSON object, e.g., <uuid>.json or users.json
+    :return: str
+    """
+    if key == 'users.json':
+        return 'users.idx'
+    return re.sub(r'\.json$', '.bin', key)
+
+
+def content_etag(data):
+    """
+    Strong ETag of JSON serialisable data, computed from its content
+    :param data: data that is returned to the client
+    :return: quoted ETag
+    """
+    content = json.dumps(
+        data, sort_keys=True, separators=(',', ':'), default=to_json_value
+    )
+    return quote_etag(hashlib.sha1(content.encode('utf-8')).hexdigest())
+
+
+def get_known_etag(request):
+    """
+    First ETag the client sent in If-None-Match, if any. Weak ETags, which
+    are given to compressed responses, are compared as their strong form.
+
+    :param request: flask.request
+    :return: quoted ETag or None
+    """
+    for etag in request.if_none_match:
+        return quote_etag(etag)
+    for etag in request.if_none_match.as_set(include_weak=True):
+        return quote_etag(etag)
+    return None
+
+
+def is_known_etag(request, etag):
+    """
+    Checks if the client already has the version of the response with etag
+    :param request: flask.request
+    :param etag: quoted ETag of the response
+    :return: boolean
+    """
+    return request.if_none_match.contains_weak(unquote_etag(etag)[0])
+
+
+def not_modified(etag):
+    """
+    Response telling the client that its copy is up to date
+    :param etag: quoted ETag of the response
+    :return: flask.Response
+    """
+    response = Response(status=304)
+    response.headers['ETag'] = etag
+    return response
+
+
+LIBRARY_FIELDS = ('name', 'description', 'documents')
+
+
+def get_library_view(args):
+    """
+    Parse the parameters that select part of a list of libraries:
+        offset: <int> index of the first library returned, default 0
+        limit: <int> maximum number of libraries returned, default all
+        fields: <string> comma-separated keys of each library returned,
+            any of name, description and documents
+        summary: <bool> return only the name and the number of documents of
+            each library
+
+    :param args: query string of the request, e.g., flask.request.args
+    :return: dict of the parameters, or None if none were given
+    :raises ValueError: if a parameter has the wrong value
+    """
+    if not any(name in args for name in ('offset', 'limit', 'fields', 'summary')):
+        return None
+
+    view = {
+        'offset': int(args.get('offset', 0)),
+        'limit': int(args['limit']) if 'limit' in args else None,
+        'fields': None,
+        'summary': args.get('summary', 'false').lower() in ('1', 'true')
+    }
+    if view['offset'] < 0 or (view['limit'] is not None and view['limit'] < 0):
+        raise ValueError('offset and limit must not be negative')
+
+    if 'fields' in args:
+        view['fields'] = [field for field in args['fields'].split(',') if field]
+        unknown = set(view['fields']) - set(LIBRARY_FIELDS)
+        if unknown:
+            raise ValueError('Unknown fields: {}'.format(', '.join(unknown)))
+
+    return view
+
+
+def select_libraries(libraries, view):
+    """
+    Part of a list of libraries selected by the parameters of
+    get_library_view
+    :param libraries: list of libraries
+    :param view: dict returned by get_library_view, or None for all
+
+    :return: list of libraries
+    """
+    if view is None:
+        return libraries
+
+    end = None if view['limit'] is None else view['offset'] + view['limit']
+    libraries = libraries[view['offset']:end]
+
+    if view['summary']:
+        return [
+            {
+                'name': library.get('name'),
+                'num_documents': len(library.get('documents') or [])
+            } for library in libraries
+        ]
+
+    if view['fields'] is not None:
+        return [
+            {field: library[field] for field in view['fields'] if field in library}
+            for library in libraries
+        ]
+
+    return libraries
+
+
+def view_etag(etag, view):
+    """
+    ETag of the part of a response selected by get_library_view, derived
+    from the ETag of the whole response
+    :param etag: quoted ETag of the whole response
+    :param view: dict returned by get_library_view, or None for all
+
+    :return: quoted ETag
+    """
+    if view is None:
+        return etag
+
+    content = '{}:{}'.format(
+        unquote_etag(etag)[0], json.dumps(view, sort_keys=True)
+    )
+    return quote_etag(hashlib.sha1(content.encode('utf-8')).hexdigest())
@@ -4,23 +4,37 @@ Views
 """
 import re
 import json
-import boto3
+import time
 import requests
+import tempfile
 import traceback
 
-from flask import current_app, request, send_file
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import current_app, request, send_file, Response
 from flask_restful import Resource
 from flask_discoverer import advertise
-from io import BytesIO
 from sqlalchemy.orm.exc import NoResultFound
 
-from harbour.utils import get_post_data, err
+from harbour.utils import get_post_data, err, binary_key, get_known_etag, \
+    is_known_etag, content_etag, not_modified, get_library_view, \
+    select_libraries, view_etag
+from harbour.client import CircuitOpenError
+from harbour.mirrors import myads_mirror
+from harbour.storage import NotFound, NotModified
+from harbour.library_format import decode_libraries, source_etag
+from harbour.json_stream import JSONStream
+from harbour.library_model import Library, BibcodeList, compact_libraries, \
+    libraries_size, to_json_value
+from harbour.export import stream_library_archive, library_documents, \
+    stream_batches, BIBTEX_INCOMPLETE
 from harbour.models import Users
 from harbour.http_errors import CLASSIC_AUTH_FAILED, CLASSIC_DATA_MALFORMED, \
     CLASSIC_TIMEOUT, CLASSIC_BAD_MIRROR, CLASSIC_NO_COOKIE, \
     CLASSIC_UNKNOWN_ERROR, NO_CLASSIC_ACCOUNT, NO_TWOPOINTOH_ACCOUNT, \
     NO_TWOPOINTOH_LIBRARIES, TWOPOINTOH_AWS_PROBLEM, EXPORT_SERVICE_FAIL, \
-    TWOPOINTOH_WRONG_EXPORT_TYPE
+    TWOPOINTOH_WRONG_EXPORT_TYPE, LIBRARY_BAD_PARAMETERS, WRONG_EXPORT_SOURCE, \
+    CLASSIC_UNAVAILABLE
 
 USER_ID_KEYWORD = 'X-Adsws-Uid'
 
@@ -112,6 +126,18 @@ class AllowedMirrors(BaseView):
         list[<string>]
         eg., list of mirrors, ['site1', 'site2', ...., 'siteN']
 
+        Optional parameters
+        -------------------
+        status: <bool> return the health of each mirror instead, from the
+            recent probes of the service:
+            mirror: <string> mirror site
+            healthy: <bool> whether the last probe succeeded
+            probes: <int> number of recent probes
+            success_rate: <float> fraction of the recent probes that succeeded
+            latency_ms: <dict> p50, p90 and p99 latency of the probes
+            last_probe: <float> time of the last probe
+            last_error: <string> error of the last probe, if it failed
+
 
         HTTP Responses:
         --------------
@@ -120,9 +146,76 @@ class AllowedMirrors(BaseView):
         Any other responses will be default Flask errors
         """
 
+        if request.args.get('status', '').lower() in ('1', 'true'):
+            return current_app.mirror_health.status()
+
         return current_app.config.get('ADS_CLASSIC_MIRROR_LIST', [])
 
 
+class Statistics(BaseView):
+    """
+    End point that returns internal statistics of the service, such as the
+    usage of its caches
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['adsws:internal']
+    rate_limit = [1000, 60*60*24]
+
+    def get(self):
+        """
+        HTTP GET request that returns the statistics of the service
+
+        Return data (on success)
+        ------------------------
+        caches: <dict> usage counters of each cache, by name:
+            entries: <int> number of entries
+            size: <int> total size of the entries in bytes
+            max_size: <int> maximum total size of the entries in bytes
+            ttl: <int> time to live of an entry in seconds
+            hits: <int> number of lookups that found a fresh entry
+            misses: <int> number of lookups that did not
+            evictions: <int> number of entries evicted to make space
+        The classic_libraries cache also has:
+            fresh_ttl: <int> seconds before an entry is refreshed
+            stale_hits: <int> number of lookups that found a stale entry
+            refreshes: <int> number of successful background refreshes
+            refresh_failures: <int> number of failed background refreshes
+            refreshing: <int> number of refreshes in progress
+        single_flight: <dict> usage counters of the coalesced calls:
+            calls: <int> number of calls made to ADS Classic or S3
+            shared: <int> number of requests that shared a call in flight
+            in_flight: <int> number of calls in flight
+        circuit_breakers: <dict> circuit breaker of each ADS Classic mirror
+            that was contacted, by host:
+            state: <string> closed, open or half-open
+            recent_failures: <int> number of failures within the window
+            opened: <float> time the breaker last opened, or null
+            rejected: <int> number of requests that failed fast
+
+        HTTP Responses:
+        --------------
+        Succeed getting statistics: 200
+
+        Any other responses will be default Flask errors
+        """
+        caches = {
+            'libraries': current_app.library_cache.stats(),
+            'export_urls': current_app.export_url_cache.stats(),
+            'compressed_responses': current_app.compression_cache.stats(),
+            'export_exists': current_app.export_exists_cache.stats(),
+            'classic_libraries': current_app.classic_library_cache.stats()
+        }
+        if current_app.object_cache is not None:
+            caches['objects'] = current_app.object_cache.stats()
+
+        return {
+            'caches': caches,
+            'single_flight': current_app.single_flight.stats(),
+            'circuit_breakers': current_app.client.stats()
+        }, 200
+
+
 class TwoPointOhLibraries(BaseView):
     """
     End point to collect the user's ADS 2.0 libraries with the MongoDB dump
@@ -147,19 +240,135 @@ class TwoPointOhLibraries(BaseView):
 
         :return: dict
         """
-        s3_resource = boto3.resource('s3')
-        bucket = s3_resource.Object(
-            current_app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
-            library_file_name
+        return TwoPointOhLibraries.fetch_s3_library(library_file_name)[1]
+
+    @staticmethod
+    def fetch_s3_library(library_file_name, known_etag=None):
+        """
+        Get the JSON MongoDB dump of the ADS 2.0 library of a specific user,
+        together with the ETag of its S3 object.
+
+        Parsed libraries are kept in the library cache, in their compact form
+        (see harbour.library_model), together with the ETag of their S3
+        object. With ADS_TWO_POINT_OH_LIBRARY_CACHE_VALIDATE, a
+        cached library is revalidated with a conditional GET, otherwise it is
+        used without contacting S3 until it expires. Libraries that are not in
+        the library cache are read through the shared disk cache, if enabled.
+        Concurrent reads of the same library share a single S3 GET.
+
+        :param library_file_name: name of library file
+        :type library_file_name: str
+        :param known_etag: ETag of a copy the client already has. If the
+            library has not changed since, it is not downloaded and None is
+            returned in its place.
+        :type known_etag: str
+
+        :return: tuple of ETag (str) and library (dict)
+        """
+        cached = current_app.library_cache.get(library_file_name)
+        if cached is not None and \
+                not current_app.config['ADS_TWO_POINT_OH_LIBRARY_CACHE_VALIDATE']:
+            return cached
+
+        etag = cached[0] if cached else known_etag
+
+        def read():
+            library, new_etag, _ = TwoPointOhLibraries.read_s3_library(
+                library_file_name,
+                if_none_match=etag
+            )
+            library = compact_libraries(library)
+            current_app.library_cache.set(
+                library_file_name,
+                (new_etag, library),
+                size=libraries_size(library)
+            )
+            return new_etag, library
+
+        try:
+            return current_app.single_flight.do(
+                ('s3', library_file_name, etag), read
+            )
+        except NotModified:
+            return cached if cached else (etag, None)
+
+    @staticmethod
+    def read_s3_library(library_file_name, if_none_match=None):
+        """
+        Download and parse the library file from S3. With
+        ADS_TWO_POINT_OH_BINARY_FORMAT, the copy converted to the binary format
+        is used when there is one, and it was converted from the current
+        library file.
+
+        :param library_file_name: name of library file
+        :type library_file_name: str
+        :param if_none_match: see harbour.storage.S3Storage.get
+
+        :return: tuple of library, ETag of the library file and size of the
+            file that was read
+        """
+        if current_app.config['ADS_TWO_POINT_OH_BINARY_FORMAT']:
+            etag = current_app.storage.head(library_file_name)
+            if if_none_match is not None and if_none_match == etag:
+                raise NotModified(library_file_name)
+
+            try:
+                library_data, _ = current_app.storage.get(
+                    binary_key(library_file_name)
+                )
+            except NotFound:
+                library_data = None
+
+            if library_data is not None:
+                if source_etag(library_data) == etag:
+                    return decode_libraries(library_data), etag, \
+                        len(library_data)
+                current_app.logger.warning(
+                    'Converted copy of {} is out of date, reading the JSON'
+                    .format(library_file_name)
+                )
+
+        library_data, etag = current_app.storage.get(
+            library_file_name,
+            if_none_match=if_none_match
         )
-        body = bucket.get()['Body']
-        library_data = BytesIO()
-        for chunk in iter(lambda: body.read(1024), b''):
-            library_data.write(chunk)
+        return json.loads(library_data), etag, len(library_data)
+
+    @staticmethod
+    def stream_s3_library(library_file_name, known_etag=None):
+        """
+        Stream the JSON MongoDB dump of the ADS 2.0 library of a specific user
+        straight from S3, wrapped in the libraries envelope. The content is
+        not parsed, so only one chunk is held in memory at any time.
+
+        :param library_file_name: name of library file
+        :type library_file_name: str
+        :param known_etag: ETag of a copy the client already has. If the
+            library has not changed since, None is returned in place of the
+            stream.
+        :type known_etag: str
+
+        :return: tuple of ETag (str) and generator of bytes
+        """
+        try:
+            etag, chunks = current_app.storage.stream(
+                library_file_name,
+                current_app.config['ADS_TWO_POINT_OH_STREAM_CHUNK_SIZE'],
+                if_none_match=known_etag
+            )
+        except NotModified:
+            return known_etag, None
 
-        library = json.loads(library_data.getvalue())
+        def generate():
+            try:
+                yield b'{"libraries": '
+                for chunk in chunks:
+                    yield chunk
+                yield b'}'
+            finally:
+                chunks.close()
 
-        return library
+        return etag, generate()
 
     def get(self, uid):
         """
@@ -176,17 +385,43 @@ class TwoPointOhLibraries(BaseView):
             description: <string> description of the library
             documents: <list<string>> list of documents
 
+        Optional parameters
+        -------------------
+        offset: <int> index of the first library returned, default 0
+        limit: <int> maximum number of libraries returned, default all
+        fields: <string> comma-separated keys of each library returned, from
+            name, description and documents
+        summary: <bool> return only the name and number of documents
+            (num_documents) of each library
+
+        When ADS_TWO_POINT_OH_STREAM_LIBRARIES is enabled, the MongoDB dump is
+        streamed to the client as-is instead of being parsed and re-serialised,
+        unless one of the parameters above is given.
+
+        The ETag of the response is the ETag of the S3 object, or is derived
+        from it when one of the parameters above is given.
+
         HTTP Responses:
         --------------
         Succeed getting libraries: 200
+        Libraries have not changed since the ETag in If-None-Match: 304
+        Wrong value of offset, limit, fields or summary: 400
         User does not have a classic/ADS 2.0 account: 400
         User does not have any libraries in their ADS 2.0 account: 400
         Unknown error: 500
 
         Any other responses will be default Flask errors
         """
+        try:
+            view = get_library_view(request.args)
+        except ValueError as error:
+            current_app.logger.warning(
+                'Wrong library parameters: {}'.format(error)
+            )
+            return err(LIBRARY_BAD_PARAMETERS)
+
         with current_app.session_scope() as session:
-            if not current_app.config['ADS_TWO_POINT_OH_LOADED_USERS']:
+            if not current_app.users_ready.is_set():
                 current_app.logger.error(
                     'Users from MongoDB have not been loaded into the app'
                 )
@@ -216,15 +451,192 @@ class TwoPointOhLibraries(BaseView):
                 )
                 return err(NO_TWOPOINTOH_LIBRARIES)
 
+            # The ETag of a part of the libraries is not the ETag of the object
+            known_etag = get_known_etag(request) if view is None else None
+
+            if current_app.config['ADS_TWO_POINT_OH_STREAM_LIBRARIES'] \
+                    and view is None:
+                try:
+                    etag, stream = TwoPointOhLibraries.stream_s3_library(
+                        library_file_name,
+                        known_etag=known_etag
+                    )
+                except Exception as error:
+                    current_app.logger.error(
+                        'Unknown error with AWS: {}'.format(error)
+                    )
+                    return err(TWOPOINTOH_AWS_PROBLEM)
+
+                if stream is None:
+                    return not_modified(etag)
+
+                response = Response(stream, mimetype='application/json')
+                response.headers['ETag'] = etag
+                return response
+
             try:
-                library = TwoPointOhLibraries.get_s3_library(library_file_name)
+                etag, library = TwoPointOhLibraries.fetch_s3_library(
+                    library_file_name,
+                    known_etag=known_etag
+                )
             except Exception as error:
                 current_app.logger.error(
                     'Unknown error with AWS: {}'.format(error)
                 )
                 return err(TWOPOINTOH_AWS_PROBLEM)
 
-            return {'libraries': library}, 200
+            if library is None:
+                return not_modified(etag)
+
+            etag = view_etag(etag, view)
+            if is_known_etag(request, etag):
+                return not_modified(etag)
+
+            return {'libraries': select_libraries(library, view)}, 200, \
+                {'ETag': etag}
+
+
+class TwoPointOhLibrariesBatch(BaseView):
+    """
+    End point to collect the ADS 2.0 libraries of many users at once, for
+    internal migration jobs. The users are looked up in a single query, and
+    their libraries are fetched from S3 concurrently.
+    """
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['adsws:internal']
+    rate_limit = [1000, 60*60*24]
+
+    @staticmethod
+    def fetch_library(app, uid, library_file_name):
+        """
+        Get the ADS 2.0 libraries of one user; run in the thread pool
+
+        :param app: flask.Flask application instance
+        :param uid: user ID for the API
+        :param library_file_name: name of library file
+
+        :return: dict of the result for this user
+        """
+        with app.app_context():
+            try:
+                library = TwoPointOhLibraries.get_s3_library(library_file_name)
+            except Exception as error:
+                app.logger.error(
+                    'Unknown error with AWS for user {}: {}'.format(uid, error)
+                )
+                return TwoPointOhLibrariesBatch.error(uid, TWOPOINTOH_AWS_PROBLEM)
+
+        return {'uid': uid, 'libraries': library}
+
+    @staticmethod
+    def error(uid, error_dictionary):
+        """
+        Result for a user whose libraries could not be returned
+
+        :param uid: user ID for the API
+        :param error_dictionary: name of the error dictionary
+
+        :return: dict of the result for this user
+        """
+        message, code = err(error_dictionary)
+        message.update(uid=uid, code=code)
+        return message
+
+    def post(self):
+        """
+        HTTP POST request that finds the libraries within ADS 2.0 for a list
+        of users.
+
+        Post body:
+        ----------
+        KEYWORD, VALUE
+        uids: <list<int>> user IDs for the API
+
+        Return data (on success)
+        ------------------------
+        Newline delimited JSON, one line per user in the order their
+        libraries become available. Each line contains:
+            uid: <int> user ID for the API
+            libraries: <list<dict>> as returned by /libraries/twopointoh/<uid>
+        or, if the libraries of the user could not be returned:
+            uid: <int> user ID for the API
+            error: <string> error message
+            code: <int> HTTP code of the error for a single user
+
+        HTTP Responses:
+        --------------
+        Succeed getting libraries: 200
+        Bad/malformed data: 400
+        Unknown error: 500
+
+        Any other responses will be default Flask errors
+        """
+        try:
+            post_data = get_post_data(request, types={'uids': list})
+            uids = [int(uid) for uid in post_data['uids']]
+        except (KeyError, TypeError, ValueError):
+            current_app.logger.warning('User did not provide a list of uids')
+            return err(CLASSIC_DATA_MALFORMED)
+
+        if len(uids) > current_app.config['ADS_TWO_POINT_OH_BATCH_MAX_UIDS']:
+            current_app.logger.warning(
+                'User asked for too many uids: {}'.format(len(uids))
+            )
+            return err(CLASSIC_DATA_MALFORMED)
+
+        if not current_app.users_ready.is_set():
+            current_app.logger.error(
+                'Users from MongoDB have not been loaded into the app'
+            )
+            return err(TWOPOINTOH_AWS_PROBLEM)
+
+        with current_app.session_scope() as session:
+            emails = dict(
+                session.query(Users.absolute_uid, Users.twopointoh_email)
+                .filter(Users.absolute_uid.in_(uids))
+                .all()
+            )
+
+        results, library_file_names = [], {}
+        for uid in uids:
+            if not emails.get(uid):
+                results.append(self.error(uid, NO_TWOPOINTOH_ACCOUNT))
+                continue
+
+            library_file_name = current_app.config['ADS_TWO_POINT_OH_USERS'].get(
+                emails[uid],
+                None
+            )
+            if not library_file_name:
+                results.append(self.error(uid, NO_TWOPOINTOH_LIBRARIES))
+                continue
+
+            library_file_names[uid] = library_file_name
+
+        app = current_app._get_current_object()
+        max_workers = current_app.config['ADS_TWO_POINT_OH_BATCH_WORKERS']
+
+        def generate():
+            for result in results:
+                yield json.dumps(result, default=to_json_value) + '\n'
+
+            if not library_file_names:
+                return
+
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            try:
+                futures = [
+                    executor.submit(self.fetch_library, app, uid, name)
+                    for uid, name in library_file_names.items()
+                ]
+                for future in as_completed(futures):
+                    yield json.dumps(
+                        future.result(), default=to_json_value
+                    ) + '\n'
+            finally:
+                executor.shutdown(wait=False)
+
+        return Response(generate(), mimetype='application/x-ndjson')
 
 
 class ExportTwoPointOhLibraries(BaseView):
@@ -241,6 +653,154 @@ class ExportTwoPointOhLibraries(BaseView):
     scopes = ['user']
     rate_limit = [1000, 60*60*24]
 
+    @staticmethod
+    def export_exists(key):
+        """
+        Check if the export archive exists in the storage. The answer is kept
+        for HARBOUR_EXPORT_EXISTS_TTL seconds.
+
+        :param key: key of the export archive
+        :type key: str
+
+        :return: boolean
+        """
+        exists = current_app.export_exists_cache.get(key)
+        if exists is None:
+            try:
+                current_app.storage.head(key)
+                exists = True
+            except NotFound:
+                exists = False
+            current_app.export_exists_cache.set(key, exists, size=len(key))
+
+        return exists
+
+    @staticmethod
+    def generated_key(key):
+        """
+        Key under which a generated export archive is stored. It is not the
+        key of the export, so that the export, which has more than the
+        generated archive, is used once it exists.
+
+        :param key: key of the export archive
+        :return: str
+        """
+        return key.replace('.zip', '.generated.zip')
+
+    @staticmethod
+    def tee_archive(app, libraries, key, flight):
+        """
+        Generate the export archive of a user's libraries, and yield it while
+        a copy is written to a temporary file, which is stored once the
+        archive is complete. The call in flight for the archive, see
+        generate_archive, lands once it is stored, and without an outcome if
+        the client went away before the end.
+
+        :param app: flask.Flask application instance
+        :param libraries: ADS 2.0 libraries of the user
+        :param key: key under which the archive is stored
+        :param flight: flight of the call, see harbour.client.SingleFlight
+
+        :return: generator of bytes
+        """
+        flight_key = ('export', key)
+        try:
+            with tempfile.TemporaryFile() as archive_file:
+                for chunk in stream_library_archive(libraries):
+                    archive_file.write(chunk)
+                    yield chunk
+
+                try:
+                    archive_file.seek(0)
+                    app.storage.put(key, archive_file)
+                except Exception as error:
+                    # The client has the whole archive, the requests that
+                    # waited for it generate it themselves
+                    app.logger.error(
+                        'Could not store the generated export {}: {}'
+                        .format(key, error)
+                    )
+                    return
+
+            app.export_exists_cache.set(key, True, size=len(key))
+            app.logger.info('Stored the generated export {}'.format(key))
+            app.single_flight.land(flight_key, flight)
+        except Exception as error:
+            app.single_flight.land(flight_key, flight, error=error)
+            raise
+        finally:
+            app.single_flight.land(flight_key, flight, outcome=False)
+
+    @staticmethod
+    def archive_response(chunks, file_name):
+        """
+        Response that downloads an export archive
+
+        :param chunks: iterable of bytes
+        :param file_name: name of the archive for the client
+
+        :return: flask.Response
+        """
+        response = Response(chunks, mimetype='application/zip')
+        response.headers['Content-Disposition'] = \
+            'attachment; filename={}'.format(file_name)
+        return response
+
+    @staticmethod
+    def generate_archive(library_file_name, key, file_name):
+        """
+        Generate the export archive of a user's libraries, and stream it to
+        the client as it is generated, while it is stored. Concurrent
+        requests for the same archive wait for it to be stored, and stream it
+        from the storage.
+
+        :param library_file_name: name of library file
+        :type library_file_name: str
+        :param key: key under which the archive is stored, see generated_key
+        :type key: str
+        :param file_name: name of the archive for the client
+        :type file_name: str
+
+        :return: flask.Response
+        """
+        app = current_app._get_current_object()
+        flight_key = ('export', key)
+        while True:
+            leader, flight = app.single_flight.join(flight_key)
+            if leader:
+                break
+
+            landed, _ = app.single_flight.wait(flight)
+            if landed:
+                _, chunks = app.storage.stream(
+                    key,
+                    app.config['ADS_TWO_POINT_OH_STREAM_CHUNK_SIZE']
+                )
+                return ExportTwoPointOhLibraries.archive_response(
+                    chunks, file_name
+                )
+
+        try:
+            libraries = TwoPointOhLibraries.get_s3_library(library_file_name)
+        except Exception as error:
+            app.single_flight.land(flight_key, flight, error=error)
+            raise
+        except BaseException:
+            app.single_flight.land(flight_key, flight, outcome=False)
+            raise
+
+        response = ExportTwoPointOhLibraries.archive_response(
+            ExportTwoPointOhLibraries.tee_archive(
+                app, libraries, key, flight
+            ),
+            file_name
+        )
+        # The archive is not generated if the response is closed unread
+        response.call_on_close(
+            lambda: app.single_flight.land(flight_key, flight, outcome=False)
+        )
+        return response
+
     def get(self, export):
         """
         HTTP GET request that collects a users ADS 2.0 libraries from the flat
@@ -251,7 +811,16 @@ class ExportTwoPointOhLibraries(BaseView):
 
         Return data (on success)
         ------------------------
-        BibTeX file (.bib)
+        url: <string> temporary URL of the export (.zip of .bib files)
+
+        The URL is signed for HARBOUR_EXPORT_URL_EXPIRES seconds and reused
+        while more than HARBOUR_EXPORT_URL_MIN_REMAINING of that lifetime
+        remains. Cache-Control tells the client how long it stays valid.
+
+        If the export has not been generated yet and HARBOUR_EXPORT_GENERATE
+        is enabled, the .zip is generated and returned as a download instead.
+        It is stored under a key of its own, see generated_key, so that the
+        next request gets a URL until the export itself exists.
 
         HTTP Responses:
         --------------
@@ -266,7 +835,7 @@ class ExportTwoPointOhLibraries(BaseView):
             if export not in current_app.config['HARBOUR_EXPORT_TYPES']:
                 return err(TWOPOINTOH_WRONG_EXPORT_TYPE)
 
-            if not current_app.config['ADS_TWO_POINT_OH_LOADED_USERS']:
+            if not current_app.users_ready.is_set():
                 current_app.logger.error(
                     'Users from MongoDB have not been loaded into the app'
                 )
@@ -298,23 +867,253 @@ class ExportTwoPointOhLibraries(BaseView):
                 )
                 return err(NO_TWOPOINTOH_LIBRARIES)
 
+            key = library_file_name.replace('.json', '.{}.zip'.format(export))
+
+            # Signed URLs are reused while enough of their lifetime remains
+            presigned = current_app.export_url_cache.get((key, export))
+
+            if presigned is None and \
+                    current_app.config['HARBOUR_EXPORT_GENERATE']:
+                try:
+                    if not self.export_exists(key):
+                        key = self.generated_key(key)
+                        if not self.export_exists(key):
+                            return self.generate_archive(
+                                library_file_name,
+                                key,
+                                '{}_{}.zip'.format(
+                                    user.twopointoh_email.split('@')[0],
+                                    export
+                                )
+                            )
+                        presigned = current_app.export_url_cache.get(
+                            (key, export)
+                        )
+                except Exception as error:
+                    current_app.logger.error(
+                        'Unknown error with AWS: {}'.format(error)
+                    )
+                    return err(TWOPOINTOH_AWS_PROBLEM)
+
+            if presigned is None:
+                expires_in = current_app.config['HARBOUR_EXPORT_URL_EXPIRES']
+                try:
+                    s3_presigned_url = current_app.storage.presign(
+                        key,
+                        expires_in
+                    )
+                except Exception as error:
+                    current_app.logger.error(
+                        'Unknown error with AWS: {}'.format(error)
+                    )
+                    return err(TWOPOINTOH_AWS_PROBLEM)
+
+                presigned = (s3_presigned_url, time.time() + expires_in)
+                current_app.export_url_cache.set(
+                    (key, export),
+                    presigned,
+                    size=len(s3_presigned_url)
+                )
+
+            s3_presigned_url, expires_at = presigned
+            max_age = max(int(expires_at - time.time()), 0)
+
+            return {'url': s3_presigned_url}, 200, {
+                'Cache-Control': 'private, max-age={}'.format(max_age)
+            }
+
+
+class ExportBibTeX(BaseView):
+    """
+    End point to export all the documents of the user's ADS Classic or ADS 2.0
+    libraries as a single BibTeX file, built by the export service
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['user']
+    rate_limit = [100, 60*60*24]
+
+    sources = ['classic', 'twopointoh']
+
+    @staticmethod
+    def get_bibcodes(user, source):
+        """
+        Bibcodes of all the libraries of the user, without duplicates
+
+        :param user: user of the service
+        :type user: harbour.models.Users
+        :param source: classic or twopointoh
+        :type source: str
+
+        :return: list of bibcodes, or an error dictionary
+        """
+        if source == 'classic':
+            if not user.classic_email:
+                return NO_CLASSIC_ACCOUNT
             try:
-                s3 = boto3.client('s3')
-                s3_presigned_url = s3.generate_presigned_url(
-                    ClientMethod='get_object',
-                    Params={
-                        'Bucket': current_app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
-                        'Key': library_file_name.replace('.json', '.{}.zip'.format(export))
-                    },
-                    ExpiresIn=1800
+                classic = ClassicLibraries.get_classic_libraries(user)
+            except requests.exceptions.Timeout:
+                return CLASSIC_TIMEOUT
+            except CircuitOpenError:
+                return CLASSIC_UNAVAILABLE
+            if classic is None:
+                return CLASSIC_UNKNOWN_ERROR
+            libraries = classic[0]
+        else:
+            if not user.twopointoh_email:
+                return NO_TWOPOINTOH_ACCOUNT
+            if not current_app.users_ready.is_set():
+                current_app.logger.error(
+                    'Users from MongoDB have not been loaded into the app'
                 )
+                return TWOPOINTOH_AWS_PROBLEM
+
+            library_file_name = current_app.config['ADS_TWO_POINT_OH_USERS'].get(
+                user.twopointoh_email,
+                None
+            )
+            if not library_file_name:
+                return NO_TWOPOINTOH_LIBRARIES
+            try:
+                libraries = TwoPointOhLibraries.get_s3_library(library_file_name)
             except Exception as error:
                 current_app.logger.error(
                     'Unknown error with AWS: {}'.format(error)
                 )
-                return err(TWOPOINTOH_AWS_PROBLEM)
+                return TWOPOINTOH_AWS_PROBLEM
+
+        bibcodes = OrderedDict()
+        for library in libraries:
+            for bibcode, tags, notes in library_documents(library):
+                bibcodes[bibcode] = None
+
+        return list(bibcodes)
+
+    @staticmethod
+    def export_service_headers():
+        """
+        Headers of the requests to the export service, which are made outside
+        of the request context
 
-            return {'url': s3_presigned_url}, 200
+        :return: dict
+        """
+        return {
+            'Authorization': current_app.config.get('SERVICE_TOKEN', None) or
+            request.headers.get(
+                'X-Forwarded-Authorization',
+                request.headers.get('Authorization', None)
+            )
+        }
+
+    @staticmethod
+    def export_batch(app, headers, bibcodes):
+        """
+        BibTeX of a batch of bibcodes from the export service; run in the
+        thread pool
+
+        :param app: flask.Flask application instance
+        :param headers: headers of the request, see export_service_headers
+        :param bibcodes: list of bibcodes
+
+        :return: bytes
+        """
+        response = app.client.post(
+            '{}/bibtex'.format(app.config['HARBOUR_EXPORT_SERVICE_URL']),
+            json={'bibcode': bibcodes},
+            headers=headers,
+            timeout=app.config['HARBOUR_EXPORT_SERVICE_TIMEOUT']
+        )
+        if response.status_code != 200:
+            raise ValueError(
+                'Export service returned "{}" [code: {}]'
+                .format(response.text, response.status_code)
+            )
+        return response.json()['export'].encode('utf-8')
+
+    def get(self, source):
+        """
+        HTTP GET request that collects the bibcodes of all the libraries of
+        the user, and returns their BibTeX from the export service.
+
+        :param source: libraries to export, classic or twopointoh
+        :type source: str
+
+        Return data (on success)
+        ------------------------
+        BibTeX file (application/x-bibtex)
+
+        The bibcodes are sent to the export service in batches of
+        HARBOUR_EXPORT_BATCH_SIZE, HARBOUR_EXPORT_WORKERS at a time, and the
+        BibTeX is streamed to the client in the order of the bibcodes as soon
+        as each batch is ready. If the export service fails after the first
+        batch, the file ends with an @COMMENT saying it is incomplete.
+
+        HTTP Responses:
+        --------------
+        Succeed getting the BibTeX: 200
+        Unknown source: 400
+        User does not have a classic/ADS 2.0 account: 400
+        User does not have any libraries in their ADS 2.0 account: 400
+        Export service failed: 500
+        ADS Classic times out: 504
+
+        Any other responses will be default Flask errors
+        """
+        if source not in self.sources:
+            return err(WRONG_EXPORT_SOURCE)
+
+        absolute_uid = self.helper_get_user_id()
+
+        with current_app.session_scope() as session:
+            try:
+                user = session.query(Users)\
+                    .filter(Users.absolute_uid == absolute_uid).one()
+            except NoResultFound:
+                current_app.logger.warning(
+                    'User does not have an associated ADS Classic/2.0 account'
+                )
+                return err(NO_CLASSIC_ACCOUNT if source == 'classic'
+                           else NO_TWOPOINTOH_ACCOUNT)
+
+            bibcodes = self.get_bibcodes(user, source)
+
+        if isinstance(bibcodes, dict):
+            return err(bibcodes)
+
+        app = current_app._get_current_object()
+        headers = self.export_service_headers()
+        stream = stream_batches(
+            lambda batch: self.export_batch(app, headers, batch),
+            bibcodes,
+            batch_size=current_app.config['HARBOUR_EXPORT_BATCH_SIZE'],
+            workers=current_app.config['HARBOUR_EXPORT_WORKERS']
+        )
+
+        # Errors on the first batch can still be returned to the client
+        try:
+            first = next(stream, b'')
+        except Exception as error:
+            current_app.logger.error(
+                'Export service failed: {}'.format(error)
+            )
+            return err(EXPORT_SERVICE_FAIL)
+
+        # Later errors can only be reported in the file itself
+        def generate():
+            yield first
+            try:
+                for chunk in stream:
+                    yield chunk
+            except Exception as error:
+                app.logger.error(
+                    'Export service failed during the export: {}'.format(error)
+                )
+                yield BIBTEX_INCOMPLETE
+
+        response = Response(generate(), mimetype='application/x-bibtex')
+        response.headers['Content-Disposition'] = \
+            'attachment; filename={}_libraries.bib'.format(source)
+        return response
 
 
 class ClassicLibraries(BaseView):
@@ -327,6 +1126,171 @@ class ClassicLibraries(BaseView):
     scopes = ['adsws:internal']
     rate_limit = [1000, 60*60*24]
 
+    @staticmethod
+    def get_classic_libraries(user):
+        """
+        Get the libraries of a user from the ADS Classic libraries end point.
+
+        The libraries are cached by mirror and cookie in
+        app.classic_library_cache. Once they are older than
+        ADS_CLASSIC_LIBRARY_CACHE_TTL, the cached libraries are returned
+        straight away while they are fetched again in the background; if ADS
+        Classic fails, the last good copy is kept.
+
+        The ETag of the libraries is computed once, when they are fetched,
+        and cached with them.
+
+        :param user: user with an ADS Classic account
+        :type user: harbour.models.Users
+
+        :return: tuple of the list of libraries and their ETag, or None if
+            ADS Classic did not return them
+        :raises requests.exceptions.Timeout: if ADS Classic timed out
+        :raises harbour.client.CircuitOpenError: if the mirror is unavailable
+        """
+        app = current_app._get_current_object()
+        mirror, cookie = user.classic_mirror, user.classic_cookie
+
+        def fetch():
+            libraries = ClassicLibraries.fetch_classic_libraries(
+                app, mirror, cookie
+            )
+            if libraries is None:
+                return None
+            return libraries, content_etag(libraries)
+
+        return app.classic_library_cache.get(
+            (mirror, cookie),
+            fetch,
+            size=lambda entry: libraries_size(entry[0])
+        )
+
+    @staticmethod
+    def libraries_url(app, mirror, cookie):
+        """
+        URL of the libraries of a user on ADS Classic
+        :param app: flask.Flask application instance
+        :param mirror: ADS Classic mirror of the user
+        :param cookie: ADS Classic cookie of the user
+        :return: str
+        """
+        return app.config['ADS_CLASSIC_LIBRARIES_URL'].format(
+            mirror=mirror,
+            cookie=cookie
+        )
+
+    @staticmethod
+    def fetch_classic_libraries(app, mirror, cookie):
+        """
+        Get the libraries of a user from ADS Classic, without the cache. It
+        does not need a request context, so that it can run in a background
+        thread. Concurrent requests for the same URL share a single call.
+
+        :param app: flask.Flask application instance
+        :param mirror: ADS Classic mirror of the user
+        :param cookie: ADS Classic cookie of the user
+
+        :return: list of libraries, or None if ADS Classic did not return them
+        :raises requests.exceptions.Timeout: if ADS Classic timed out
+        :raises harbour.client.CircuitOpenError: if the mirror is unavailable
+        """
+        url = ClassicLibraries.libraries_url(app, mirror, cookie)
+        app.logger.debug('Obtaining libraries via: {}'.format(url))
+        try:
+            return app.single_flight.do(
+                ('classic', url),
+                lambda: ClassicLibraries.read_classic_libraries(app, url)
+            )
+        except requests.exceptions.Timeout:
+            app.logger.warning(
+                'ADS Classic timed out before finishing: {}'.format(url)
+            )
+            raise
+
+    @staticmethod
+    def read_classic_libraries(app, url):
+        """
+        Request the libraries from ADS Classic and parse them. With
+        ADS_CLASSIC_LIBRARIES_STREAM, the response is read in chunks and
+        parsed as it arrives, see parse_classic_libraries.
+
+        :param app: flask.Flask application instance
+        :param url: URL of the libraries of the user
+
+        :return: list of libraries, or None if ADS Classic did not return them
+        """
+        stream = app.config.get('ADS_CLASSIC_LIBRARIES_STREAM', False)
+        response = app.client.get(url, policy='libraries', stream=stream)
+        try:
+            if response.status_code != 200:
+                app.logger.info(
+                    'ADS Classic returned an unkown status code: "{}" [code: {}]'
+                    .format(response.text, response.status_code)
+                )
+                return None
+
+            if not stream:
+                data = response.json()
+                return [Library(
+                    name=i['name'],
+                    description=i.get('desc', ''),
+                    documents=BibcodeList(j['bibcode'] for j in i['entries'])
+                ) for i in data['libraries']]
+
+            chunks = response.iter_content(
+                chunk_size=app.config.get('ADS_CLASSIC_LIBRARIES_CHUNK_SIZE', 65536)
+            )
+            return list(ClassicLibraries.parse_classic_libraries(
+                chunks, encoding=response.encoding or 'utf-8'
+            ))
+        finally:
+            response.close()
+
+    @staticmethod
+    def parse_classic_libraries(chunks, encoding='utf-8'):
+        """
+        Parse the libraries of an ADS Classic response one at a time, keeping
+        only the name, description and bibcodes. Entries are decoded one at a
+        time too, so that neither the document nor a whole library with the
+        other fields of its entries is held in memory.
+
+        :param chunks: iterable of the chunks of the response
+        :param encoding: encoding of the response
+
+        :return: generator of harbour.library_model.Library
+        :raises ValueError: if the response is not valid JSON
+        :raises KeyError: if a library has no name or entries
+        """
+        stream = JSONStream(chunks, encoding=encoding)
+        found = False
+        for key in stream.iter_object():
+            if key != 'libraries':
+                stream.skip()
+                continue
+
+            found = True
+            for _ in stream.iter_array():
+                library = {'desc': ''}
+                for field in stream.iter_object():
+                    if field == 'entries':
+                        library['entries'] = BibcodeList(
+                            stream.value()['bibcode']
+                            for _ in stream.iter_array()
+                        )
+                    elif field in ('name', 'desc'):
+                        library[field] = stream.value()
+                    else:
+                        stream.skip()
+
+                yield Library(
+                    name=library['name'],
+                    description=library['desc'],
+                    documents=library['entries']
+                )
+
+        if not found:
+            raise KeyError('libraries')
+
     def get(self, uid):
         """
         HTTP GET request that contacts the ADS Classic libraries end point to
@@ -343,15 +1307,37 @@ class ClassicLibraries(BaseView):
             description: <string> description of the library
             documents: <list<string>> list of documents
 
+        Optional parameters
+        -------------------
+        offset: <int> index of the first library returned, default 0
+        limit: <int> maximum number of libraries returned, default all
+        fields: <string> comma-separated keys of each library returned, from
+            name, description and documents
+        summary: <bool> return only the name and number of documents
+            (num_documents) of each library
+
+        The ETag of the response is a hash of the libraries, combined with the
+        parameters above when they are given.
+
         HTTP Responses:
         --------------
         Succeed getting libraries: 200
+        Libraries have not changed since the ETag in If-None-Match: 304
+        Wrong value of offset, limit, fields or summary: 400
         User does not have a classic account: 400
         ADS Classic give unknown messages: 500
         ADS Classic times out: 504
 
         Any other responses will be default Flask errors
         """
+        try:
+            view = get_library_view(request.args)
+        except ValueError as error:
+            current_app.logger.warning(
+                'Wrong library parameters: {}'.format(error)
+            )
+            return err(LIBRARY_BAD_PARAMETERS)
+
         with current_app.session_scope() as session:
             try:
                 user = session.query(Users).filter(Users.absolute_uid == uid).one()
@@ -363,35 +1349,23 @@ class ClassicLibraries(BaseView):
                 )
                 return err(NO_CLASSIC_ACCOUNT)
 
-            url = current_app.config['ADS_CLASSIC_LIBRARIES_URL'].format(
-                mirror=user.classic_mirror,
-                cookie=user.classic_cookie
-            )
-            current_app.logger.debug('Obtaining libraries via: {}'.format(url))
             try:
-                response = current_app.client.get(url)
+                classic = ClassicLibraries.get_classic_libraries(user)
             except requests.exceptions.Timeout:
-                current_app.logger.warning(
-                    'ADS Classic timed out before finishing: {}'.format(url)
-                )
                 return err(CLASSIC_TIMEOUT)
+            except CircuitOpenError:
+                return err(CLASSIC_UNAVAILABLE)
 
-            if response.status_code != 200:
-                current_app.logger.info(
-                    'ADS Classic returned an unkown status code: "{}" [code: {}]'
-                    .format(response.text, response.status_code)
-                )
+            if classic is None:
                 return err(CLASSIC_UNKNOWN_ERROR)
 
-            data = response.json()
-
-            libraries = [dict(
-                name=i['name'],
-                description=i.get('desc', ''),
-                documents=[j['bibcode'] for j in i['entries']]
-            ) for i in data['libraries']]
+            libraries, etag = classic
+            etag = view_etag(etag, view)
+            if is_known_etag(request, etag):
+                return not_modified(etag)
 
-            return {'libraries': libraries}, 200
+            return {'libraries': select_libraries(libraries, view)}, 200, \
+                {'ETag': etag}
 
 
 class AuthenticateUserClassic(BaseView):
@@ -474,13 +1448,19 @@ class AuthenticateUserClassic(BaseView):
             try:
                 response = current_app.client.post(
                     url,
-                    params=params
+                    params=params,
+                    policy='auth'
                 )
             except requests.exceptions.Timeout:
                 current_app.logger.warning(
                     'ADS Classic end point timed out, returning to user'
                 )
                 return err(CLASSIC_TIMEOUT)
+            except CircuitOpenError:
+                current_app.logger.warning(
+                    'ADS Classic mirror "{}" is unavailable'.format(classic_mirror)
+                )
+                return err(CLASSIC_UNAVAILABLE)
 
             if response.status_code >= 500:
                 message, status_code = err(CLASSIC_UNKNOWN_ERROR)
@@ -632,13 +1612,21 @@ class AuthenticateUserTwoPointOh(BaseView):
         try:
             response = current_app.client.post(
                 url,
-                params=params
+                params=params,
+                policy='auth'
             )
         except requests.exceptions.Timeout:
             current_app.logger.warning(
                 'ADS Classic end point timed out, returning to user'
             )
             return err(CLASSIC_TIMEOUT)
+        except CircuitOpenError:
+            current_app.logger.warning(
+                'ADS Classic mirror "{}" is unavailable'.format(
+                    current_app.config['ADS_TWO_POINT_OH_MIRROR']
+                )
+            )
+            return err(CLASSIC_UNAVAILABLE)
 
         if response.status_code >= 500:
             message, status_code = err(CLASSIC_UNKNOWN_ERROR)
@@ -715,6 +1703,20 @@ class ClassicMyADS(BaseView):
     scopes = ['adsws:internal']
     rate_limit = [1000, 60*60*24]
 
+    @staticmethod
+    def myads_url(app, email):
+        """
+        URL of the myADS settings of a user on the fastest healthy mirror
+        that serves them, see harbour.mirrors.myads_mirror
+        :param app: flask.Flask application instance
+        :param email: ADS Classic e-mail of the user
+        :return: str
+        """
+        return app.config['ADS_CLASSIC_MYADS_URL'].format(
+            mirror=myads_mirror(app),
+            email=email
+        )
+
     def get(self, uid):
         """
         HTTP GET request that contacts the ADS Classic myADS end point to
@@ -748,19 +1750,25 @@ class ClassicMyADS(BaseView):
                 )
                 return err(NO_CLASSIC_ACCOUNT)
 
-            url = current_app.config['ADS_CLASSIC_MYADS_URL'].format(
-                mirror='adsabs.harvard.edu',
-                email=user.classic_email
-            )
+            url = ClassicMyADS.myads_url(current_app, user.classic_email)
 
             current_app.logger.debug('Obtaining libraries via: {}'.format(url))
             try:
-                response = current_app.client.get(url)
+                # Concurrent requests for the same URL share a single call
+                response = current_app.single_flight.do(
+                    ('classic', url),
+                    lambda: current_app.client.get(url, policy='myads')
+                )
             except requests.exceptions.Timeout:
                 current_app.logger.warning(
                     'ADS Classic timed out before finishing: {}'.format(url)
                 )
                 return err(CLASSIC_TIMEOUT)
+            except CircuitOpenError:
+                current_app.logger.warning(
+                    'ADS Classic mirror is unavailable: {}'.format(url)
+                )
+                return err(CLASSIC_UNAVAILABLE)
 
             if response.status_code != 200:
                 current_app.logger.warning(
@@ -8,8 +8,10 @@
 
 from werkzeug.serving import run_simple
 from harbour import app
+from harbour.mirrors import start_mirror_prober
 
 application = app.create_app()
+start_mirror_prober(application)
 
 if __name__ == "__main__":
     run_simple(